@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+"""Asynchronous DNS resolver
+
+This module contains a resolver built on asyncio. All resolutions running in
+an event loop share a single UDP endpoint, and responses are matched to the
+queries waiting for them by transaction ID and source address. This allows a
+single process to have thousands of resolutions outstanding at once.
+
+The resolution algorithm is the same as the one of Resolver, which is reused
+for everything that does not involve the network. Concurrent resolutions of
+the same name are coalesced into one.
+"""
+
+import asyncio
+import copy
+import socket
+import time
+
+from dns.classes import Class
+from dns.message import Message
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.resolver import BudgetExceeded, NoData, ResolutionBudget, \
+    ResolutionFailed, Resolver
+from dns.types import Type
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol that dispatches responses to waiting queries"""
+
+    def __init__(self):
+        """Initialize the protocol"""
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = Message.from_bytes(data)
+        except (ValueError, IndexError):
+            return
+        future = self.pending.pop((response.header.ident, addr[:2]), None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        exc = exc or ConnectionError("endpoint closed")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+    def query(self, message, addr):
+        """Send a query and get a future for its response
+
+        Args:
+            message (Message): the query
+            addr ((str, int)): address of the nameserver
+
+        Returns:
+            asyncio.Future: future for the response
+        """
+        key = (message.header.ident, addr)
+        while key in self.pending:
+            message.header.ident = (message.header.ident + 1) % 2**16
+            key = (message.header.ident, addr)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        self.transport.sendto(message.to_bytes(), addr)
+        return future
+
+    def cancel(self, message, addr):
+        """Stop waiting for the response to a query"""
+        future = self.pending.pop((message.header.ident, addr), None)
+        if future is not None:
+            future.cancel()
+
+
+class AsyncResolver(Resolver):
+    """DNS resolver for asyncio
+
+    The resolver has to be opened inside the event loop before it is used.
+    query_recursive and gethostbyname are coroutines.
+    """
+
+    def __init__(self, timeout, cache=None, stagger_delay=0.2, fanout=3,
+                 infra=None, max_queries=100, time_limit=10, max_chain=8,
+                 tcp=None, payload=1232, stale_timeout=1.8):
+        """Initialize the resolver
+
+        Args:
+            timeout (float): timeout for each upstream query
+            cache (RecordCache): the cache
+            stagger_delay (float): seconds to wait for a response before
+                also querying the next nameserver of a zone
+            fanout (int): maximum number of nameservers queried for one
+                step of a resolution
+            infra (InfrastructureCache): round-trip times of nameservers
+            max_queries (int): maximum number of queries sent for one
+                resolution, including its sub-resolutions
+            time_limit (float): maximum duration of one resolution
+            max_chain (int): maximum number of CNAME records followed
+            tcp (TCPPool): connections for truncated responses
+            payload (int): EDNS0 UDP payload size advertised in queries
+            stale_timeout (float): seconds after which stale records are
+                served while the resolution goes on, never if None
+        """
+        super().__init__(
+            timeout, cache, stagger_delay, fanout, infra,
+            max_queries=max_queries, time_limit=time_limit,
+            max_chain=max_chain, tcp=tcp, payload=payload,
+            stale_timeout=stale_timeout,
+        )
+        self.transport = None
+        self.protocol = None
+        self.inflight = {}
+        self.background = set()
+        self.coalesced = 0
+
+    async def open(self):
+        """Create the UDP endpoint used for upstream queries"""
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            UpstreamProtocol, local_addr=("0.0.0.0", 0)
+        )
+
+    def close(self):
+        """Close the UDP endpoint"""
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def send_query(self, hostname, ip, timeout=None, type_=Type.A,
+                         class_=Class.IN, budget=None):
+        """Send a query to a nameserver and wait for the response
+
+        A truncated response is retried over TCP. A response with an RCODE
+        other than NOERROR and NXDOMAIN counts as a failure of the
+        nameserver, after a FORMERR the query is first repeated without an
+        EDNS0 OPT record (RFC 6891 section 7).
+
+        Args:
+            hostname (str): the hostname to query
+            ip (str): address of the nameserver
+            timeout (float): timeout, defaults to the resolver timeout
+            type_ (Type): the type to query
+            class_ (Class): the class to query
+            budget (ResolutionBudget): budget a TCP retry is taken from
+
+        Returns:
+            Message: the response
+
+        Raises:
+            socket.timeout: if no response arrived in time
+            ConnectionError: if the nameserver failed or refused
+        """
+        if timeout is None:
+            timeout = self.timeout
+        addr = (ip, self.port)
+        sent = time.monotonic()
+        payload = self.payload
+        while True:
+            query = Resolver.make_query(
+                hostname, type_, class_, payload, self.recursion_desired
+            )
+            future = self.protocol.query(query, addr)
+            try:
+                response = await asyncio.wait_for(
+                    future, max(sent + timeout - time.monotonic(), 0.001)
+                )
+            except asyncio.TimeoutError:
+                if self.infra is not None:
+                    self.infra.record_timeout(ip, timeout)
+                raise socket.timeout("timed out")
+            except asyncio.CancelledError:
+                # another nameserver won, this one took at least this long
+                if self.infra is not None:
+                    self.infra.record_unanswered(
+                        ip, time.monotonic() - sent
+                    )
+                raise
+            finally:
+                self.protocol.cancel(query, addr)
+            if response.header.rcode != RCode.FormErr or payload == 0:
+                break
+            payload = 0
+        if response.header.rcode not in (RCode.NoError, RCode.NXDomain):
+            # a failure can be caused by the name, so it does not count
+            # against the health of the nameserver
+            raise ConnectionError("nameserver failed")
+        if self.infra is not None:
+            self.infra.record_rtt(ip, time.monotonic() - sent)
+        if response.header.tc:
+            # the TCP pool is blocking, so it is used from a worker thread
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, self.send_query_tcp, hostname, ip, budget, type_,
+                class_,
+            )
+        return response
+
+    async def send_query_staggered(self, hostname, ips, budget=None,
+                                   type_=Type.A, class_=Class.IN):
+        """Query a list of nameservers in a staggered fashion
+
+        See Resolver.send_query_staggered. The queries which lose the race
+        are cancelled, which raises the SRTT of their nameservers to the
+        time they went unanswered.
+
+        Args:
+            hostname (str): the hostname to query
+            ips ([str]): addresses of the nameservers, best first
+            budget (ResolutionBudget): every query is taken from the budget,
+                and no response is awaited beyond its deadline
+            type_ (Type): the type to query
+            class_ (Class): the class to query
+
+        Returns:
+            Message: the first response
+
+        Raises:
+            BudgetExceeded: if the budget ran out before a query was sent
+            socket.timeout: if no nameserver responded in time
+        """
+        ips = self.order_servers(ips)
+        tasks = []
+        try:
+            for ip in ips[:self.fanout]:
+                timeout = self.timeout
+                if budget is not None:
+                    try:
+                        budget.spend()
+                    except BudgetExceeded:
+                        if not tasks:
+                            raise
+                        break
+                    timeout = min(
+                        timeout, budget.deadline - time.monotonic()
+                    )
+                tasks.append(asyncio.ensure_future(
+                    self.send_query(
+                        hostname, ip, timeout, type_, class_, budget
+                    )
+                ))
+                done, _ = await asyncio.wait(
+                    tasks, timeout=self.stagger_delay,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    tasks.remove(task)
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    tasks.remove(task)
+            raise socket.timeout("timed out")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def query_recursive(self, hostname, ips=None, refresh=False,
+                              budget=None, type_=Type.A, class_=Class.IN,
+                              zone=None):
+        """Resolve a hostname iteratively
+
+        See Resolver.query_recursive.
+
+        Args:
+            hostname (str): the hostname to resolve
+            ips ([str]): addresses of the nameservers to start at
+            refresh (bool): whether to bypass the cached answer
+            budget (ResolutionBudget): budget of the resolution
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+            zone (Name): the zone of the nameservers at ips, the root if
+                None
+
+        Returns:
+            [ResourceRecord]: the answer
+        """
+        if budget is None:
+            budget = ResolutionBudget(self.max_queries, self.time_limit)
+        if ips is None:
+            key = (str(Name(hostname)).lower(), type_, class_, refresh)
+            task = self.inflight.get(key)
+            if task is asyncio.current_task():
+                return await self.resolve(hostname, refresh, budget, type_,
+                                          class_)
+            if task is None:
+                task = asyncio.ensure_future(
+                    self.resolve(hostname, refresh, budget, type_, class_)
+                )
+                self.inflight[key] = task
+                task.add_done_callback(
+                    lambda _: self.inflight.pop(key, None)
+                )
+                return copy.copy(await asyncio.shield(task))
+            self.coalesced += 1
+            try:
+                return copy.copy(await asyncio.wait_for(
+                    asyncio.shield(task), self.time_limit
+                ))
+            except asyncio.TimeoutError:
+                # the resolutions may be waiting for each other
+                return await self.resolve(hostname, refresh, budget, type_,
+                                          class_)
+
+        seen = set()
+        while True:
+            answer = None
+            if not refresh:
+                answer = self.lookup_cache(hostname, type_, class_)
+            if answer is not None:
+                return answer
+            if frozenset(ips) in seen:
+                raise ResolutionFailed("referral loop")
+            seen.add(frozenset(ips))
+
+            response = await self.send_query_staggered(
+                hostname, ips, budget, type_, class_
+            )
+            answer, ips, nsdnames, zone = self.process_response(
+                hostname, response, type_, class_, zone
+            )
+            if answer is not None:
+                return answer
+            error = None
+            for nsdname in nsdnames:
+                if ips:
+                    break
+                if str(nsdname).lower() in budget.resolving:
+                    continue  # would depend on itself
+                try:
+                    ips = Resolver.hostent(
+                        nsdname,
+                        await self.query_recursive(nsdname, budget=budget),
+                    )[2]
+                except BudgetExceeded:
+                    raise
+                except OSError as e:
+                    error = e  # try the next nameserver
+            if not ips:
+                if error is not None:
+                    raise error
+                raise ResolutionFailed("no nameserver address")
+
+    async def resolve(self, hostname, refresh=False, budget=None,
+                      type_=Type.A, class_=Class.IN):
+        """Resolve a hostname and follow its CNAME chain
+
+        See Resolver.resolve.
+
+        Args:
+            hostname (str): the hostname to resolve
+            refresh (bool): whether to bypass the cached answer of the
+                hostname itself
+            budget (ResolutionBudget): budget of the resolution
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+
+        Returns:
+            [ResourceRecord]: the CNAME records of the chain and the answer
+                for the canonical name
+        """
+        if budget is None:
+            budget = ResolutionBudget(self.max_queries, self.time_limit)
+        answer = []
+        sname = hostname
+        names = set()
+        while sname is not None and len(names) <= self.max_chain:
+            name = str(Name(sname)).lower()
+            if name in names:
+                break  # CNAME loop
+            names.add(name)
+            records = await self.resolve_link(
+                sname, refresh, budget, type_, class_
+            )
+            if not answer and isinstance(records, NoData):
+                return records
+            answer.extend(r for r in records if r not in answer)
+            if type_ in (Type.CNAME, Type.ANY):
+                break
+            sname = Resolver.canonical_name(sname, records)
+            refresh = False
+        return answer
+
+    async def resolve_link(self, hostname, refresh=False, budget=None,
+                           type_=Type.A, class_=Class.IN):
+        """Resolve one link of a CNAME chain
+
+        See Resolver.resolve_link.
+
+        Args:
+            hostname (str): the hostname to resolve
+            refresh (bool): whether to bypass the cached answer
+            budget (ResolutionBudget): budget of the resolution
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+
+        Returns:
+            [ResourceRecord]: the answer
+        """
+        name = str(Name(hostname)).lower()
+        budget.resolving.add(name)
+        try:
+            zone, ips = self.closest_delegation(hostname)
+            stale = None
+            if not refresh and self.stale_timeout is not None:
+                stale = self.lookup_stale(hostname, type_, class_, False)
+            if stale is None:
+                return await self.query_recursive(
+                    hostname, ips, refresh, budget, type_, class_, zone
+                )
+            task = asyncio.ensure_future(self.query_recursive(
+                hostname, ips, False, budget, type_, class_, zone
+            ))
+            self.background.add(task)
+            task.add_done_callback(self.finish_background)
+            done, _ = await asyncio.wait([task], timeout=self.stale_timeout)
+            if not done:
+                return stale  # the task goes on to refresh the cache
+            return task.result()
+        except OSError:
+            stale = None
+            if not refresh:
+                stale = self.lookup_stale(hostname, type_, class_)
+            if stale is None:
+                raise
+            return stale
+        finally:
+            budget.resolving.discard(name)
+
+    def finish_background(self, task):
+        """Forget a resolution that may have outlived its client"""
+        self.background.discard(task)
+        if not task.cancelled():
+            task.exception()  # retrieved, the client was already answered
+
+    async def gethostbyname(self, hostname):
+        """Translate a host name to IPv4 address.
+
+        See Resolver.gethostbyname.
+
+        Args:
+            hostname (str): the hostname to resolve
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        answers = await self.query_recursive(hostname)
+        return Resolver.hostent(hostname, answers)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""Asynchronous recursive DNS server
+
+This module contains a DNS server built on asyncio. Instead of starting a
+thread for every request, all requests are handled in one event loop.
+Questions which can be answered from the zones or the cache are answered
+right away, the others are resolved by an AsyncResolver without blocking
+the loop. The server shares the zones, cache and infrastructure cache of
+Server.
+"""
+
+import asyncio
+
+from dns.asyncresolver import AsyncResolver
+from dns.message import Message, Header
+from dns.resolver import Resolver
+from dns.server import RequestHandler, Server
+from dns.types import Type
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol that passes requests to an AsyncServer"""
+
+    def __init__(self, server):
+        """Initialize the protocol
+
+        Args:
+            server (AsyncServer): the server
+        """
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle(data, addr)
+
+    def error_received(self, exc):
+        pass
+
+
+class AsyncServer:
+    """A recursive DNS server on asyncio"""
+
+    def __init__(self, port, timeout=5, reuse_port=False):
+        """Initialize the server
+
+        Args:
+            port (int): port that server is listening on
+            timeout (float): timeout for upstream queries
+            reuse_port (bool): whether to set SO_REUSEPORT, so several
+                processes can serve the same port
+        """
+        self.port = port
+        self.timeout = timeout
+        self.reuse_port = reuse_port
+        self.transport = None
+        self.resolver = None
+        self.loop = None
+        self.done = None
+        self.tasks = set()
+        self.inline = 0
+        self.resolved = 0
+        self.failed = 0
+
+    async def serve(self):
+        """Serve requests until the server is shut down"""
+        self.loop = asyncio.get_running_loop()
+        self.done = asyncio.Event()
+        self.resolver = AsyncResolver(
+            self.timeout, Server.cache, stagger_delay=Server.stagger_delay,
+            fanout=Server.fanout, infra=Server.infra,
+            max_queries=Server.max_queries, time_limit=Server.time_limit,
+            tcp=Server.tcp,
+        )
+        await self.resolver.open()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self), local_addr=("127.0.0.1", self.port),
+            reuse_port=self.reuse_port or None,
+        )
+        try:
+            await self.done.wait()
+        finally:
+            self.transport.close()
+            for task in list(self.tasks):
+                task.cancel()
+            self.resolver.close()
+
+    def shutdown(self):
+        """Shut the server down, may be called from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.done.set)
+
+    def handle(self, data, addr):
+        """Handle a request
+
+        Answers from the zones and the cache are sent right away, other
+        questions are resolved in a new task.
+
+        Args:
+            data (bytes): the request
+            addr ((str, int)): address of the client
+        """
+        try:
+            message = Message.from_bytes(data)
+            question = message.questions[0]
+        except (ValueError, IndexError):
+            message = Message(Header(0, 0, 0, 0, 0, 0))
+            self.respond(message, addr, [], False, 1)  # FORMERR
+            return
+        authoritative, records = RequestHandler.answer_from_zone(question)
+        if records is None and message.header.rd:
+            records = self.lookup_cache(question)
+            if records is None:
+                task = self.loop.create_task(self.resolve(message, addr))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                return
+        self.inline += 1
+        if records is None:
+            records = []
+        self.respond(message, addr, records, authoritative)
+
+    def lookup_cache(self, question):
+        """Get a complete answer to a question from the cache
+
+        Args:
+            question (Question): the question
+
+        Returns:
+            [ResourceRecord]: the answer, or None if it is not cached or the
+                cached CNAME chain has to be followed further
+        """
+        records = self.resolver.lookup_cache(
+            question.qname, question.qtype, question.qclass
+        )
+        if (
+                records and
+                question.qtype not in (Type.CNAME, Type.ANY) and
+                Resolver.canonical_name(question.qname, records) is not None
+        ):
+            return None
+        return records
+
+    async def resolve(self, message, addr):
+        """Resolve a question and send the response
+
+        Args:
+            message (Message): the request
+            addr ((str, int)): address of the client
+        """
+        question = message.questions[0]
+        try:
+            records = await self.resolver.query_recursive(
+                question.qname, type_=question.qtype, class_=question.qclass
+            )
+        except OSError:
+            self.failed += 1
+            self.respond(message, addr, [], False, 2)  # SERVFAIL
+            return
+        self.resolved += 1
+        self.respond(message, addr, records, False)
+
+    def respond(self, message, addr, records, authoritative, error=0):
+        """Send the response to a request"""
+        response = RequestHandler.make_response(
+            message, records, authoritative, error
+        )
+        self.transport.sendto(response.to_bytes(), addr)
+
+    def stats(self):
+        """Get the request counters
+
+        Returns:
+            dict: requests answered inline, after resolution and with a
+                server failure
+        """
+        return {
+            "inline": self.inline,
+            "resolved": self.resolved,
+            "failed": self.failed,
+        }
@@ -2,31 +2,624 @@
 
 """A cache for resource records
 
-This module contains a class which implements a cache for DNS resource records,
-you still have to do most of the implementation. The module also provides a
-class and a function for converting ResourceRecords from and to JSON strings.
-It is highly recommended to use these.
+This module contains a class which implements a cache for DNS resource records.
+The module also provides functions for converting cached records from and to
+the binary format of the cache file, and a thread which periodically writes
+the changes to the cache to a journal next to the cache file, and a table
+in shared memory through which the caches of several processes can share
+their records.
+
+The cache file starts with a header containing a magic string and a version
+number, followed by the records. Every record consists of its name in wire
+format, a fixed-size part (type, class, TTL, time added, kind and rdata
+length) and its rdata in wire format. The kind is 0 for a record and the RCODE
+plus one for a negative entry. The journal has the same header, followed by
+records which are each prefixed with an operation byte.
 """
 
 
-import json
+import hashlib
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
 import time
+from collections import OrderedDict, deque
+
+from dns.classes import Class
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.resource import ResourceRecord, CacheRecord, GenericRecordData, \
+    RecordData
+from dns.types import Type
+
+
+CACHE_MAGIC = b"DNSC"
+CACHE_VERSION = 1
+_HEADER = struct.Struct("!4sH")
+_RECORD = struct.Struct("!HHiQBH")
+JOURNAL_ADD = 1
+JOURNAL_DEL = 2
+STALE_TTL = 30
+
+
+def pack_record(record):
+    """Convert a cached record to the binary cache file format
+
+    Args:
+        record (CacheRecord): the record
+
+    Returns:
+        bytes: the packed record
+    """
+    if isinstance(record, NegativeRecord):
+        kind, rdata = record.rcode + 1, b""
+    else:
+        kind, rdata = 0, record.rdata.to_bytes(0, None)
+    return (
+        record.name.to_bytes(0) +
+        _RECORD.pack(record.type_, record.class_, record.ttl, record.added,
+                     kind, len(rdata)) +
+        rdata
+    )
+
+
+def unpack_records(buf, offset, now=None):
+    """Lazily read records in the binary cache file format
+
+    The records are decoded one by one while iterating. The rdata of
+    records which have expired is skipped without being decoded.
+
+    Args:
+        buf (bytes): buffer (or mmap) containing the records
+        offset (int): offset of the first record
+        now (float): the current time, defaults to time.time()
+
+    Yields:
+        CacheRecord: the unexpired records
+    """
+    if now is None:
+        now = time.time()
+    while offset < len(buf):
+        record, offset = _unpack_record(buf, offset, now)
+        if record is not None:
+            yield record
+
+
+def unpack_journal(buf, offset, now=None):
+    """Lazily read the entries of a cache journal
+
+    Every entry is an operation (JOURNAL_ADD or JOURNAL_DEL) followed by a
+    record in the binary cache file format. Additions of records which have
+    expired are skipped.
+
+    Args:
+        buf (bytes): buffer (or mmap) containing the entries
+        offset (int): offset of the first entry
+        now (float): the current time, defaults to time.time()
+
+    Yields:
+        (int, CacheRecord): the operations and their records
+    """
+    if now is None:
+        now = time.time()
+    while offset < len(buf):
+        operation = buf[offset]
+        record, offset = _unpack_record(
+            buf, offset + 1, None if operation == JOURNAL_DEL else now
+        )
+        if record is not None:
+            yield operation, record
+
+
+def _unpack_record(buf, offset, now):
+    """Read a record in the binary cache file format
+
+    Args:
+        buf (bytes): buffer (or mmap) containing the record
+        offset (int): offset of the record
+        now (float): the current time, or None to decode expired records
+
+    Returns:
+        (CacheRecord, int): the record, or None if it has expired, and the
+            offset of the next record
+
+    Raises:
+        ValueError: if the record is truncated or malformed
+        IndexError: if the name of the record is truncated
+        struct.error: if the fields of the record are truncated
+    """
+    name, offset = Name.from_bytes(buf, offset)
+    type_, class_, ttl, added, kind, rdlength = _RECORD.unpack_from(
+        buf, offset
+    )
+    offset += _RECORD.size
+    if offset + rdlength > len(buf):
+        raise ValueError("truncated record")
+    if now is not None and now - added > ttl:
+        return None, offset + rdlength
+    if kind:
+        record = NegativeRecord(name, Type(type_), Class(class_), ttl,
+                                RCode(kind - 1), added)
+    else:
+        rdata = RecordData.create_from_bytes(
+            Type(type_), buf, offset, rdlength
+        )
+        record = CacheRecord(
+            ResourceRecord(name, Type(type_), Class(class_), ttl, rdata),
+            added,
+        )
+    return record, offset + rdlength
+
+
+class NegativeRecord(CacheRecord):
+    """A cached negative answer
+
+    See RFC 2308. A name error (NXDOMAIN) is cached with type ANY, since it
+    applies to every type of the name. A NODATA answer is cached with the
+    type of the question.
+    """
+
+    def __init__(self, name, type_, class_, ttl, rcode, added):
+        """Create a new negative cache entry
+
+        Args:
+            name (Name): domain name.
+            type_ (Type): the type, ANY for a name error.
+            class_ (Class): the class.
+            ttl (int): time to live.
+            rcode (RCode): NXDomain or NoError (NODATA).
+            added (float): time at which the entry was added.
+        """
+        super(NegativeRecord, self).__init__(
+            ResourceRecord(name, type_, class_, ttl, GenericRecordData(b"")),
+            added,
+        )
+        self.rcode = rcode
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, NegativeRecord) and
+            self.name == other.name and
+            self.type_ is other.type_ and
+            self.class_ is other.class_
+        )
+
+    def __hash__(self):
+        return ResourceRecord.__hash__(self)
 
-from dns.resource import ResourceRecord, CacheRecord
+
+class LRUPolicy:
+    """Least recently used eviction policy
+
+    Eviction policies keep track of the keys in a RecordCache and decide which
+    RRset is evicted when the cache is full.
+    """
+
+    def __init__(self):
+        """Initialize the policy"""
+        self.keys = OrderedDict()
+
+    def insert(self, key):
+        """Start tracking a key"""
+        self.keys[key] = None
+
+    def touch(self, key):
+        """Register a hit on a key"""
+        self.keys.move_to_end(key)
+
+    def remove(self, key):
+        """Stop tracking a key"""
+        del self.keys[key]
+
+    def victim(self):
+        """Return the key that should be evicted next"""
+        return next(iter(self.keys))
+
+
+class LFUPolicy:
+    """Least frequently used eviction policy
+
+    Keys are kept in buckets by hit count, so every operation is O(1). Ties
+    are broken by evicting the least recently used key.
+    """
+
+    def __init__(self):
+        """Initialize the policy"""
+        self.counts = {}
+        self.buckets = {}
+        self.min_count = 0
+
+    def insert(self, key):
+        """Start tracking a key"""
+        self.counts[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_count = 1
+
+    def touch(self, key):
+        """Register a hit on a key"""
+        count = self.counts[key]
+        self._unlink(key, count)
+        self.counts[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[key] = None
+        if self.min_count == count and count not in self.buckets:
+            self.min_count = count + 1
+
+    def remove(self, key):
+        """Stop tracking a key"""
+        self._unlink(key, self.counts.pop(key))
+
+    def victim(self):
+        """Return the key that should be evicted next"""
+        if self.min_count not in self.buckets:
+            self.min_count = min(self.buckets)
+        return next(iter(self.buckets[self.min_count]))
+
+    def _unlink(self, key, count):
+        """Remove a key from the bucket for its count"""
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+
+POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+}
+
+
+class CacheSegment:
+    """A segment of a RecordCache
+
+    Each segment owns part of the key space together with its own lock,
+    expiry heap and eviction policy, so threads working on different
+    segments never contend.
+
+    RRsets are stored as tuples which are replaced as a whole by writers.
+    Readers therefore never take the lock: they look up a consistent RRset
+    and append the hit or miss to a buffer, which is applied to the policy
+    and counters by the next thread that holds the lock.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, policy="lru"):
+        """Initialize the segment
+
+        Args:
+            max_entries (int): maximum number of cached records (if > 0)
+            max_bytes (int): maximum size of cached records (if > 0)
+            policy (str): eviction policy, one of POLICIES
+        """
+        self.lock = threading.Lock()
+        self.records = {}
+        self.expiry = []
+        self.counter = itertools.count()
+        self.reads = deque()
+        self.journal = None
+        self.popularity = {}
+        self.max_stale = 0
+        self.size = 0
+        self.nbytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = POLICIES[policy]()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _record_size(record):
+        """Size of a record in wire format, without name compression"""
+        return len(record.to_bytes(0, None))
+
+    def lookup(self, key, now):
+        """Lookup the unexpired records for a key, without locking
+
+        If there are no records for the key, a cached name error for the
+        name is looked up instead.
+
+        Args:
+            key (tuple): the index key
+            now (float): the current time
+
+        Returns:
+            [CacheRecord]: the matching records, an empty list if the records
+                are known not to exist, or None if there are none
+        """
+        rrset = self._fresh(key, now)
+        if not rrset:
+            nxdomain = (key[0], Type.ANY, key[2])
+            rrset = [
+                record for record in self._fresh(nxdomain, now)
+                if isinstance(record, NegativeRecord)
+            ]
+        self.reads.append((key, bool(rrset)))
+        if self.lock.acquire(blocking=False):
+            try:
+                self._drain_reads()
+            finally:
+                self.lock.release()
+        if not rrset:
+            return None
+        return [
+            record for record in rrset
+            if not isinstance(record, NegativeRecord)
+        ]
+
+    def lookup_stale(self, key, now):
+        """Lookup the expired records for a key, without locking
+
+        Args:
+            key (tuple): the index key
+            now (float): the current time
+
+        Returns:
+            [CacheRecord]: records which expired at most max_stale seconds
+                ago
+        """
+        return [
+            record for record in self.records.get(key, ())
+            if not isinstance(record, NegativeRecord) and
+            record.ttl < now - record.added <= record.ttl + self.max_stale
+        ]
+
+    def _fresh(self, key, now):
+        """Get the unexpired records for a key, without locking"""
+        return [
+            record for record in self.records.get(key, ())
+            if now - record.added <= record.ttl
+        ]
+
+    def _drain_reads(self):
+        """Apply buffered reads to the counters and policy
+
+        The caller must hold the lock.
+        """
+        while self.reads:
+            key, hit = self.reads.popleft()
+            if not hit:
+                self.misses += 1
+                continue
+            self.hits += 1
+            if key in self.records:
+                self.policy.touch(key)
+                self.popularity[key] = self.popularity.get(key, 0) + 1
+
+    def add(self, key, record):
+        """Add a record to the segment, replacing an equal record
+
+        Args:
+            key (tuple): the index key
+            record (CacheRecord): the record
+        """
+        with self.lock:
+            self._drain_reads()
+            if key not in self.records:
+                self.records[key] = ()
+                self.policy.insert(key)
+            negative = isinstance(record, NegativeRecord)
+            replaced = [
+                cached for cached in self.records[key]
+                if cached == record or
+                isinstance(cached, NegativeRecord) is not negative
+            ]
+            if not negative:
+                nxdomain = (key[0], Type.ANY, key[2])
+                for cached in self.records.get(nxdomain, ()):
+                    if isinstance(cached, NegativeRecord):
+                        self._remove(nxdomain, cached)
+            self.records[key] += (record,)
+            self.size += 1
+            self.nbytes += CacheSegment._record_size(record)
+            for cached in replaced:
+                self._remove(key, cached)
+            expires = record.added + record.ttl + self.max_stale
+            heapq.heappush(
+                self.expiry, (expires, next(self.counter), key, record)
+            )
+            if self.journal is not None:
+                self.journal.append((JOURNAL_ADD, record))
+            self._evict_expired(time.time())
+            self._evict_overflow()
+            if len(self.expiry) > 2 * self.size + 64:
+                self._rebuild_expiry()
+
+    def discard(self, key, record):
+        """Remove the cached records equal to a record
+
+        Args:
+            key (tuple): the index key
+            record (CacheRecord): the record
+        """
+        with self.lock:
+            for cached in self.records.get(key, ()):
+                if cached == record:
+                    self._remove(key, cached)
+
+    def _remove(self, key, record):
+        """Remove a cached record from its RRset
+
+        The caller must hold the lock.
+
+        Args:
+            key (tuple): the index key of the record
+            record (CacheRecord): the record to remove
+        """
+        rrset = self.records.get(key, ())
+        if not any(cached is record for cached in rrset):
+            return
+        rrset = tuple(cached for cached in rrset if cached is not record)
+        self.size -= 1
+        self.nbytes -= CacheSegment._record_size(record)
+        if rrset:
+            self.records[key] = rrset
+        else:
+            del self.records[key]
+            self.policy.remove(key)
+            self.popularity.pop(key, None)
+
+    def _over_capacity(self):
+        """Check whether the segment exceeds one of its limits"""
+        return (
+            (self.max_entries and self.size > self.max_entries) or
+            (self.max_bytes and self.nbytes > self.max_bytes)
+        )
+
+    def _evict_overflow(self):
+        """Evict RRsets chosen by the policy until the segment fits"""
+        while self.records and self._over_capacity():
+            key = self.policy.victim()
+            for record in self.records[key]:
+                self._remove(key, record)
+                self.evictions += 1
+                if self.journal is not None:
+                    self.journal.append((JOURNAL_DEL, record))
+
+    def _rebuild_expiry(self):
+        """Drop heap entries of records which are no longer cached"""
+        self.expiry = [
+            (expires, seq, key, record)
+            for expires, seq, key, record in self.expiry
+            if any(cached is record for cached in self.records.get(key, ()))
+        ]
+        heapq.heapify(self.expiry)
+
+    def _evict_expired(self, now):
+        """Pop expired records from the expiry heap
+
+        The caller must hold the lock.
+        """
+        while self.expiry and self.expiry[0][0] < now:
+            _, _, key, record = heapq.heappop(self.expiry)
+            if any(cached is record for cached in self.records.get(key, ())):
+                self._remove(key, record)
+                self.expirations += 1
+
+    def evict_expired(self, now):
+        """Remove all expired records from the segment"""
+        with self.lock:
+            self._evict_expired(now)
+
+    def stats(self):
+        """Get the segment counters"""
+        with self.lock:
+            self._drain_reads()
+            return {
+                "entries": self.size,
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def all_records(self):
+        """Get a snapshot of all records in the segment"""
+        with self.lock:
+            return [
+                record
+                for rrset in self.records.values()
+                for record in rrset
+            ]
 
 
 class RecordCache:
-    """Cache for ResourceRecords"""
+    """Cache for ResourceRecords
 
-    def __init__(self, ttl):
+    Records are indexed by (lowercased name, type, class), so a lookup only
+    has to look at the RRset it is interested in. Expired records are evicted
+    in order of expiry using a min-heap, lazily when records are added or
+    explicitly by calling evict_expired.
+
+    The cache can be limited to a maximum number of records and a maximum
+    number of bytes (measured in wire format). When either limit is exceeded,
+    whole RRsets are evicted as chosen by the eviction policy.
+
+    The key space is sharded over a number of CacheSegments with their own
+    locks, so the cache can be shared by the threads of the server. The
+    limits are divided over the segments, the first segments getting one
+    more than the others if a limit is not a multiple of the number of
+    segments, so the limits of the segments add up to those of the cache.
+    A segment may fill up while others have room, so the cache can evict
+    before it reaches its limits, but it never exceeds them.
+    """
+
+    def __init__(self, ttl, max_entries=0, max_bytes=0, policy="lru",
+                 segments=1):
         """Initialize the RecordCache
 
         Args:
             ttl (int): TTL of cached entries (if > 0)
+            max_entries (int): maximum number of cached records (if > 0),
+                at least segments
+            max_bytes (int): maximum size of cached records (if > 0), at
+                least segments
+            policy (str): eviction policy, one of POLICIES
+            segments (int): number of lock-striped segments
         """
         assert ttl >= 0, "TTL must be >= 0"
-        self.records = set()
+        assert max_entries >= 0, "max_entries must be >= 0"
+        assert max_bytes >= 0, "max_bytes must be >= 0"
+        assert segments >= 1, "segments must be >= 1"
+        # a segment with a limit of 0 would be unlimited
+        assert max_entries == 0 or max_entries >= segments, \
+            "max_entries must be >= segments"
+        assert max_bytes == 0 or max_bytes >= segments, \
+            "max_bytes must be >= segments"
         self.ttl = ttl
+        self.prefetch = None
+        self.prefetch_hits = 0
+        self.prefetch_fraction = 0
+        self.stale_refresh = None
+        self.shared = None
+        self.segments = [
+            CacheSegment(
+                max_entries // segments + (i < max_entries % segments),
+                max_bytes // segments + (i < max_bytes % segments),
+                policy,
+            )
+            for i in range(segments)
+        ]
+
+    @staticmethod
+    def _key(dname, type_, class_):
+        """Create the index key for a domain name, type and class"""
+        return str(dname).lower(), type_, class_
+
+    def _segment(self, key):
+        """Get the segment responsible for a key
+
+        All keys of a domain name are stored in the same segment, so a name
+        error can be found in the segment of every type.
+        """
+        return self.segments[hash(key[0]) % len(self.segments)]
+
+    @property
+    def size(self):
+        """Number of cached records"""
+        return sum(segment.size for segment in self.segments)
+
+    @property
+    def nbytes(self):
+        """Size of the cached records in bytes"""
+        return sum(segment.nbytes for segment in self.segments)
+
+    def stats(self):
+        """Get the cache counters
+
+        Returns:
+            dict: sizes, hits, misses, evictions and expirations
+        """
+        total = {}
+        for segment in self.segments:
+            for name, value in segment.stats().items():
+                total[name] = total.get(name, 0) + value
+        return total
 
     def lookup(self, dname, type_, class_):
         """Lookup resource records in cache
@@ -38,33 +631,155 @@ class RecordCache:
             dname (Name): domain name
             type_ (Type): type
             class_ (Class): class
+
+        Returns:
+            [CacheRecord]: the matching records, or None if there are none
+        """
+        key = RecordCache._key(dname, type_, class_)
+        segment = self._segment(key)
+        now = time.time()
+        rrset = segment.lookup(key, now)
+        if (
+                rrset is None and self.shared is not None and
+                self._lookup_shared(key, segment, now)
+        ):
+            rrset = segment.lookup(key, now)
+        if (
+                self.prefetch is not None and rrset and
+                segment.popularity.get(key, 0) >= self.prefetch_hits and
+                any(
+                    record.added + record.ttl - now <
+                    self.prefetch_fraction * record.ttl
+                    for record in rrset
+                )
+        ):
+            self.prefetch(dname, type_, class_)
+        return rrset
+
+    def enable_prefetch(self, prefetch, hits=3, fraction=0.1):
+        """Refresh popular records before they expire
+
+        When a lookup hits an RRset which has been hit at least hits times
+        before and of which a record has less than fraction of its TTL left,
+        prefetch is called with the domain name, type and class. It should
+        refresh the records asynchronously.
+
+        Args:
+            prefetch (callable): called as prefetch(dname, type_, class_)
+            hits (int): minimum number of earlier hits
+            fraction (float): fraction of the TTL
         """
-        to_remove = set()
-        return_record = None
-        for record in self.records:
-            if time.time() - record.added > record.ttl:
-                to_remove.add(record)
-            if (
-                    record.name == dname and
-                    record.type_ is type_ and
-                    record.class_ is class_
-            ):
-                if time.time() - record.added <= record.ttl:
-                    return_record = record
-        self.records.difference_update(to_remove)
-        return return_record
+        self.prefetch = prefetch
+        self.prefetch_hits = hits
+        self.prefetch_fraction = fraction
+
+    def enable_serve_stale(self, max_stale, refresh=None):
+        """Keep expired records around to answer when upstream fails
+
+        See RFC 8767. Records are only evicted max_stale seconds after they
+        expire, and can be retrieved with lookup_stale. This should be
+        called before records are added.
+
+        Args:
+            max_stale (int): maximum staleness in seconds
+            refresh (callable): called as refresh(dname, type_, class_) when
+                stale records are served, should refresh the records
+                asynchronously
+        """
+        for segment in self.segments:
+            segment.max_stale = max_stale
+        self.stale_refresh = refresh
+
+    def lookup_stale(self, dname, type_, class_, trigger_refresh=True):
+        """Lookup expired resource records in cache
+
+        Args:
+            dname (Name): domain name
+            type_ (Type): type
+            class_ (Class): class
+            trigger_refresh (bool): whether to start refreshing the records
+                if there are any
+
+        Returns:
+            [ResourceRecord]: copies of the stale records with a TTL of
+                STALE_TTL, or None if there are none
+        """
+        key = RecordCache._key(dname, type_, class_)
+        rrset = self._segment(key).lookup_stale(key, time.time())
+        if not rrset:
+            return None
+        if trigger_refresh and self.stale_refresh is not None:
+            self.stale_refresh(dname, type_, class_)
+        return [
+            ResourceRecord(record.name, record.type_, record.class_,
+                           STALE_TTL, record.rdata)
+            for record in rrset
+        ]
 
     def add_record(self, record):
         """Add a new Record to the cache
 
+        An equal record which is already cached is replaced.
+
         Args:
             record (ResourceRecord): the record added to the cache
         """
         record.ttl = self.ttl or record.ttl
-        if isinstance(record, CacheRecord):
-            self.records.add(record)
-        else:
-            self.records.add(CacheRecord(record, time.time()))
+        if not isinstance(record, CacheRecord):
+            record = CacheRecord(record, time.time())
+        self._insert(record)
+
+    def add_negative(self, dname, type_, class_, ttl, rcode):
+        """Cache a negative answer
+
+        Args:
+            dname (Name): domain name
+            type_ (Type): type of the question
+            class_ (Class): class of the question
+            ttl (int): negative TTL, from the SOA record in the authority
+                section
+            rcode (RCode): NXDomain for a name error, NoError for NODATA
+        """
+        if rcode == RCode.NXDomain:
+            type_ = Type.ANY
+        self._insert(
+            NegativeRecord(dname, type_, class_, ttl, rcode, time.time())
+        )
+
+    def _insert(self, record):
+        """Insert a CacheRecord into its segment"""
+        key = RecordCache._key(record.name, record.type_, record.class_)
+        segment = self._segment(key)
+        segment.add(key, record)
+        if self.shared is not None:
+            self.shared.put(key, segment._fresh(key, time.time()))
+
+    def enable_shared(self, shared):
+        """Share records with the caches of other processes
+
+        Records added to the cache are also written to the shared table,
+        and lookups which miss are retried in the shared table.
+
+        Args:
+            shared (SharedCache): the shared table
+        """
+        self.shared = shared
+
+    def _lookup_shared(self, key, segment, now):
+        """Copy the records for a key from the shared table into a segment
+
+        Returns:
+            bool: whether records were found
+        """
+        records = self.shared.get(key, now)
+        if key[1] is not Type.ANY:
+            records += self.shared.get((key[0], Type.ANY, key[2]), now)
+        for record in records:
+            segment.add(
+                RecordCache._key(record.name, record.type_, record.class_),
+                record,
+            )
+        return bool(records)
 
     def add_records(self, records):
         """ Add new Records to the cache
@@ -75,21 +790,479 @@ class RecordCache:
         for record in records:
             self.add_record(record)
 
-    def read_cache_file(self):
-        """Read the cache file from disk"""
-        records = []
+    def evict_expired(self, now=None):
+        """Remove all expired records from the cache
+
+        Only the records which have expired are popped from the expiry heaps,
+        so this takes O(log n) time per evicted record.
+
+        Args:
+            now (float): the current time, defaults to time.time()
+        """
+        if now is None:
+            now = time.time()
+        for segment in self.segments:
+            segment.evict_expired(now)
+
+    def all_records(self):
+        """Get a snapshot of all cached records
+
+        Returns:
+            [CacheRecord]: the records
+        """
+        return [
+            record
+            for segment in self.segments
+            for record in segment.all_records()
+        ]
+
+    def enable_journal(self):
+        """Start recording changes to the cache
+
+        Additions and evictions are appended to a deque, which is shared by
+        all segments and drained by a CacheCheckpointer.
+
+        Returns:
+            deque: the journal
+        """
+        journal = deque()
+        for segment in self.segments:
+            segment.journal = journal
+        return journal
+
+    def read_cache_file(self, filename="cache"):
+        """Read the cache file from disk
+
+        The file is memory-mapped and records are decoded while they are
+        added, skipping the rdata of expired records.
+
+        Args:
+            filename (str): the name of the cache file
+        """
         try:
-            with open("cache", "r") as file_:
-                records = json.load(file_)
-        except:
+            with open(filename, "rb") as file_:
+                buf = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+            with buf:
+                magic, version = _HEADER.unpack_from(buf)
+                if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                    raise ValueError("unsupported cache file")
+                for record in unpack_records(buf, _HEADER.size):
+                    self._insert(record)
+        except (OSError, ValueError, IndexError, struct.error):
             print("could not read cache")
-        self.add_records(CacheRecord.from_dict(dct) for dct in records)
 
-    def write_cache_file(self):
-        """Write the cache file to disk"""
-        dcts = [record.to_dict() for record in self.records]
+    def read_journal(self, filename="cache.log"):
+        """Replay the journal written by a CacheCheckpointer
+
+        Args:
+            filename (str): the name of the journal
+        """
+        try:
+            with open(filename, "rb") as file_:
+                buf = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+            with buf:
+                magic, version = _HEADER.unpack_from(buf)
+                if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                    raise ValueError("unsupported journal")
+                for operation, record in unpack_journal(buf, _HEADER.size):
+                    key = RecordCache._key(
+                        record.name, record.type_, record.class_
+                    )
+                    if operation == JOURNAL_ADD:
+                        self._segment(key).add(key, record)
+                    else:
+                        self._segment(key).discard(key, record)
+        except (OSError, ValueError, IndexError, struct.error):
+            print("could not read cache journal")
+
+    def write_cache_file(self, filename="cache"):
+        """Write the cache file to disk
+
+        The cache is written to a temporary file which then replaces the
+        cache file, so the cache file is never left half-written.
+
+        Args:
+            filename (str): the name of the cache file
+
+        Returns:
+            bool: whether the cache file was written
+        """
+        tmpname = filename + ".tmp"
         try:
-            with open("cache", "w") as file_:
-                json.dump(dcts, file_, indent=2)
-        except:
+            with open(tmpname, "wb") as file_:
+                file_.write(_HEADER.pack(CACHE_MAGIC, CACHE_VERSION))
+                for record in self.all_records():
+                    file_.write(pack_record(record))
+                file_.flush()
+                os.fsync(file_.fileno())
+            os.replace(tmpname, filename)
+        except OSError:
             print("could not write cache")
+            return False
+        return True
+
+
+class SharedCache:
+    """A table of RRsets in memory shared between processes
+
+    The table has a fixed number of slots of a fixed size. An RRset is
+    stored in the binary cache file format in the slot chosen by the hash
+    of its key, replacing whatever was stored there. RRsets which do not
+    fit in a slot are not shared. The table has to be created before the
+    processes sharing it are forked.
+
+    A worker can be killed at any time, also while it holds a lock, so no
+    process ever waits for a lock indefinitely. Every slot has a sequence
+    number, which is odd while the slot is written (a seqlock). Readers
+    take no lock: they retry while the slot is written and treat a slot
+    which stays torn as a miss. Writers take the lock of the stripe of the
+    slot with a timeout, and skip the write if it runs out. A writer records
+    its process ID and slot next to the lock, so when it dies, recover
+    clears the torn slot and releases the lock.
+    """
+
+    _SEQ = struct.Struct("!Q")
+    _SLOT = struct.Struct("!QQdH")
+    _OWNER = struct.Struct("!qQ")
+
+    def __init__(self, slots=65536, slot_size=512, locks=64,
+                 lock_timeout=0.05, retries=8):
+        """Create the table
+
+        Args:
+            slots (int): number of slots
+            slot_size (int): size of a slot in bytes
+            locks (int): number of locks, each guarding a stripe of slots
+            lock_timeout (float): seconds a writer waits for a lock
+            retries (int): number of reads of a slot which is being written
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        # the owners of the locks are stored after the slots
+        self.owners = slots * slot_size
+        self.memory = mmap.mmap(
+            -1, self.owners + locks * SharedCache._OWNER.size
+        )
+        self.locks = [multiprocessing.Lock() for _ in range(locks)]
+        self.lock_timeout = lock_timeout
+        self.retries = retries
+
+    @staticmethod
+    def _hash(key):
+        """Hash a key the same way in every process"""
+        data = "{} {} {}".format(key[0], int(key[1]), int(key[2]))
+        digest = hashlib.blake2b(data.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") or 1
+
+    def get(self, key, now=None):
+        """Get the unexpired records for a key
+
+        Args:
+            key (tuple): the index key
+            now (float): the current time, defaults to time.time()
+
+        Returns:
+            [CacheRecord]: the records, empty if there are none or the slot
+                is being written
+        """
+        if now is None:
+            now = time.time()
+        hash_ = SharedCache._hash(key)
+        offset = hash_ % self.slots * self.slot_size
+        for _ in range(self.retries):
+            seq, stored, expires, length = SharedCache._SLOT.unpack_from(
+                self.memory, offset
+            )
+            if seq % 2:
+                time.sleep(0)
+                continue
+            if stored != hash_ or expires < now:
+                return []
+            start = offset + SharedCache._SLOT.size
+            length = min(length, self.slot_size - SharedCache._SLOT.size)
+            data = self.memory[start:start + length]
+            if SharedCache._SEQ.unpack_from(self.memory, offset)[0] == seq:
+                break
+        else:
+            return []
+        return [
+            record for record in unpack_records(data, 0, now)
+            if RecordCache._key(record.name, record.type_,
+                                record.class_) == key
+        ]
+
+    def put(self, key, records):
+        """Store the records for a key
+
+        Args:
+            key (tuple): the index key
+            records ([CacheRecord]): the records
+        """
+        if not records:
+            return
+        data = b"".join(pack_record(record) for record in records)
+        if SharedCache._SLOT.size + len(data) > self.slot_size:
+            return
+        hash_ = SharedCache._hash(key)
+        slot = hash_ % self.slots
+        offset = slot * self.slot_size
+        expires = min(record.added + record.ttl for record in records)
+        stripe = slot % len(self.locks)
+        owner = self.owners + stripe * SharedCache._OWNER.size
+        lock = self.locks[stripe]
+        if not lock.acquire(timeout=self.lock_timeout):
+            return  # the holder died and has not been recovered yet
+        try:
+            SharedCache._OWNER.pack_into(
+                self.memory, owner, os.getpid(), slot
+            )
+            seq = SharedCache._SEQ.unpack_from(self.memory, offset)[0] + 1
+            SharedCache._SEQ.pack_into(self.memory, offset, seq)
+            SharedCache._SLOT.pack_into(
+                self.memory, offset, seq, hash_, expires, len(data)
+            )
+            start = offset + SharedCache._SLOT.size
+            self.memory[start:start + len(data)] = data
+            SharedCache._SEQ.pack_into(self.memory, offset, seq + 1)
+        finally:
+            SharedCache._OWNER.pack_into(self.memory, owner, 0, 0)
+            lock.release()
+
+    def recover(self, pid):
+        """Release the locks held by a process which died
+
+        The slot the process was writing is cleared, so it is a miss until
+        it is written again. Must only be called once the process is gone.
+
+        Args:
+            pid (int): ID of the process
+
+        Returns:
+            int: number of locks released
+        """
+        released = 0
+        for stripe, lock in enumerate(self.locks):
+            owner = self.owners + stripe * SharedCache._OWNER.size
+            holder, slot = SharedCache._OWNER.unpack_from(self.memory, owner)
+            if holder != pid:
+                continue
+            offset = slot * self.slot_size
+            seq = SharedCache._SEQ.unpack_from(self.memory, offset)[0]
+            SharedCache._SLOT.pack_into(
+                self.memory, offset, seq + 2 - seq % 2, 0, 0, 0
+            )
+            SharedCache._OWNER.pack_into(self.memory, owner, 0, 0)
+            lock.release()
+            released += 1
+        return released
+
+    def close(self):
+        """Release the shared memory"""
+        self.memory.close()
+
+
+class CacheCheckpointer(threading.Thread):
+    """Thread which periodically persists the changes to a RecordCache
+
+    Every interval, the changes recorded in the journal of the cache are
+    appended to the journal file. Every compact_every checkpoints, a new
+    snapshot of the cache is written and the journal file is truncated.
+    Query handling only ever appends to the in-memory journal.
+    """
+
+    def __init__(self, cache, interval, filename="cache", compact_every=10):
+        """Initialize the checkpointer
+
+        Args:
+            cache (RecordCache): the cache
+            interval (float): seconds between checkpoints
+            filename (str): the name of the cache file, the journal is
+                written to filename + ".log"
+            compact_every (int): number of checkpoints between snapshots
+        """
+        super().__init__()
+        self.daemon = True
+        self.cache = cache
+        self.interval = interval
+        self.filename = filename
+        self.logname = filename + ".log"
+        self.compact_every = compact_every
+        self.journal = cache.enable_journal()
+        self.checkpoints = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Run the checkpointer thread"""
+        while not self.stopped.wait(self.interval):
+            self.checkpoint()
+
+    def stop(self):
+        """Stop the thread and write a final snapshot"""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.compact()
+
+    def checkpoint(self):
+        """Append the journal to the journal file, compacting if needed"""
+        self.checkpoints += 1
+        if self.checkpoints % self.compact_every == 0:
+            self.compact()
+            return
+        entries = []
+        while self.journal:
+            operation, record = self.journal.popleft()
+            entries.append(bytes([operation]) + pack_record(record))
+        if not entries:
+            return
+        try:
+            new = not os.path.exists(self.logname)
+            with open(self.logname, "ab") as file_:
+                if new:
+                    file_.write(_HEADER.pack(CACHE_MAGIC, CACHE_VERSION))
+                file_.write(b"".join(entries))
+                file_.flush()
+                os.fsync(file_.fileno())
+        except OSError:
+            print("could not write cache journal")
+
+    def compact(self):
+        """Write a snapshot of the cache and start a new journal
+
+        Changes made while the snapshot is written stay in the journal and
+        are written to the new journal file, replaying them is idempotent.
+        If the snapshot cannot be written, the journal is kept.
+        """
+        written = len(self.journal)
+        if not self.cache.write_cache_file(self.filename):
+            return
+        for _ in range(written):
+            self.journal.popleft()
+        try:
+            os.remove(self.logname)
+        except FileNotFoundError:
+            pass
+
+
+class ServerInfo:
+    """What is known about the performance of a nameserver"""
+
+    def __init__(self):
+        """Initialize the info for a server that has not been queried"""
+        self.srtt = None
+        self.timeouts = 0
+        self.backoff_until = 0
+
+
+class InfrastructureCache:
+    """Cache of nameserver round-trip times
+
+    Keeps a smoothed round-trip time (SRTT) for every nameserver address,
+    together with the number of consecutive timeouts. A server which timed
+    out is backed off exponentially, during which it is only used when no
+    other server is available.
+    """
+
+    def __init__(self, alpha=0.3, unknown_rtt=0.4, backoff=1.0,
+                 max_backoff=60.0):
+        """Initialize the infrastructure cache
+
+        Args:
+            alpha (float): weight of a new sample in the SRTT
+            unknown_rtt (float): assumed RTT of servers without samples
+            backoff (float): backoff after the first timeout in seconds
+            max_backoff (float): maximum backoff in seconds
+        """
+        self.alpha = alpha
+        self.unknown_rtt = unknown_rtt
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.servers = {}
+
+    def record_rtt(self, ip, rtt):
+        """Record a response from a server
+
+        Args:
+            ip (str): address of the server
+            rtt (float): round-trip time in seconds
+        """
+        with self.lock:
+            info = self.servers.setdefault(ip, ServerInfo())
+            if info.srtt is None:
+                info.srtt = rtt
+            else:
+                info.srtt = (1 - self.alpha) * info.srtt + self.alpha * rtt
+            info.timeouts = 0
+            info.backoff_until = 0
+
+    def record_timeout(self, ip, timeout):
+        """Record a query to a server which timed out
+
+        Args:
+            ip (str): address of the server
+            timeout (float): the timeout of the query in seconds
+        """
+        with self.lock:
+            info = self.servers.setdefault(ip, ServerInfo())
+            info.timeouts += 1
+            info.srtt = max(info.srtt or 0, timeout)
+            info.backoff_until = time.monotonic() + min(
+                self.backoff * 2 ** (info.timeouts - 1), self.max_backoff
+            )
+
+    def record_unanswered(self, ip, elapsed):
+        """Record a query to a server which was abandoned unanswered
+
+        This happens when another server answered first. The server took
+        at least elapsed seconds, so its SRTT is raised to that if it is
+        lower.
+
+        Args:
+            ip (str): address of the server
+            elapsed (float): seconds since the query was sent
+        """
+        with self.lock:
+            info = self.servers.setdefault(ip, ServerInfo())
+            srtt = self.unknown_rtt if info.srtt is None else info.srtt
+            if elapsed > srtt:
+                info.srtt = elapsed
+
+    def sort(self, ips):
+        """Sort server addresses from most to least preferable
+
+        Servers which are backed off come last, the others are sorted by
+        SRTT.
+
+        Args:
+            ips ([str]): addresses of the servers
+
+        Returns:
+            [str]: the sorted addresses
+        """
+        now = time.monotonic()
+        with self.lock:
+            def preference(ip):
+                info = self.servers.get(ip)
+                if info is None:
+                    return False, self.unknown_rtt
+                srtt = self.unknown_rtt if info.srtt is None else info.srtt
+                return info.backoff_until > now, srtt
+            return sorted(ips, key=preference)
+
+    def get(self, ip):
+        """Get what is known about a server
+
+        Args:
+            ip (str): address of the server
+
+        Returns:
+            dict: SRTT, number of timeouts and whether it is backed off
+        """
+        with self.lock:
+            info = self.servers.get(ip, ServerInfo())
+            return {
+                "srtt": info.srtt,
+                "timeouts": info.timeouts,
+                "backed_off": info.backoff_until > time.monotonic(),
+            }
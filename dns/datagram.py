@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""Batched datagram I/O
+
+This module contains a wrapper around a UDP socket which receives and sends
+datagrams in batches. On Linux, recvmmsg and sendmmsg are called through
+ctypes, so one system call moves a whole batch of datagrams. Elsewhere the
+batch is drained with non-blocking recvfrom_into calls and replies are sent
+one by one, which still saves the wakeups of the receiving thread.
+
+Datagrams are received into buffers which are allocated once. A reply is
+sent as soon as it is ready, it never waits for other requests to be
+handled. Replies are coalesced without a sending thread: a thread which
+sends while another thread is already sending leaves its reply to that
+thread, which sends all replies queued in the meantime with one call.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import sys
+import threading
+from collections import deque
+
+
+MSG_WAITFORONE = 0x10000
+SOCKADDR_SIZE = 16
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _MsgHdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+def load_mmsg():
+    """Get recvmmsg and sendmmsg from the C library
+
+    Returns:
+        (function, function): recvmmsg and sendmmsg, or None if they are
+            not available
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    for function in (recvmmsg, sendmmsg):
+        function.restype = ctypes.c_int
+    recvmmsg.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+        ctypes.c_void_p,
+    ]
+    sendmmsg.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+    ]
+    return recvmmsg, sendmmsg
+
+
+class _Messages:
+    """Preallocated message headers, buffers and addresses for a batch
+
+    The buffers and addresses of all messages are stored in one block of
+    memory each. They, the lengths of the received datagrams and the
+    buffers of the replies are accessed through memoryviews and structs,
+    which is a lot faster than going through the ctypes fields.
+    """
+
+    def __init__(self, batch, size):
+        """Allocate the messages
+
+        Args:
+            batch (int): number of messages
+            size (int): size of the buffer of every message
+        """
+        self.size = size
+        self.headers = (_MMsgHdr * batch)()
+        self.iovecs = (_IOVec * batch)()
+        self.buffers = ctypes.create_string_buffer(batch * size)
+        self.names = ctypes.create_string_buffer(batch * SOCKADDR_SIZE)
+        self.address = ctypes.addressof(self.headers)
+        self.buffers_address = ctypes.addressof(self.buffers)
+        for i in range(batch):
+            self.iovecs[i].iov_base = self.buffers_address + i * size
+            self.iovecs[i].iov_len = size
+            header = self.headers[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.names) + i * SOCKADDR_SIZE
+            header.msg_namelen = SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+        self.buffers_view = memoryview(self.buffers).cast("B")
+        self.names_view = memoryview(self.names).cast("B")
+        self.headers_view = memoryview(self.headers).cast("B")
+        self.iovecs_view = memoryview(self.iovecs).cast("B")
+        offset = _MMsgHdr.msg_len.offset
+        self.lengths = struct.Struct("=" + "{}xI{}x".format(
+            offset, ctypes.sizeof(_MMsgHdr) - offset - 4
+        ) * batch)
+        self.keep = []
+
+    def datagrams(self, count, addresses):
+        """Get the received datagrams and their source addresses
+
+        The kernel writes back the length of the source address, which is
+        the same for every datagram on an IPv4 socket, so the messages can
+        be reused as they are.
+
+        Args:
+            count (int): number of received datagrams
+            addresses (dict): cache of parsed source addresses
+
+        Returns:
+            [(bytes, (str, int))]: the datagrams
+        """
+        size = self.size
+        lengths = self.lengths.unpack_from(self.headers_view)
+        buffers = self.buffers_view
+        names = self.names_view[:count * SOCKADDR_SIZE].tobytes()
+        datagrams = []
+        for i in range(count):
+            name = names[i * SOCKADDR_SIZE:(i + 1) * SOCKADDR_SIZE]
+            address = addresses.get(name)
+            if address is None:
+                address = (
+                    socket.inet_ntoa(name[4:8]),
+                    struct.unpack("!H", name[2:4])[0],
+                )
+                if len(addresses) < 4096:
+                    addresses[name] = address
+            start = i * size
+            datagrams.append(
+                (buffers[start:start + lengths[i]].tobytes(), address)
+            )
+        return datagrams
+
+    def set_replies(self, replies, sockaddrs):
+        """Copy replies and their destination addresses into the messages
+
+        Args:
+            replies ([(bytes, (str, int))]): the replies
+            sockaddrs (dict): cache of packed destination addresses
+        """
+        size = self.size
+        names = self.names_view
+        buffers = self.buffers_view
+        iovecs = []
+        self.keep = []
+        for i, (data, address) in enumerate(replies):
+            sockaddr = sockaddrs.get(address)
+            if sockaddr is None:
+                sockaddr = (
+                    struct.pack("=H", socket.AF_INET) +
+                    struct.pack("!H", address[1]) +
+                    socket.inet_aton(address[0]) + bytes(8)
+                )
+                if len(sockaddrs) < 4096:
+                    sockaddrs[address] = sockaddr
+            names[i * SOCKADDR_SIZE:(i + 1) * SOCKADDR_SIZE] = sockaddr
+            start = i * size
+            length = len(data)
+            if length <= size:
+                buffers[start:start + length] = data
+                iovecs += (self.buffers_address + start, length)
+            else:
+                # too large for the buffer, point at a copy of the reply
+                buffer = ctypes.create_string_buffer(data, len(data))
+                self.keep.append(buffer)
+                iovecs += (ctypes.addressof(buffer), len(data))
+        # the unused messages keep their iovecs
+        struct.pack_into("PN" * len(replies), self.iovecs_view, 0, *iovecs)
+
+
+class DatagramBatcher:
+    """Receives and sends datagrams on a UDP socket in batches
+
+    The socket has to be a blocking IPv4 socket. The batcher is used in
+    place of the socket by the request handlers: sendto sends a reply,
+    together with the other queued replies.
+    """
+
+    def __init__(self, sock, batch=32, size=1024, mmsg=True):
+        """Allocate the buffers
+
+        Args:
+            sock (socket): the socket
+            batch (int): maximum number of datagrams per system call
+            size (int): maximum size of a received datagram
+            mmsg (bool): whether to use recvmmsg and sendmmsg if available
+        """
+        self.sock = sock
+        self.batch = batch
+        self.size = size
+        self.mmsg = load_mmsg() if mmsg else None
+        if self.mmsg is not None:
+            self.received = _Messages(batch, size)
+            self.sending = _Messages(batch, size)
+            self.addresses = {}
+            self.sockaddrs = {}
+        else:
+            self.buffers = [bytearray(size) for _ in range(batch)]
+        self.dontwait = getattr(socket, "MSG_DONTWAIT", None)
+        self.replies = deque()
+        self.lock = threading.Lock()
+        self.receive_calls = 0
+        self.datagrams = 0
+        self.send_calls = 0
+        self.sent = 0
+
+    def receive(self):
+        """Wait for datagrams and receive all which are queued
+
+        Returns:
+            [(bytes, (str, int))]: the datagrams and their source addresses,
+                at most batch
+
+        Raises:
+            OSError: if receiving failed
+        """
+        if self.mmsg is not None:
+            datagrams = self.receive_mmsg()
+        else:
+            datagrams = self.receive_into()
+        self.datagrams += len(datagrams)
+        return datagrams
+
+    def receive_mmsg(self):
+        """Receive a batch with recvmmsg"""
+        while True:
+            self.receive_calls += 1
+            count = self.mmsg[0](
+                self.sock.fileno(), self.received.address, self.batch,
+                MSG_WAITFORONE, None,
+            )
+            if count >= 0:
+                return self.received.datagrams(count, self.addresses)
+            error = ctypes.get_errno()
+            if error != errno.EINTR:
+                raise OSError(error, os.strerror(error))
+
+    def receive_into(self):
+        """Receive a batch with recvfrom_into into the buffers"""
+        datagrams = []
+        flags = 0
+        for buffer in self.buffers:
+            try:
+                self.receive_calls += 1
+                length, address = self.sock.recvfrom_into(buffer, 0, flags)
+            except BlockingIOError:
+                break
+            datagrams.append((bytes(buffer[:length]), address))
+            if self.dontwait is None:
+                break
+            flags = self.dontwait
+        return datagrams
+
+    def sendto(self, data, address):
+        """Send a reply
+
+        The reply is only queued if another thread is sending, that
+        thread sends it before it stops.
+
+        Args:
+            data (bytes): the reply
+            address ((str, int)): address of the client
+        """
+        self.replies.append((data, address))
+        self.send_queued()
+
+    def send_queued(self):
+        """Send the queued replies unless another thread is sending"""
+        while self.replies and self.lock.acquire(blocking=False):
+            try:
+                self.flush()
+            finally:
+                self.lock.release()
+
+    def flush(self):
+        """Send the queued replies, the lock has to be held"""
+        while self.replies:
+            count = min(len(self.replies), self.batch)
+            replies = [self.replies.popleft() for _ in range(count)]
+            try:
+                if self.mmsg is not None:
+                    self.send_mmsg(replies)
+                else:
+                    for data, address in replies:
+                        self.send_calls += 1
+                        self.sock.sendto(data, address)
+                        self.sent += 1
+            except OSError as e:
+                if self.sock.fileno() == -1:
+                    self.replies.clear()
+                    return
+                print("could not send replies:", e)
+
+    def send_mmsg(self, replies):
+        """Send replies with sendmmsg"""
+        self.sending.set_replies(replies, self.sockaddrs)
+        first = 0
+        while first < len(replies):
+            self.send_calls += 1
+            count = self.mmsg[1](
+                self.sock.fileno(),
+                self.sending.address + first * ctypes.sizeof(_MMsgHdr),
+                len(replies) - first, 0,
+            )
+            if count < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error == errno.EBADF:
+                    raise OSError(error, os.strerror(error))
+                count = 1  # the first reply could not be sent, skip it
+            else:
+                self.sent += count
+            first += count
+
+    def stats(self):
+        """Get the batching counters
+
+        Returns:
+            dict: datagrams received and receive calls, replies sent and
+                send calls, and whether recvmmsg and sendmmsg are used
+        """
+        return {
+            "mmsg": self.mmsg is not None,
+            "datagrams": self.datagrams,
+            "receive_calls": self.receive_calls,
+            "sent": self.sent,
+            "send_calls": self.send_calls,
+        }
+
+    def close(self):
+        """Send the queued replies"""
+        with self.lock:
+            self.flush()
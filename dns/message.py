@@ -76,9 +76,26 @@ class Message:
     def from_bytes(cls, packet):
         """Create Message from bytes.
 
+        The message is parsed through a memoryview, so no part of the
+        packet is copied unless it is kept in the message. The message does
+        not refer to the packet, which may be a receive buffer that is
+        reused afterwards.
+
         Args:
-            packet (bytes): byte representation of the message.
+            packet (bytes): byte representation of the message, or a
+                bytearray or memoryview containing it.
+
+        Raises:
+            ValueError: if the message is malformed or truncated
         """
+        try:
+            return cls._parse(memoryview(packet))
+        except (struct.error, IndexError) as e:
+            raise ValueError("malformed message") from e
+
+    @classmethod
+    def _parse(cls, packet):
+        """Parse a message from a memoryview, see from_bytes"""
         header, offset = Header.from_bytes(packet), 12
 
         questions = []
@@ -286,6 +303,5 @@ class Question:
     def from_bytes(cls, packet, offset):
         """Convert Question from bytes."""
         qname, offset = Name.from_bytes(packet, offset)
-        qtype = Type(struct.unpack_from("!H", packet, offset)[0])
-        qclass = Class(struct.unpack_from("!H", packet, offset + 2)[0])
-        return cls(qname, qtype, qclass), offset + 4
+        qtype, qclass = struct.unpack_from("!HH", packet, offset)
+        return cls(qname, Type(qtype), Class(qclass)), offset + 4
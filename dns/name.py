@@ -32,6 +32,18 @@ class Name:
         else:
             return False
 
+    def is_subdomain(self, zone):
+        """Check whether the name is in a zone
+
+        Args:
+            zone (Name): the zone
+
+        Returns:
+            bool: whether the name is the zone or a name below it
+        """
+        start = len(self.labels) - len(zone.labels)
+        return start >= 0 and Name(self.labels[start:]) == zone
+
     def __str__(self):
         result = ""
         for label in self.labels:
@@ -63,29 +75,38 @@ class Name:
 
     @classmethod
     def from_bytes(cls, packet, offset):
-        """Create Name from bytes."""
+        """Create Name from bytes.
+
+        The packet may be a memoryview, in which case the labels are
+        decoded from it without copying them first.
+
+        Raises:
+            ValueError: if a label or a compression pointer is invalid
+        """
         labels = []
-        hops = 0
+        next_offset = None
+        # pointers have to point before the labels read so far, otherwise
+        # a malicious packet could make them loop
+        start = offset
         while True:
-            label_length = struct.unpack_from("!B", packet, offset)[0]
+            label_length = packet[offset]
             if label_length < 64:
                 offset += 1
-                blabel = packet[offset:offset + label_length]
-                if blabel:
-                    labels.append(blabel.decode("utf-8"))
-                offset += label_length
-                if hops == 0:
-                    next_offset = offset
                 if label_length == 0:
                     break
+                labels.append(
+                    str(packet[offset:offset + label_length], "utf-8")
+                )
+                offset += label_length
             elif label_length >= 192:
-                pointer = struct.unpack_from(
-                    "!H", packet, offset
-                )[0] - (3 << 14)
-                if hops == 0:
+                if next_offset is None:
                     next_offset = offset + 2
-                hops += 1
-                offset = pointer
+                offset = ((label_length & 0x3f) << 8) | packet[offset + 1]
+                if offset >= start:
+                    raise ValueError("invalid compression pointer")
+                start = offset
             else:
                 raise ValueError
+        if next_offset is None:
+            next_offset = offset
         return cls(labels), next_offset
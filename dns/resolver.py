@@ -7,84 +7,802 @@ implement things in this module. This resolver will be both used by the DNS
 client and the DNS server, but with a different list of servers.
 """
 
+import copy
 import socket
+import threading
+import time
 from random import randint
 
+from dns.cache import InfrastructureCache
 from dns.classes import Class
 from dns.message import Message, Question, Header
 from dns.name import Name
+from dns.rcodes import RCode
+from dns.resource import GenericRecordData, ResourceRecord
+from dns.transport import SocketChannel, TCPPool
 from dns.types import Type
 
 
+class BudgetExceeded(TimeoutError):
+    """A resolution used up its queries or time"""
+
+
+class ResolutionFailed(OSError):
+    """A resolution reached a dead end, such as a referral loop"""
+
+
+class NoData(list):
+    """An empty answer for a name which exists
+
+    Returned instead of an empty list when the name has no records of the
+    queried type (NODATA, see RFC 2308), so it can be told apart from a
+    name error.
+    """
+
+
+class ResolutionBudget:
+    """The queries and time a resolution may use
+
+    A budget is shared by a resolution and all of its sub-resolutions. It
+    also tracks which names are being resolved, so a resolution never
+    starts a sub-resolution of a name it depends on.
+    """
+
+    def __init__(self, max_queries, time_limit):
+        """Initialize the budget
+
+        Args:
+            max_queries (int): maximum number of queries
+            time_limit (float): maximum duration in seconds
+        """
+        self.max_queries = max_queries
+        self.deadline = time.monotonic() + time_limit
+        self.queries = 0
+        self.resolving = set()
+
+    def spend(self):
+        """Take a query from the budget
+
+        Raises:
+            BudgetExceeded: if there are no queries or time left
+        """
+        if self.queries >= self.max_queries:
+            raise BudgetExceeded("query budget exceeded")
+        if time.monotonic() >= self.deadline:
+            raise BudgetExceeded("resolution deadline exceeded")
+        self.queries += 1
+
+
 class Resolver:
     """DNS resolver"""
 
     root_server = "198.97.190.53"  # h.root-servers.net
+    port = 53
+    recursion_desired = False
 
     @staticmethod
-    def send_query(sock, hostname, ip):
-        # Create and send query
-        question = Question(Name(hostname), Type.A, Class.IN)
-        header = Header(randint(0, 2**16), 0, 1, 0, 0, 0)
+    def make_query(hostname, type_=Type.A, class_=Class.IN, payload=0,
+                   rd=False):
+        """Create a query for the records of a hostname
+
+        Args:
+            hostname (str): the hostname
+            type_ (Type): the type of the records
+            class_ (Class): the class of the records
+            payload (int): UDP payload size advertised with an EDNS0 OPT
+                record (if > 0), see RFC 6891
+            rd (bool): whether recursion is desired
+
+        Returns:
+            Message: the query
+        """
+        question = Question(Name(hostname), type_, class_)
+        header = Header(randint(0, 2**16 - 1), 0, 1, 0, 0, 0)
         header.qr = 0
         header.opcode = 0
-        header.rd = 0  # no recursion desired
-        query = Message(header, [question])
-        sock.sendto(query.to_bytes(), (ip, 53))
+        header.rd = int(rd)
+        additionals = []
+        if payload > 0:
+            header.ar_count = 1
+            additionals.append(ResourceRecord(
+                Name([]), Type.OPT, payload, 0, GenericRecordData(b"")
+            ))
+        return Message(header, [question], additionals=additionals)
+
+    def closest_servers(self, hostname):
+        """Find the nameservers of the closest known enclosing zone
+
+        Args:
+            hostname (str): the hostname to resolve
+
+        Returns:
+            [str]: addresses of the nameservers, the root server if no
+                delegation is cached
+        """
+        return self.closest_delegation(hostname)[1]
 
-        # Receive response
-        data = sock.recv(512)
-        return Message.from_bytes(data)
+    def closest_delegation(self, hostname):
+        """Find the closest known enclosing zone and its nameservers
 
-    def query_recursive(self, sock, hostname, ip):
+        Walks from the hostname towards the root and returns the deepest zone
+        for which both the NS records and the addresses of the nameservers
+        are cached.
+
+        Args:
+            hostname (str): the hostname to resolve
+
+        Returns:
+            (Name, [str]): the zone and the addresses of its nameservers,
+                the root and the root server if no delegation is cached
+        """
         if self.cache is not None:
-            answer = []
-            record = self.cache.lookup(Name(hostname), Type.A, Class.IN)
-            alias = self.cache.lookup(Name(hostname), Type.CNAME, Class.IN)
-            if record is not None:
-                answer.append(record)
-            if alias is not None:
-                answer.append(alias)
-            if len(answer):
+            labels = Name(hostname).labels
+            for i in range(len(labels) + 1):
+                delegation = self.cache.lookup(
+                    Name(labels[i:]), Type.NS, Class.IN
+                )
+                ips = []
+                for record in delegation or []:
+                    for glue in self.cache.lookup(
+                            record.rdata.nsdname, Type.A, Class.IN
+                    ) or []:
+                        ips.append(glue.rdata.address)
+                if ips:
+                    return Name(labels[i:]), ips
+        return Name([]), [self.root_server]
+
+    def order_servers(self, ips):
+        """Order nameservers from most to least preferable
+
+        Args:
+            ips ([str]): addresses of the nameservers
+
+        Returns:
+            [str]: the addresses, fastest first if the resolver has an
+                infrastructure cache
+        """
+        if self.infra is not None:
+            return self.infra.sort(ips)
+        return ips
+
+    def send_query_staggered(self, sock, hostname, ips, budget=None,
+                             type_=Type.A, class_=Class.IN):
+        """Query a list of nameservers in a staggered fashion
+
+        The query is sent to the first nameserver. Whenever no response has
+        arrived stagger_delay seconds after the last query was sent, the
+        query is also sent to the next nameserver, up to fanout nameservers.
+        A response with an RCODE other than NOERROR and NXDOMAIN counts as a
+        failure of that nameserver and the next one is queried right away.
+        A nameserver which answers FORMERR to a query with an EDNS0 OPT
+        record is asked again without it first (RFC 6891 section 7). The
+        first other matching response wins, responses to the other queries
+        are ignored. If the
+        resolver has an infrastructure cache, the fastest nameservers are
+        queried first and round-trip times are recorded, including lower
+        bounds for the queries still unanswered. If the resolver has
+        a socket pool, the queries are sent through the pool instead of the
+        given socket. A truncated response is retried over TCP.
+
+        Args:
+            sock (socket): UDP socket, or None if the resolver has a pool
+            hostname (str): the hostname to query
+            ips ([str]): addresses of the nameservers, best first
+            budget (ResolutionBudget): every query is taken from the budget,
+                and no response is awaited beyond its deadline
+            type_ (Type): the type to query
+            class_ (Class): the class to query
+
+        Returns:
+            Message: the first response
+
+        Raises:
+            BudgetExceeded: if the budget ran out before a query was sent
+            socket.timeout: if no nameserver responded in time
+            ConnectionError: if all nameservers failed
+        """
+        ips = self.order_servers(ips)
+        candidates = list(ips[:self.fanout])
+        if self.pool is not None:
+            channel = self.pool.channel()
+        else:
+            channel = SocketChannel(sock)
+        pending = {}
+        plain = set()  # nameservers which do not understand EDNS0
+        failed = False
+        deadline = next_send = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                if candidates and now >= next_send:
+                    if budget is not None:
+                        try:
+                            budget.spend()
+                        except BudgetExceeded:
+                            if not pending:
+                                raise
+                            candidates = []
+                            continue
+                    ip = candidates.pop(0)
+                    query = Resolver.make_query(
+                        hostname, type_, class_,
+                        0 if ip in plain else self.payload,
+                        self.recursion_desired,
+                    )
+                    addr = (ip, self.port)
+                    try:
+                        channel.send(query, addr)
+                    except OSError:
+                        continue
+                    pending[(query.header.ident, addr)] = now
+                    next_send = now + self.stagger_delay
+                    deadline = now + self.timeout
+                    if budget is not None:
+                        deadline = min(deadline, budget.deadline)
+                    continue
+                if not pending and not candidates:
+                    if failed:
+                        raise ConnectionError("nameservers failed")
+                    raise socket.timeout("no nameserver answered")
+                if candidates:
+                    wait_until = min(deadline, next_send)
+                else:
+                    wait_until = deadline
+                if now >= wait_until and not candidates:
+                    if self.infra is not None:
+                        for _, (ip, _) in pending:
+                            self.infra.record_timeout(ip, self.timeout)
+                    raise socket.timeout("timed out")
+                try:
+                    received = channel.receive(max(wait_until - now, 0.001))
+                except socket.timeout:
+                    continue
+                if received is None:
+                    continue
+                response, addr = received
+                sent = pending.get((response.header.ident, addr))
+                if sent is not None and response.header.rcode not in (
+                        RCode.NoError, RCode.NXDomain
+                ):
+                    del pending[(response.header.ident, addr)]
+                    if (
+                            response.header.rcode == RCode.FormErr and
+                            self.payload > 0 and addr[0] not in plain
+                    ):
+                        plain.add(addr[0])
+                        candidates.insert(0, addr[0])
+                    else:
+                        # try the next server, a failure can be caused by
+                        # the name, so it does not count against the health
+                        failed = True
+                    next_send = time.monotonic()
+                    continue
+                if sent is not None:
+                    del pending[(response.header.ident, addr)]
+                    if self.infra is not None:
+                        now = time.monotonic()
+                        self.infra.record_rtt(addr[0], now - sent)
+                        for (_, (ip, _)), other in pending.items():
+                            self.infra.record_unanswered(ip, now - other)
+                    if response.header.tc:
+                        return self.send_query_tcp(
+                            hostname, addr[0], budget, type_, class_
+                        )
+                    return response
+        finally:
+            channel.close()
+
+    def send_query_tcp(self, hostname, ip, budget=None, type_=Type.A,
+                       class_=Class.IN):
+        """Query a nameserver over TCP
+
+        Args:
+            hostname (str): the hostname to query
+            ip (str): address of the nameserver
+            budget (ResolutionBudget): budget the query is taken from
+            type_ (Type): the type to query
+            class_ (Class): the class to query
+
+        Returns:
+            Message: the response
+
+        Raises:
+            BudgetExceeded: if the budget ran out
+            OSError: if the query failed
+        """
+        timeout = self.timeout
+        if budget is not None:
+            budget.spend()
+            timeout = min(timeout, budget.deadline - time.monotonic())
+        query = Resolver.make_query(
+            hostname, type_, class_, rd=self.recursion_desired
+        )
+        return self.tcp.query(query, (ip, self.port), max(timeout, 0.001))
+
+    def query_recursive(self, sock, hostname, ips=None, refresh=False,
+                        budget=None, type_=Type.A, class_=Class.IN,
+                        zone=None):
+        """Resolve a hostname iteratively
+
+        Starting at the given nameservers (or at the closest known zone),
+        follows referrals until an answer is found. Addresses of
+        nameservers without glue are resolved as sub-resolutions. All
+        queries, including those of sub-resolutions, are taken from one
+        ResolutionBudget.
+
+        Args:
+            sock (socket): UDP socket
+            hostname (str): the hostname to resolve
+            ips ([str]): addresses of the nameservers to start at
+            refresh (bool): whether to bypass the cached answer
+            budget (ResolutionBudget): budget of the resolution
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+            zone (Name): the zone of the nameservers at ips, the root if
+                None
+
+        Returns:
+            [ResourceRecord]: the answer, a NoData if the name exists but
+                has no records of the type
+
+        Raises:
+            BudgetExceeded: if the budget ran out
+            socket.timeout: if the nameservers did not respond, or the
+                addresses of none of the nameservers could be resolved
+            ResolutionFailed: if the referrals loop or lead to no
+                nameserver address
+        """
+        if budget is None:
+            budget = ResolutionBudget(self.max_queries, self.time_limit)
+        if ips is None and self.coalescer is not None:
+            key = (str(Name(hostname)).lower(), type_, class_, refresh)
+            return self.coalescer.resolve(
+                key,
+                lambda: self.resolve(
+                    sock, hostname, refresh, budget, type_, class_
+                ),
+                self.time_limit,
+            )
+        if ips is None:
+            return self.resolve(sock, hostname, refresh, budget, type_,
+                                class_)
+
+        seen = set()
+        while True:
+            answer = None
+            if not refresh:
+                answer = self.lookup_cache(hostname, type_, class_)
+            if answer is not None:
                 return answer
+            if frozenset(ips) in seen:
+                raise ResolutionFailed("referral loop")
+            seen.add(frozenset(ips))
+
+            response = self.send_query_staggered(
+                sock, hostname, ips, budget, type_, class_
+            )
+            answer, ips, nsdnames, zone = self.process_response(
+                hostname, response, type_, class_, zone
+            )
+            if answer is not None:
+                return answer
+            error = None
+            for nsdname in nsdnames:
+                if ips:
+                    break
+                if str(nsdname).lower() in budget.resolving:
+                    continue  # would depend on itself
+                try:
+                    ips = Resolver.hostent(
+                        nsdname,
+                        self.query_recursive(sock, nsdname, budget=budget),
+                    )[2]
+                except BudgetExceeded:
+                    raise
+                except OSError as e:
+                    error = e  # try the next nameserver
+            if not ips:
+                if error is not None:
+                    raise error
+                raise ResolutionFailed("no nameserver address")
+
+    def resolve(self, sock, hostname, refresh=False, budget=None,
+                type_=Type.A, class_=Class.IN):
+        """Resolve a hostname and follow its CNAME chain
+
+        Every link of the chain is resolved starting at the closest known
+        zone, so links which are cached cost no queries. At most
+        max_chain aliases are followed. Queries for CNAME and ANY records
+        are not chased.
+
+        Args:
+            sock (socket): UDP socket
+            hostname (str): the hostname to resolve
+            refresh (bool): whether to bypass the cached answer of the
+                hostname itself
+            budget (ResolutionBudget): budget of the resolution
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+
+        Returns:
+            [ResourceRecord]: the CNAME records of the chain and the answer
+                for the canonical name
+        """
+        if budget is None:
+            budget = ResolutionBudget(self.max_queries, self.time_limit)
+        answer = []
+        sname = hostname
+        names = set()
+        while sname is not None and len(names) <= self.max_chain:
+            name = str(Name(sname)).lower()
+            if name in names:
+                break  # CNAME loop
+            names.add(name)
+            records = self.resolve_link(
+                sock, sname, refresh, budget, type_, class_
+            )
+            if not answer and isinstance(records, NoData):
+                return records
+            answer.extend(r for r in records if r not in answer)
+            if type_ in (Type.CNAME, Type.ANY):
+                break
+            sname = Resolver.canonical_name(sname, records)
+            refresh = False
+        return answer
+
+    def resolve_link(self, sock, hostname, refresh=False, budget=None,
+                     type_=Type.A, class_=Class.IN):
+        """Resolve one link of a CNAME chain
+
+        Falls back to stale records from the cache if resolution fails. If
+        there are stale records, they are also served when the resolution
+        takes longer than stale_timeout seconds, and the resolution goes on
+        in the background to refresh the cache (RFC 8767 section 5).
+
+        Args:
+            sock (socket): UDP socket
+            hostname (str): the hostname to resolve
+            refresh (bool): whether to bypass the cached answer
+            budget (ResolutionBudget): budget of the resolution
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+
+        Returns:
+            [ResourceRecord]: the answer
+        """
+        name = str(Name(hostname)).lower()
+        budget.resolving.add(name)
+        try:
+            zone, ips = self.closest_delegation(hostname)
+            stale = None
+            if not refresh and self.stale_timeout is not None:
+                stale = self.lookup_stale(hostname, type_, class_, False)
+            if stale is not None:
+                return self.resolve_before_stale(
+                    stale, hostname, ips, budget, type_, class_, zone
+                )
+            return self.query_recursive(
+                sock, hostname, ips, refresh, budget, type_, class_, zone
+            )
+        except OSError:
+            stale = None
+            if not refresh:
+                stale = self.lookup_stale(hostname, type_, class_)
+            if stale is None:
+                raise
+            return stale
+        finally:
+            budget.resolving.discard(name)
+
+    def resolve_before_stale(self, stale, hostname, ips, budget,
+                             type_=Type.A, class_=Class.IN, zone=None):
+        """Resolve in a thread and serve stale records if it takes too long
+
+        The thread uses its own socket unless the resolver has a pool, since
+        it may outlive the socket of the caller.
+
+        Args:
+            stale ([ResourceRecord]): the stale records
+            hostname (str): the hostname to resolve
+            ips ([str]): addresses of the nameservers to start at
+            budget (ResolutionBudget): budget of the resolution
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+            zone (Name): the zone of the nameservers at ips
+
+        Returns:
+            [ResourceRecord]: the answer, or the stale records if there is
+                none after stale_timeout seconds
+        """
+        done = threading.Event()
+        result = {}
+
+        def resolve():
+            sock = None
+            if self.pool is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.settimeout(self.timeout)
+            try:
+                result["answer"] = self.query_recursive(
+                    sock, hostname, ips, False, budget, type_, class_, zone
+                )
+            except (OSError, ValueError) as e:
+                result["error"] = e
+            finally:
+                if sock is not None:
+                    sock.close()
+                done.set()
+
+        thread = threading.Thread(target=resolve)
+        thread.daemon = True
+        thread.start()
+        if not done.wait(self.stale_timeout):
+            return stale
+        if "error" in result:
+            raise result["error"]
+        return result["answer"]
+
+    @staticmethod
+    def canonical_name(hostname, records):
+        """Find where resolution has to continue after an answer
+
+        Follows the CNAME records in the answer starting at the hostname.
+
+        Args:
+            hostname (str): the hostname that was resolved
+            records ([ResourceRecord]): the answer
+
+        Returns:
+            Name: the end of the chain if the answer contains no records
+                for it, or None
+        """
+        sname = Name(hostname)
+        for _ in range(len(records)):
+            for record in records:
+                if record.type_ is Type.CNAME and record.name == sname:
+                    sname = record.rdata.cname
+                    break
+            else:
+                break
+        if sname == Name(hostname):
+            return None
+        for record in records:
+            if record.name == sname and record.type_ is not Type.CNAME:
+                return None
+        return sname
+
+    def lookup_cache(self, hostname, type_=Type.A, class_=Class.IN):
+        """Get the cached answer for a hostname
+
+        Answers to queries for ANY records are never taken from the cache,
+        since it cannot tell whether it holds all records of a name.
+
+        Args:
+            hostname (str): the hostname to resolve
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+
+        Returns:
+            [ResourceRecord]: the cached records of the type and CNAME
+                records, an empty list if the name is known not to exist,
+                a NoData if the records are known not to exist, or None
+        """
+        if self.cache is None or type_ is Type.ANY:
+            return None
+        answer = []
+        records = self.cache.lookup(Name(hostname), type_, class_)
+        aliases = None
+        if type_ is not Type.CNAME:
+            aliases = self.cache.lookup(Name(hostname), Type.CNAME, class_)
+        if records is not None:
+            answer.extend(records)
+        if aliases is not None:
+            answer.extend(aliases)
+        if answer:
+            return answer
+        if records is not None or aliases is not None:
+            # the lookup falls back to a name error, which is cached as ANY
+            nxdomain = self.cache.lookup(Name(hostname), Type.ANY, class_)
+            return answer if nxdomain is not None else NoData()
+        return None
+
+    def process_response(self, hostname, response, type_=Type.A,
+                         class_=Class.IN, zone=None):
+        """Analyze and cache a response from a nameserver
+
+        A referral is only followed if it delegates a zone which contains
+        the hostname and is below the zone of the nameserver. Only glue for
+        the nameservers of that delegation and within the zone of the
+        nameserver is used.
+
+        Args:
+            hostname (str): the hostname that was queried
+            response (Message): the response
+            type_ (Type): the type that was queried
+            class_ (Class): the class that was queried
+            zone (Name): the zone of the nameserver, the root if None
+
+        Returns:
+            ([ResourceRecord], [str], [Name], Name): the answer (a NoData
+                for a NODATA response), or None if the response is a
+                referral, the addresses of the nameservers from the
+                additional section, the names of the nameservers from the
+                authority section, and the delegated zone
 
-        response = Resolver.send_query(sock, hostname, ip)
+        Raises:
+            ConnectionError: if the RCODE is not NOERROR or NXDOMAIN
+            ResolutionFailed: if the referral is lame or out of bailiwick
+        """
+        if zone is None:
+            zone = Name([])
+        if response.header.rcode not in (RCode.NoError, RCode.NXDomain):
+            # never turn a failure into an empty answer
+            raise ConnectionError("nameserver failed")
         if (
                 response.header.an_count > 0 or
                 response.header.rcode != 0
         ):
             if self.cache is not None:
                 self.cache.add_records(response.answers)
-            return response.answers
+                self.cache_negative(hostname, response, type_, class_)
+            return response.answers, [], [], zone
+        referral = [
+            record for record in response.authorities
+            if record.type_ is Type.NS
+        ]
+        if (
+                self.cache_negative(hostname, response, type_, class_) or
+                not referral
+        ):
+            # NODATA, which is only cached if it has an SOA record
+            return NoData(), [], [], zone
+        qname = Name(hostname)
+        referral = [
+            record for record in referral
+            if qname.is_subdomain(record.name) and
+            record.name.is_subdomain(zone) and
+            len(record.name.labels) > len(zone.labels)
+        ]
+        if not referral:
+            # never turn a lame server into an empty answer
+            raise ResolutionFailed("lame referral")
+        child = max(
+            (record.name for record in referral),
+            key=lambda name: len(name.labels),
+        )
+        referral = [record for record in referral if record.name == child]
+        if self.cache is not None:
+            self.cache.add_records(referral)
+        nsdnames = [record.rdata.nsdname for record in referral]
         ips = []
         for record in response.additionals:
-            if record.type_ is Type.A:
+            if (
+                    record.type_ is Type.A and
+                    record.name in nsdnames and
+                    record.name.is_subdomain(zone)
+            ):
                 ips.append(record.rdata.address)
                 if self.cache is not None:
                     self.cache.add_record(record)
-            if record.type_ is Type.CNAME and self.cache is not None:
-                self.cache.add_record(record)
-        if len(ips) == 0:
-            for record in response.authorities:
-                ipaddrlist = self.gethostbyname(record.rdata.nsdname)[2]
-                for new_ip in ipaddrlist:
-                    res = self.query_recursive(sock, hostname, new_ip)
-                    if res is not None:
-                        return res
-        for new_ip in ips:
-            res = self.query_recursive(sock, hostname, new_ip)
-            if res is not None:
-                return res
-        return []
-
-    def __init__(self, timeout, cache=None):
+        return None, ips, nsdnames, child
+
+    def lookup_stale(self, hostname, type_=Type.A, class_=Class.IN,
+                     trigger_refresh=True):
+        """Get expired records to serve when resolution fails
+
+        Args:
+            hostname (str): the hostname to resolve
+            type_ (Type): the type to resolve
+            class_ (Class): the class to resolve
+            trigger_refresh (bool): whether the cache should start
+                refreshing the records
+
+        Returns:
+            [ResourceRecord]: the stale records, or None if there are none
+        """
+        if self.cache is None or type_ is Type.ANY:
+            return None
+        answer = []
+        for stale_type in {type_, Type.CNAME}:
+            answer += self.cache.lookup_stale(
+                Name(hostname), stale_type, class_, trigger_refresh
+            ) or []
+        return answer or None
+
+    @staticmethod
+    def negative_ttl(response):
+        """Get the TTL for caching a negative response
+
+        See RFC 2308 section 5: the TTL is the minimum of the TTL of the SOA
+        record in the authority section and its MINIMUM field.
+
+        Args:
+            response (Message): the response
+
+        Returns:
+            int: the TTL, or None if there is no SOA record
+        """
+        for record in response.authorities:
+            if record.type_ is Type.SOA:
+                return min(record.ttl, record.rdata.minimum)
+        return None
+
+    def cache_negative(self, hostname, response, type_=Type.A,
+                       class_=Class.IN):
+        """Cache a name error or NODATA response
+
+        If the answer contains a CNAME chain, the negative answer is for the
+        name at the end of the chain, see RFC 2308 section 2.
+
+        Args:
+            hostname (str): the hostname that was queried
+            response (Message): the response
+            type_ (Type): the type that was queried
+            class_ (Class): the class that was queried
+
+        Returns:
+            bool: whether the response was a negative answer
+        """
+        rcode = response.header.rcode
+        if rcode not in (RCode.NoError, RCode.NXDomain):
+            return False
+        name = Resolver.canonical_name(hostname, response.answers)
+        if name is None:
+            if rcode == RCode.NoError and response.answers:
+                return False
+            name = Name(hostname)
+        ttl = Resolver.negative_ttl(response)
+        if ttl is None:
+            return rcode == RCode.NXDomain
+        if self.cache is not None and (
+                rcode == RCode.NXDomain or type_ is not Type.ANY
+        ):
+            # a name error is cached under ANY, so NODATA for ANY is not
+            self.cache.add_negative(name, type_, class_, ttl, RCode(rcode))
+        return True
+
+    def __init__(self, timeout, cache=None, stagger_delay=0.2, fanout=3,
+                 infra=None, coalescer=None, max_queries=100, time_limit=10,
+                 max_chain=8, pool=None, tcp=None, payload=1232,
+                 stale_timeout=1.8):
         """Initialize the resolver
 
         Args:
+            timeout (float): timeout for upstream queries
             cache (RecordCache): the cache
+            stagger_delay (float): seconds to wait for a response before
+                also querying the next nameserver of a zone
+            fanout (int): maximum number of nameservers queried for one
+                step of a resolution
+            infra (InfrastructureCache): round-trip times of nameservers
+            coalescer (QueryCoalescer): shared between resolvers to
+                deduplicate concurrent resolutions of the same name
+            max_queries (int): maximum number of queries sent for one
+                resolution, including its sub-resolutions
+            time_limit (float): maximum duration of one resolution
+            max_chain (int): maximum number of CNAME records followed
+            pool (SocketPool): sockets shared by all resolutions, used
+                instead of the socket passed to query_recursive
+            tcp (TCPPool): connections for truncated responses, by default
+                a connection is opened for every TCP query
+            payload (int): EDNS0 UDP payload size advertised in queries,
+                EDNS0 is not used if 0
+            stale_timeout (float): seconds after which stale records are
+                served while the resolution goes on, never if None
         """
         self.timeout = timeout
         self.cache = cache
+        self.stagger_delay = stagger_delay
+        self.fanout = fanout
+        self.infra = infra
+        self.coalescer = coalescer
+        self.max_queries = max_queries
+        self.time_limit = time_limit
+        self.max_chain = max_chain
+        self.pool = pool
+        self.tcp = tcp if tcp is not None else TCPPool(0)
+        self.payload = payload
+        self.stale_timeout = stale_timeout
 
     def gethostbyname(self, hostname):
         """Translate a host name to IPv4 address.
@@ -114,14 +832,31 @@ class Resolver:
         Returns:
             (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
         """
+        if self.pool is not None:
+            return Resolver.hostent(
+                hostname, self.query_recursive(None, hostname)
+            )
+
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.settimeout(self.timeout)
 
-        answers = self.query_recursive(sock, hostname, Resolver.root_server)
+        answers = self.query_recursive(sock, hostname)
 
         sock.close()
 
-        # Get data
+        return Resolver.hostent(hostname, answers)
+
+    @staticmethod
+    def hostent(hostname, answers):
+        """Convert an answer to the result of gethostbyname
+
+        Args:
+            hostname (str): the hostname
+            answers ([ResourceRecord]): the answer
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
         aliaslist = []
         ipaddrlist = []
         for answer in answers:
@@ -131,3 +866,316 @@ class Resolver:
                 aliaslist.append(str(answer.rdata.cname))
 
         return hostname, aliaslist, ipaddrlist
+
+
+class InFlightCall:
+    """A resolution which is in progress"""
+
+    def __init__(self):
+        """Initialize the call"""
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QueryCoalescer:
+    """Deduplicates concurrent identical resolutions
+
+    The first thread to resolve a key does the work, other threads asking
+    for the same key in the meantime wait for its result.
+    """
+
+    def __init__(self):
+        """Initialize the coalescer"""
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def resolve(self, key, function, timeout=None):
+        """Call function, or wait for a concurrent call for the same key
+
+        A waiter which is not done after timeout seconds calls function
+        itself, so cyclic dependencies between resolutions cannot
+        deadlock.
+
+        Args:
+            key (tuple): identifies the resolution
+            function (callable): does the resolution
+            timeout (float): maximum time to wait for another thread
+
+        Returns:
+            the result of function
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+            elif call.owner == threading.get_ident():
+                call = None
+            else:
+                self.coalesced += 1
+        if call is None:
+            return function()
+        if not leader:
+            if call.done.wait(timeout):
+                if call.error is not None:
+                    raise call.error
+                return copy.copy(call.result)
+            return function()
+        try:
+            call.result = function()
+            return copy.copy(call.result)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+class Prefetcher:
+    """Refreshes popular cache entries before they expire
+
+    An instance is passed to RecordCache.enable_prefetch. Every refresh runs
+    in its own thread, at most budget refreshes run at the same time and a
+    record set is never refreshed twice at the same time.
+    """
+
+    def __init__(self, cache, timeout=5, budget=4, infra=None, pool=None,
+                 upstreams=None):
+        """Initialize the prefetcher
+
+        Args:
+            cache (RecordCache): the cache
+            timeout (float): timeout of the resolver
+            budget (int): maximum number of concurrent refreshes
+            infra (InfrastructureCache): round-trip times of nameservers
+            pool (SocketPool): sockets for upstream queries
+            upstreams (UpstreamGroup): refresh through these upstreams
+                instead of resolving iteratively
+        """
+        self.cache = cache
+        self.infra = infra
+        self.pool = pool
+        self.upstreams = upstreams
+        self.timeout = timeout
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.pending = set()
+
+        self.triggered = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def __call__(self, dname, type_, class_):
+        """Start refreshing the records of a domain name
+
+        Args:
+            dname (Name): domain name
+            type_ (Type): type
+            class_ (Class): class
+        """
+        key = (str(dname).lower(), type_, class_)
+        with self.lock:
+            if key in self.pending:
+                return
+            if len(self.pending) >= self.budget:
+                self.skipped += 1
+                return
+            self.pending.add(key)
+            self.triggered += 1
+        thread = threading.Thread(
+            target=self.refresh, args=(key, dname, type_, class_)
+        )
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self, key, dname, type_=Type.A, class_=Class.IN):
+        """Resolve a domain name again, bypassing the cached answer"""
+        sock = None
+        if self.pool is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(self.timeout)
+        if self.upstreams is not None:
+            resolver = Forwarder(
+                self.timeout, self.upstreams, self.cache, pool=self.pool
+            )
+        else:
+            resolver = Resolver(
+                self.timeout, self.cache, infra=self.infra, pool=self.pool
+            )
+        try:
+            records = resolver.query_recursive(
+                sock, dname, refresh=True, type_=type_, class_=class_
+            )
+        except (OSError, ValueError):
+            records = []
+        finally:
+            if sock is not None:
+                sock.close()
+        with self.lock:
+            self.pending.discard(key)
+            if records:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        """Get the prefetch counters
+
+        Returns:
+            dict: triggered, succeeded, failed and skipped refreshes
+        """
+        with self.lock:
+            return {
+                "triggered": self.triggered,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "skipped": self.skipped,
+            }
+
+
+class UpstreamGroup:
+    """The upstream recursive servers of a forwarder
+
+    Spreads queries over the healthy upstreams in turn. An upstream which
+    timed out is only used when no healthy upstream is left, until it
+    answers again, usually a probe of the HealthChecker. Unlike the backoff
+    of the infrastructure cache, this does not expire between probes.
+    """
+
+    def __init__(self, ips, port=53, infra=None):
+        """Initialize the group
+
+        Args:
+            ips ([str]): addresses of the upstream servers
+            port (int): port of the upstream servers
+            infra (InfrastructureCache): health of the upstream servers
+        """
+        self.ips = list(ips)
+        self.port = port
+        self.infra = infra if infra is not None else InfrastructureCache()
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def order(self):
+        """Get the upstreams in the order in which they should be queried
+
+        Returns:
+            [str]: addresses of the upstreams, healthy ones first and
+                starting at a different one for every call
+        """
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % len(self.ips)
+        ips = self.ips[start:] + self.ips[:start]
+        # timeouts only drop back to 0 when the upstream answers
+        return sorted(ips, key=lambda ip: self.infra.get(ip)["timeouts"] > 0)
+
+
+class Forwarder(Resolver):
+    """Resolver which forwards queries to upstream recursive servers
+
+    Queries are sent with recursion desired to the upstreams of an
+    UpstreamGroup, and fail over to the next upstream when one times out or
+    answers with a server failure. Answers are cached like those of the
+    iterative resolver.
+    """
+
+    recursion_desired = True
+
+    def __init__(self, timeout, upstreams, cache=None, stagger_delay=0.2,
+                 coalescer=None, max_queries=100, time_limit=10,
+                 max_chain=8, pool=None, tcp=None, payload=1232,
+                 stale_timeout=1.8):
+        """Initialize the forwarder
+
+        Args:
+            timeout (float): timeout for upstream queries
+            upstreams (UpstreamGroup): the upstream servers
+            cache (RecordCache): the cache
+
+        See Resolver.__init__ for the other arguments.
+        """
+        super().__init__(
+            timeout, cache, stagger_delay, len(upstreams.ips),
+            upstreams.infra, coalescer, max_queries, time_limit, max_chain,
+            pool, tcp, payload, stale_timeout,
+        )
+        self.upstreams = upstreams
+        self.port = upstreams.port
+
+    def closest_delegation(self, hostname):
+        """Get the upstreams to forward a query to
+
+        Args:
+            hostname (str): the hostname to resolve
+
+        Returns:
+            (Name, [str]): the root and the addresses of the upstreams
+        """
+        return Name([]), self.upstreams.order()
+
+    def order_servers(self, ips):
+        """Keep the order chosen by the upstream group"""
+        return ips
+
+
+class HealthChecker(threading.Thread):
+    """Thread which periodically probes the upstreams of a forwarder
+
+    Every interval, every upstream is asked for the root NS records. The
+    outcome is recorded in the infrastructure cache, so an upstream that
+    timed out is put back into rotation as soon as it answers a probe.
+    """
+
+    def __init__(self, upstreams, interval=10, timeout=2):
+        """Initialize the health checker
+
+        Args:
+            upstreams (UpstreamGroup): the upstream servers
+            interval (float): seconds between probes
+            timeout (float): timeout of a probe
+        """
+        super().__init__()
+        self.daemon = True
+        self.upstreams = upstreams
+        self.interval = interval
+        self.timeout = timeout
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Run the health checker thread"""
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        """Stop the thread"""
+        self.stopped.set()
+
+    def check(self):
+        """Probe every upstream once
+
+        Returns:
+            {str: bool}: whether each upstream answered
+        """
+        forwarder = Forwarder(self.timeout, self.upstreams, payload=0)
+        healthy = {}
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        try:
+            for ip in self.upstreams.ips:
+                try:
+                    forwarder.send_query_staggered(
+                        sock, Name([]), [ip], type_=Type.NS
+                    )
+                    healthy[ip] = True
+                except OSError:
+                    healthy[ip] = False
+        finally:
+            sock.close()
+        return healthy
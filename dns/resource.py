@@ -47,9 +47,13 @@ class ResourceRecord(object):
     def from_bytes(cls, packet, offset):
         """Convert ResourceRecord from bytes."""
         name, offset = Name.from_bytes(packet, offset)
-        type_ = Type(struct.unpack_from("!H", packet, offset)[0])
-        class_ = Class(struct.unpack_from("!H", packet, offset + 2)[0])
-        ttl, rdlength = struct.unpack_from("!iH", packet, offset + 4)
+        type_, class_, ttl, rdlength = struct.unpack_from(
+            "!HHiH", packet, offset
+        )
+        type_ = Type(type_)
+        if type_ is not Type.OPT:
+            # the class of an OPT record is the UDP payload size
+            class_ = Class(class_)
         offset += 10
         rdata = RecordData.create_from_bytes(type_, packet, offset, rdlength)
         offset += rdlength
@@ -119,7 +123,10 @@ class RecordData:
             Type.A: ARecordData,
             Type.CNAME: CNAMERecordData,
             Type.NS: NSRecordData,
-            Type.SOA: SOARecordData
+            Type.SOA: SOARecordData,
+            Type.PTR: PTRRecordData,
+            Type.MX: MXRecordData,
+            Type.AAAA: AAAARecordData,
         }
         if type_ in classdict:
             return classdict[type_].from_bytes(packet, offset, rdlength)
@@ -133,7 +140,10 @@ class RecordData:
             Type.A: ARecordData,
             Type.CNAME: CNAMERecordData,
             Type.NS: NSRecordData,
-            Type.SOA: SOARecordData
+            Type.SOA: SOARecordData,
+            Type.PTR: PTRRecordData,
+            Type.MX: MXRecordData,
+            Type.AAAA: AAAARecordData,
         }
         if type_ in classdict:
             return classdict[type_].from_dict(dct)
@@ -147,6 +157,8 @@ class RecordData:
             Type.A: ARecordData,
             Type.CNAME: CNAMERecordData,
             Type.NS: NSRecordData,
+            Type.PTR: PTRRecordData,
+            Type.AAAA: AAAARecordData,
         }
         if type_ in classdict:
             return classdict[type_](string)
@@ -334,6 +346,15 @@ class SOARecordData(RecordData):
         self.expire = expire
         self.minimum = minimum
 
+    def __str__(self):
+        return "SOA: {} {} {}".format(self.mname, self.rname, self.serial)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, SOARecordData) and
+            self.to_dict() == other.to_dict()
+        )
+
     def to_bytes(self, offset, compress):
         """Convert to bytes.
 
@@ -348,6 +369,7 @@ class SOARecordData(RecordData):
         data += struct.pack("!i", self.retry)
         data += struct.pack("!i", self.expire)
         data += struct.pack("!I", self.minimum)
+        return data
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength):
@@ -365,10 +387,7 @@ class SOARecordData(RecordData):
         retry = struct.unpack_from("!i", packet, offset + 8)[0]
         expire = struct.unpack_from("!i", packet, offset + 12)[0]
         minimum = struct.unpack_from("!I", packet, offset + 16)[0]
-        return (
-            cls(mname, rname, serial, refresh, retry, expire, minimum),
-            offset + 20,
-        )
+        return cls(mname, rname, serial, refresh, retry, expire, minimum)
 
     def to_dict(self):
         """Convert to dict."""
@@ -381,7 +400,179 @@ class SOARecordData(RecordData):
     def from_dict(cls, dct):
         """Create a RecordData object from dict."""
         return cls(Name(dct["mname"]), Name(dct["rname"]), dct["serial"],
-                   dt["refresh"], dct["retry"], dct["expire"], dct["minimum"])
+                   dct["refresh"], dct["retry"], dct["expire"], dct["minimum"])
+
+
+class PTRRecordData(RecordData):
+    """Record data for PTR type.
+
+    See RFC 1035 3.3.12.
+    """
+
+    def __init__(self, ptrdname):
+        """Create RecordData for PTR type.
+
+        Args:
+            ptrdname (Name): ptrdname.
+        """
+        self.ptrdname = Name(ptrdname)
+
+    def __str__(self):
+        return "PTR D Name: {}".format(self.ptrdname)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, PTRRecordData) and
+            self.ptrdname == other.ptrdname
+        )
+
+    def to_bytes(self, offset, compress):
+        """Convert to bytes.
+
+        Args:
+            offset (int): offset in packet.
+            compress (dict): dict from domain names to pointers.
+        """
+        return self.ptrdname.to_bytes(offset, compress)
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength):
+        """Create a RecordData object from bytes.
+
+        Args:
+            packet (bytes): packet.
+            offset (int): offset in message.
+            rdlength (int): length of rdata.
+        """
+        ptrdname, offset = Name.from_bytes(packet, offset)
+        return cls(ptrdname)
+
+    def to_dict(self):
+        """Convert to dict."""
+        return {"ptrdname": str(self.ptrdname)}
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Create a RecordData object from dict."""
+        return cls(Name(dct["ptrdname"]))
+
+
+class MXRecordData(RecordData):
+    """Record data for MX type.
+
+    See RFC 1035 3.3.9.
+    """
+
+    def __init__(self, preference, exchange):
+        """Create RecordData for MX type.
+
+        Args:
+            preference (int): preference.
+            exchange (Name): exchange.
+        """
+        self.preference = preference
+        self.exchange = Name(exchange)
+
+    def __str__(self):
+        return "Mail Exchange: {} {}".format(self.preference, self.exchange)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, MXRecordData) and
+            self.preference == other.preference and
+            self.exchange == other.exchange
+        )
+
+    def to_bytes(self, offset, compress):
+        """Convert to bytes.
+
+        Args:
+            offset (int): offset in packet.
+            compress (dict): dict from domain names to pointers.
+        """
+        data = struct.pack("!H", self.preference)
+        data += self.exchange.to_bytes(offset + 2, compress)
+        return data
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength):
+        """Create a RecordData object from bytes.
+
+        Args:
+            packet (bytes): packet.
+            offset (int): offset in message.
+            rdlength (int): length of rdata.
+        """
+        preference = struct.unpack_from("!H", packet, offset)[0]
+        exchange, offset = Name.from_bytes(packet, offset + 2)
+        return cls(preference, exchange)
+
+    def to_dict(self):
+        """Convert to dict."""
+        return {"preference": self.preference,
+                "exchange": str(self.exchange)}
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Create a RecordData object from dict."""
+        return cls(dct["preference"], Name(dct["exchange"]))
+
+
+class AAAARecordData(RecordData):
+    """Record data for AAAA type.
+
+    See RFC 3596 2.2.
+    """
+
+    def __init__(self, address):
+        """Create RecordData for AAAA type.
+
+        Args:
+            address (str): address.
+        """
+        self.address = address
+
+    def __str__(self):
+        return "IPv6: " + self.address
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, AAAARecordData) and
+            socket.inet_pton(socket.AF_INET6, self.address) ==
+            socket.inet_pton(socket.AF_INET6, other.address)
+        )
+
+    def to_bytes(self, offset, compress):
+        """Convert to bytes.
+
+        Args:
+            offset (int): offset in packet.
+            compress (dict): dict from domain names to pointers.
+        """
+        return socket.inet_pton(socket.AF_INET6, self.address)
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength):
+        """Create a RecordData object from bytes.
+
+        Args:
+            packet (bytes): packet.
+            offset (int): offset in message.
+            rdlength (int): length of rdata.
+        """
+        address = socket.inet_ntop(
+            socket.AF_INET6, packet[offset:offset + 16]
+        )
+        return cls(address)
+
+    def to_dict(self):
+        """Convert to dict."""
+        return {"address": self.address}
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Create a RecordData object from dict."""
+        return cls(dct["address"])
 
 
 class GenericRecordData(RecordData):
@@ -395,6 +586,15 @@ class GenericRecordData(RecordData):
         """
         self.data = data
 
+    def __str__(self):
+        return "Data: " + self.data.hex()
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, GenericRecordData) and
+            self.data == other.data
+        )
+
     def to_bytes(self, offset, compress):
         """Convert to bytes.
 
@@ -413,7 +613,8 @@ class GenericRecordData(RecordData):
             offset (int): offset in message.
             rdlength (int): length of rdata.
         """
-        data = packet[offset:offset + rdlength]
+        # copied, the packet may be a view of a buffer which is reused
+        data = bytes(packet[offset:offset + rdlength])
         return cls(data)
 
     def to_dict(self):
@@ -6,13 +6,18 @@ This module provides a recursive DNS server. You will have to implement this
 server using the algorithm described in section 4.3.2 of RFC 1034.
 """
 import copy
+import queue
 import socket
 import threading
 from threading import Thread
 
+from dns.cache import InfrastructureCache
+from dns.datagram import DatagramBatcher
 from dns.message import Message, Header
 from dns.name import Name
-from dns.resolver import Resolver
+from dns.rcodes import RCode
+from dns.resolver import Forwarder, NoData, QueryCoalescer, Resolver
+from dns.transport import SocketPool, TCPPool
 from dns.types import Type
 from dns.zone import Catalog
 
@@ -28,41 +33,83 @@ class RequestHandler(Thread):
         self.data = data
         self.address = address
 
-    def lookup_zone(self, domain):
+    @staticmethod
+    def lookup_zone(domain):
         """Look for a record in the zone files."""
         for i in range(len(domain.labels) + 1):
             zone = ".".join(domain.labels[i:]) + "."
             if zone in Server.catalog.zones:
                 name = str(domain)[:str(domain).rfind(zone)]
                 if name in Server.catalog.zones[zone].records:
-                    records = copy.deepcopy(Server.catalog.zones[zone].records[name])
+                    records = copy.deepcopy(
+                        Server.catalog.zones[zone].records[name]
+                    )
                     for record in records:
                         record.name = domain
                         if record.type_ is Type.CNAME:
                             cname = record.rdata.cname
                             cname.labels += zone.split(".")[:-1]
-                            records += self.lookup_zone(cname)[1]
+                            records += (
+                                RequestHandler.lookup_zone(cname)[1] or []
+                            )
                     return True, records
                 else:
                     return True, None
         return False, None
 
-    def send_response(self, records, authoritative, error=0):
-        """Send a response to some message."""
-        if not error and len(records) == 0:
+    @staticmethod
+    def answer_from_zone(question):
+        """Answer a question from the zone files
+
+        Args:
+            question (Question): the question
+
+        Returns:
+            (bool, [ResourceRecord]): whether the answer is authoritative,
+                and the records of the question type and CNAME records, a
+                NoData if the name has none, or None if the zones do not
+                have the name
+        """
+        authoritative, records = RequestHandler.lookup_zone(question.qname)
+        if records is not None and question.qtype is not Type.ANY:
+            records = [
+                record for record in records
+                if record.type_ in (question.qtype, Type.CNAME)
+            ] or NoData()
+        return authoritative, records
+
+    @staticmethod
+    def make_response(message, records, authoritative, error=0):
+        """Create the response to a message
+
+        Args:
+            message (Message): the query
+            records ([ResourceRecord]): the answer
+            authoritative (bool): whether the answer is authoritative
+            error (int): the RCODE, a name error is used if there are no
+                records and they are not a NoData
+
+        Returns:
+            Message: the response
+        """
+        if not error and len(records) == 0 and not isinstance(records, NoData):
             error = 3  # NXDOMAIN (Domain Name not found)
         if error != 0:
-            header = Header(self.message.header.ident, 0, 0, 0, 0, 0)
+            header = Header(message.header.ident, 0, 0, 0, 0, 0)
             header.rcode = error
         else:
-            header = Header(
-                self.message.header.ident, 0, 0, len(records), 0, 0
-            )
+            header = Header(message.header.ident, 0, 0, len(records), 0, 0)
         header.aa = authoritative  # Authoritative Answer
         header.qr = 1  # Message is Response
-        header.rd = self.message.header.rd  # Recursion desired
+        header.rd = message.header.rd  # Recursion desired
         header.ra = 1  # Recursion Available
-        response = Message(header, answers=records)
+        return Message(header, answers=records)
+
+    def send_response(self, records, authoritative, error=0):
+        """Send a response to some message."""
+        response = RequestHandler.make_response(
+            self.message, records, authoritative, error
+        )
         self.sock.sendto(response.to_bytes(), self.address)
 
     def run(self):
@@ -74,47 +121,229 @@ class RequestHandler(Thread):
             self.send_response([], False, 1)
             return
         self.domain = self.message.questions[0].qname
+        self.qtype = self.message.questions[0].qtype
+        self.qclass = self.message.questions[0].qclass
         print(threading.current_thread())
         print("\tDomain:", self.domain)
         print("\tAddress:", self.address)
-        authoritative, records = self.lookup_zone(self.domain)
+        authoritative, records = RequestHandler.answer_from_zone(
+            self.message.questions[0]
+        )
         if records is None:
             if self.message.header.rd:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                resolver = Resolver(5, Server.cache)
-                records = resolver.query_recursive(
-                    sock, self.domain, Resolver.root_server
-                )
-                sock.close()
+                if Server.upstreams is not None:
+                    # the fanout of a forwarder is the number of upstreams
+                    resolver = Forwarder(
+                        5, Server.upstreams, Server.cache,
+                        stagger_delay=Server.stagger_delay,
+                        coalescer=Server.coalescer,
+                        max_queries=Server.max_queries,
+                        time_limit=Server.time_limit, pool=Server.pool,
+                        tcp=Server.tcp,
+                    )
+                else:
+                    resolver = Resolver(
+                        5, Server.cache, stagger_delay=Server.stagger_delay,
+                        fanout=Server.fanout, infra=Server.infra,
+                        coalescer=Server.coalescer,
+                        max_queries=Server.max_queries,
+                        time_limit=Server.time_limit, pool=Server.pool,
+                        tcp=Server.tcp,
+                    )
+                try:
+                    records = resolver.query_recursive(
+                        None, self.domain, type_=self.qtype,
+                        class_=self.qclass,
+                    )
+                except OSError:
+                    self.send_response([], False, 2)  # SERVFAIL
+                    return
             else:
                 records = []
         self.send_response(records, authoritative)
 
 
+class WorkerPool:
+    """A fixed number of threads handling requests from a bounded queue"""
+
+    def __init__(self, workers, queue_size):
+        """Start the worker threads
+
+        Args:
+            workers (int): number of threads
+            queue_size (int): maximum number of waiting requests
+        """
+        self.queue = queue.Queue(queue_size)
+        self.threads = []
+        for _ in range(workers):
+            thread = Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, handler):
+        """Queue a request
+
+        Args:
+            handler (RequestHandler): handler for the request, which is run
+                by a worker instead of being started as a thread
+
+        Returns:
+            bool: whether the request was queued, False if the queue is full
+        """
+        try:
+            self.queue.put_nowait(handler)
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        """Handle requests until the pool is stopped"""
+        while True:
+            handler = self.queue.get()
+            if handler is None:
+                return
+            try:
+                handler.run()
+            except Exception as e:
+                print("could not handle request:", e)
+
+    def stop(self):
+        """Stop the workers after the queued requests"""
+        for _ in self.threads:
+            self.queue.put(None)
+
+
+SHED_POLICIES = {
+    "drop": None,
+    "servfail": RCode.ServFail,
+    "refused": RCode.Refused,
+}
+
+
 class Server:
-    """A recursive DNS server"""
+    """A recursive DNS server
+
+    Every request is handled by a new RequestHandler thread, or, if workers
+    is set, by a WorkerPool. When the queue of the pool is full, requests
+    are shed: dropped, or answered with SERVFAIL or REFUSED. If batch is
+    set, datagrams are received and replies are sent in batches by a
+    DatagramBatcher.
+    """
 
     cache = None
     catalog = Catalog()
+    infra = InfrastructureCache()
+    coalescer = QueryCoalescer()
+    pool = None
+    tcp = TCPPool()
+    upstreams = None
+    # see Resolver.__init__
+    stagger_delay = 0.2
+    fanout = 3
+    max_queries = 100
+    time_limit = 10
 
-    def __init__(self, port):
+    def __init__(self, port, workers=0, queue_size=1024, shed="servfail",
+                 reuse_port=False, batch=0):
         """Initialize the server
 
         Args:
             port (int): port that server is listening on
+            workers (int): number of worker threads, a thread is started
+                for every request if 0
+            queue_size (int): maximum number of requests waiting for a
+                worker
+            shed (str): what happens to requests which do not fit in the
+                queue, one of SHED_POLICIES
+            reuse_port (bool): whether to set SO_REUSEPORT, so several
+                processes can serve the same port
+            batch (int): maximum number of datagrams received or sent with
+                one system call, datagrams are not batched if 0
         """
         self.port = port
         self.done = False
+        self.workers = workers
+        self.queue_size = queue_size
+        self.shed_rcode = SHED_POLICIES[shed]
+        self.workerpool = None
+        self.shed = 0
+        self.reuse_port = reuse_port
+        self.batch = batch
+        self.batcher = None
 
     def serve(self):
         """Start serving requests"""
+        if Server.pool is None:
+            Server.pool = SocketPool()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.bind(("127.0.0.1", self.port))
+        self.output = self.sock
+        if self.batch > 0:
+            self.batcher = DatagramBatcher(self.sock, self.batch)
+            self.output = self.batcher
+        if self.workers > 0:
+            self.workerpool = WorkerPool(self.workers, self.queue_size)
         while not self.done:
-            data, address = self.sock.recvfrom(1024)
-            RequestHandler(self.sock, data, address).start()
+            try:
+                datagrams = self.receive()
+            except OSError:
+                if self.done:
+                    break
+                raise
+            for data, address in datagrams:
+                if self.done:
+                    break
+                handler = RequestHandler(self.output, data, address)
+                if self.workerpool is None:
+                    handler.start()
+                elif not self.workerpool.submit(handler):
+                    self.shed_request(data, address)
+
+    def receive(self):
+        """Receive the next datagrams
+
+        Returns:
+            [(bytes, (str, int))]: the datagrams and their source addresses
+        """
+        if self.batcher is not None:
+            return self.batcher.receive()
+        return [self.sock.recvfrom(1024)]
+
+    def shed_request(self, data, address):
+        """Reject a request for which there is no room in the queue
+
+        Args:
+            data (bytes): the request
+            address ((str, int)): address of the client
+        """
+        self.shed += 1
+        if self.shed_rcode is None:
+            return
+        try:
+            message = Message.from_bytes(data)
+        except (ValueError, IndexError):
+            return
+        response = RequestHandler.make_response(
+            message, [], False, self.shed_rcode
+        )
+        try:
+            self.output.sendto(response.to_bytes(), address)
+        except OSError:
+            pass
 
     def shutdown(self):
         """Shut the server down"""
         self.done = True
+        try:
+            # wakes up the thread blocked in recvfrom
+            self.sock.sendto(b"", self.sock.getsockname())
+        except OSError:
+            pass
+        if self.batcher is not None:
+            self.batcher.close()
         self.sock.close()
+        if self.workerpool is not None:
+            self.workerpool.stop()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""Supervisor for multi-process servers
+
+This module contains a supervisor which runs a server in a number of forked
+worker processes. The workers bind the same port with SO_REUSEPORT, so the
+kernel spreads the incoming datagrams over them and the server can use all
+cores of the machine. Workers which die are restarted.
+"""
+
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+
+class Supervisor:
+    """Runs a function in worker processes and restarts them when they die"""
+
+    def __init__(self, workers, target, restart_delay=1.0, on_exit=None):
+        """Initialize the supervisor
+
+        Args:
+            workers (int): number of worker processes
+            target (callable): function run by every worker
+            restart_delay (float): seconds to wait before restarting a
+                worker, so a worker which keeps crashing does not spin
+            on_exit (callable): called with the process ID of a worker
+                which died, before it is restarted
+        """
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.on_exit = on_exit
+        self.context = multiprocessing.get_context("fork")
+        self.processes = []
+        self.restarts = 0
+        self.done = False
+
+    def spawn(self):
+        """Fork a worker process
+
+        Returns:
+            multiprocessing.Process: the worker
+        """
+        process = self.context.Process(target=self.target)
+        process.daemon = True
+        process.start()
+        return process
+
+    def run(self):
+        """Start the workers and restart them until shutdown is called"""
+        self.processes = [self.spawn() for _ in range(self.workers)]
+        try:
+            while not self.done:
+                wait([process.sentinel for process in self.processes], 1)
+                for i, process in enumerate(self.processes):
+                    if process.is_alive() or self.done:
+                        continue
+                    process.join()
+                    if self.on_exit is not None:
+                        self.on_exit(process.pid)
+                    time.sleep(self.restart_delay)
+                    if not self.done:
+                        self.restarts += 1
+                        self.processes[i] = self.spawn()
+        except KeyboardInterrupt:
+            # the workers were interrupted as well, let them finish
+            self.done = True
+            for process in self.processes:
+                process.join(5)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Stop the workers"""
+        self.done = True
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def pids(self):
+        """Get the process IDs of the workers
+
+        Returns:
+            [int]: the process IDs
+        """
+        return [process.pid for process in self.processes]
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+"""Transports for upstream queries
+
+This module contains a pool of UDP sockets which is shared by all
+resolutions of a process. Every socket is bound to a random source port and
+has a thread which receives its responses. A response is only delivered if
+its transaction ID, source address and question match a query that is
+waiting for it, which makes spoofed responses hard to get accepted.
+
+Truncated responses are retried over TCP, using a pool of persistent
+connections.
+
+Responses are received into a buffer which is reused for every datagram
+and parsed from there, since a parsed Message does not refer to the data it
+was parsed from.
+"""
+
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from dns.message import Message
+
+
+class SocketChannel:
+    """Sends queries and receives responses on a single socket"""
+
+    def __init__(self, sock):
+        """Initialize the channel
+
+        Args:
+            sock (socket): UDP socket
+        """
+        self.sock = sock
+        self.timeout = sock.gettimeout()
+        self.buffer = bytearray(65535)
+
+    def send(self, query, addr):
+        """Send a query
+
+        Args:
+            query (Message): the query
+            addr ((str, int)): address of the nameserver
+        """
+        self.sock.sendto(query.to_bytes(), addr)
+
+    def receive(self, timeout):
+        """Receive a response
+
+        Args:
+            timeout (float): maximum time to wait
+
+        Returns:
+            (Message, (str, int)): the response and its source address, or
+                None if a datagram was received that is not a response
+
+        Raises:
+            socket.timeout: if nothing was received in time
+        """
+        self.sock.settimeout(timeout)
+        length, addr = self.sock.recvfrom_into(self.buffer)
+        try:
+            return Message.from_bytes(
+                memoryview(self.buffer)[:length]
+            ), addr[:2]
+        except (ValueError, IndexError):
+            return None
+
+    def close(self):
+        """Restore the timeout of the socket"""
+        self.sock.settimeout(self.timeout)
+
+
+class PoolChannel:
+    """Sends queries and receives responses through a SocketPool"""
+
+    def __init__(self, pool):
+        """Initialize the channel
+
+        Args:
+            pool (SocketPool): the pool
+        """
+        self.pool = pool
+        self.responses = queue.Queue()
+        self.sent = []
+
+    def send(self, query, addr):
+        """Send a query on a random socket of the pool
+
+        The transaction ID of the query is changed if another query to the
+        same nameserver with the same ID is waiting on that socket.
+
+        Args:
+            query (Message): the query
+            addr ((str, int)): address of the nameserver
+        """
+        upstream = random.choice(self.pool.sockets)
+        upstream.send(query, addr, self.responses)
+        self.sent.append((upstream, query.header.ident, addr))
+
+    def receive(self, timeout):
+        """Receive a response to one of the queries of this channel
+
+        Args:
+            timeout (float): maximum time to wait
+
+        Returns:
+            (Message, (str, int)): the response and its source address
+
+        Raises:
+            socket.timeout: if nothing was received in time
+        """
+        try:
+            return self.responses.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout("timed out")
+
+    def close(self):
+        """Stop waiting for responses to the queries of this channel"""
+        for upstream, ident, addr in self.sent:
+            upstream.cancel(ident, addr)
+        self.sent = []
+
+
+class UpstreamSocket:
+    """A UDP socket on a random port with a thread receiving responses"""
+
+    def __init__(self, address="0.0.0.0", ports=(1024, 65535)):
+        """Bind the socket and start the receiving thread
+
+        Args:
+            address (str): local address
+            ports ((int, int)): range from which the port is chosen
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(0.5)
+        rng = random.SystemRandom()
+        for _ in range(100):
+            try:
+                self.sock.bind((address, rng.randint(*ports)))
+                break
+            except OSError:
+                continue
+        else:
+            self.sock.bind((address, 0))
+        self.port = self.sock.getsockname()[1]
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.done = False
+        self.dropped = 0
+        self.buffer = bytearray(65535)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, query, addr, responses):
+        """Send a query
+
+        Args:
+            query (Message): the query
+            addr ((str, int)): address of the nameserver
+            responses (queue.Queue): receives (response, address)
+        """
+        with self.lock:
+            while (query.header.ident, addr) in self.pending:
+                query.header.ident = (query.header.ident + 1) % 2**16
+            self.pending[(query.header.ident, addr)] = (
+                query.questions[0], responses
+            )
+        try:
+            self.sock.sendto(query.to_bytes(), addr)
+        except OSError:
+            self.cancel(query.header.ident, addr)
+            raise
+
+    def cancel(self, ident, addr):
+        """Stop waiting for the response to a query"""
+        with self.lock:
+            self.pending.pop((ident, addr), None)
+
+    def run(self):
+        """Receive responses and hand them to the waiting queries"""
+        view = memoryview(self.buffer)
+        while not self.done:
+            try:
+                length, addr = self.sock.recvfrom_into(self.buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                response = Message.from_bytes(view[:length])
+            except (ValueError, IndexError):
+                continue
+            key = (response.header.ident, addr[:2])
+            with self.lock:
+                waiter = self.pending.get(key)
+                if waiter is not None and self.matches(waiter[0], response):
+                    del self.pending[key]
+                else:
+                    waiter = None
+                    self.dropped += 1
+            if waiter is not None:
+                waiter[1].put((response, addr[:2]))
+
+    @staticmethod
+    def matches(question, response):
+        """Check whether a response answers a question"""
+        if not response.questions:
+            return True
+        answered = response.questions[0]
+        return (
+            answered.qname == question.qname and
+            answered.qtype == question.qtype and
+            answered.qclass == question.qclass
+        )
+
+    def close(self):
+        """Close the socket and stop the receiving thread"""
+        self.done = True
+        self.sock.close()
+
+
+class SocketPool:
+    """A pool of UDP sockets shared by all resolutions
+
+    Every query is sent on a randomly chosen socket of the pool.
+    """
+
+    def __init__(self, size=8, address="0.0.0.0"):
+        """Create the sockets of the pool
+
+        Args:
+            size (int): number of sockets
+            address (str): local address
+        """
+        self.sockets = [UpstreamSocket(address) for _ in range(size)]
+
+    def channel(self):
+        """Get a channel for the queries of one resolution step
+
+        Returns:
+            PoolChannel: the channel, which has to be closed after use
+        """
+        return PoolChannel(self)
+
+    def stats(self):
+        """Get the pool counters
+
+        Returns:
+            dict: number of sockets and of dropped unexpected responses
+        """
+        return {
+            "sockets": len(self.sockets),
+            "dropped": sum(upstream.dropped for upstream in self.sockets),
+        }
+
+    def close(self):
+        """Close all sockets of the pool"""
+        for upstream in self.sockets:
+            upstream.close()
+
+
+class TCPPool:
+    """Persistent TCP connections to nameservers
+
+    Used for queries whose UDP response was truncated. After a query, the
+    connection is kept open for the next query to the same nameserver, so
+    repeated large lookups skip the handshake. See RFC 7766. Idle
+    connections are closed after max_age seconds, and when more than
+    max_total are open, the least recently used ones are closed.
+    """
+
+    def __init__(self, max_idle=2, max_total=32, max_age=10.0):
+        """Initialize the pool
+
+        Args:
+            max_idle (int): maximum number of idle connections kept open
+                per nameserver
+            max_total (int): maximum number of idle connections kept open
+            max_age (float): seconds after which an idle connection is
+                closed
+        """
+        self.max_idle = max_idle
+        self.max_total = max_total
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.idle = OrderedDict()
+        self.connects = 0
+        self.reuses = 0
+        self.evicted = 0
+
+    def query(self, query, addr, timeout):
+        """Send a query over TCP and receive the response
+
+        A reused connection may have been closed by the nameserver in the
+        meantime, in which case the query is retried on a new connection.
+
+        Args:
+            query (Message): the query
+            addr ((str, int)): address of the nameserver
+            timeout (float): timeout for connecting and for the response
+
+        Returns:
+            Message: the response
+
+        Raises:
+            socket.timeout: if the nameserver did not respond in time
+            OSError: if the connection failed
+        """
+        data = query.to_bytes()
+        data = struct.pack("!H", len(data)) + data
+        while True:
+            sock = self.acquire(addr)
+            reused = sock is not None
+            if sock is None:
+                sock = socket.create_connection(addr, timeout)
+                self.connects += 1
+            else:
+                self.reuses += 1
+            try:
+                sock.settimeout(timeout)
+                sock.sendall(data)
+                length = struct.unpack("!H", TCPPool.recv_exactly(sock, 2))
+                response = Message.from_bytes(
+                    TCPPool.recv_exactly(sock, length[0])
+                )
+            except (OSError, EOFError) as e:
+                sock.close()
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                if isinstance(e, EOFError):
+                    raise ConnectionError("connection closed") from e
+                raise
+            except ValueError as e:
+                sock.close()
+                raise ConnectionError("malformed response") from e
+            if response.header.ident != query.header.ident:
+                sock.close()
+                raise ConnectionError("response does not match query")
+            self.release(addr, sock)
+            return response
+
+    def acquire(self, addr):
+        """Take the most recently used idle connection to a nameserver
+
+        Connections which have been idle for too long are closed first.
+
+        Args:
+            addr ((str, int)): address of the nameserver
+
+        Returns:
+            socket: the connection, or None if there is none
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                sock, (_, since) = next(iter(self.idle.items()))
+                if now - since <= self.max_age:
+                    break
+                del self.idle[sock]
+                sock.close()
+                self.evicted += 1
+            for sock, (idle_addr, _) in reversed(self.idle.items()):
+                if idle_addr == addr:
+                    del self.idle[sock]
+                    return sock
+        return None
+
+    def release(self, addr, sock):
+        """Keep a connection open for the next query, or close it
+
+        Args:
+            addr ((str, int)): address of the nameserver
+            sock (socket): the connection
+        """
+        with self.lock:
+            idle = sum(1 for a, _ in self.idle.values() if a == addr)
+            if idle >= self.max_idle:
+                sock.close()
+                return
+            self.idle[sock] = (addr, time.monotonic())
+            while len(self.idle) > self.max_total:
+                sock, _ = self.idle.popitem(last=False)
+                sock.close()
+                self.evicted += 1
+
+    @staticmethod
+    def recv_exactly(sock, length):
+        """Receive an exact number of bytes from a stream socket
+
+        Raises:
+            EOFError: if the connection was closed
+        """
+        data = b""
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise EOFError("connection closed")
+            data += chunk
+        return data
+
+    def stats(self):
+        """Get the pool counters
+
+        Returns:
+            dict: number of new, of reused and of evicted connections
+        """
+        return {
+            "connects": self.connects,
+            "reuses": self.reuses,
+            "evicted": self.evicted,
+        }
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            for sock in self.idle:
+                sock.close()
+            self.idle = OrderedDict()
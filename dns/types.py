@@ -35,6 +35,7 @@ class Type(IntEnum):
     MX = 15
     TXT = 16
     AAAA = 28
+    OPT = 41
     ANY = 255
 
     def __str__(self):
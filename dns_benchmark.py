@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+""" DNS server benchmark
+
+Measures how many packets per second the server answers from its zone,
+with and without batched datagram I/O. The server runs in this process, the
+client runs in another process, so they do not share the interpreter lock.
+The client keeps a window of queries outstanding. The runs alternate, and
+the best run of each server is reported.
+"""
+
+import contextlib
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from argparse import ArgumentParser
+
+from dns.classes import Class
+from dns.message import Message, Question, Header
+from dns.name import Name
+from dns.server import Server
+from dns.transport import SocketPool
+from dns.types import Type
+from dns.zone import Zone
+
+
+def send_queries(address, count, window, results):
+    """Send queries to a server and measure the rate of the responses
+
+    Args:
+        address ((str, int)): address of the server
+        count (int): number of queries
+        window (int): number of outstanding queries
+        results (multiprocessing.Queue): receives the responses per second
+    """
+    query = Message(
+        Header(1, 0, 1, 0, 0, 0),
+        [Question(Name("server1.gumpe"), Type.A, Class.IN)]
+    ).to_bytes()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.settimeout(0.5)
+    sent = answered = 0
+    start = time.monotonic()
+    while answered < count:
+        while sent < count and sent - answered < window:
+            sock.sendto(query, address)
+            sent += 1
+        try:
+            sock.recv(1024)
+            answered += 1
+        except socket.timeout:
+            sent = answered  # the outstanding queries were lost
+    results.put(count / (time.monotonic() - start))
+    sock.close()
+
+
+def measure(batch, count, window, workers):
+    """Measure the packets per second of a server
+
+    Args:
+        batch (int): batch size of the server, 0 for no batching
+        count (int): number of queries
+        window (int): number of outstanding queries
+        workers (int): number of worker threads of the server
+
+    Returns:
+        (float, dict): answered queries per second, and the counters of the
+            batcher or None
+    """
+    server = Server(0, workers, queue_size=count, batch=batch)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    while getattr(server, "sock", None) is None:
+        time.sleep(0.01)
+    results = multiprocessing.get_context("spawn").Queue()
+    client = multiprocessing.get_context("spawn").Process(
+        target=send_queries,
+        args=(server.sock.getsockname(), count, window, results),
+    )
+    client.start()
+    pps = results.get()
+    client.join()
+
+    stats = server.batcher.stats() if server.batcher is not None else None
+    server.shutdown()
+    thread.join()
+    return pps, stats
+
+
+def run_benchmark():
+    parser = ArgumentParser(description="DNS Server Benchmark")
+    parser.add_argument(
+        "-n", "--count", type=int, default=20000,
+        help="Number of queries per run",
+    )
+    parser.add_argument(
+        "--window", type=int, default=64,
+        help="Number of outstanding queries",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2,
+        help="Number of worker threads of the server",
+    )
+    parser.add_argument(
+        "--batch", type=int, default=32,
+        help="Batch size of the batched run",
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=3,
+        help="Number of runs of each server, the best run is reported",
+    )
+    args = parser.parse_args()
+    # both runs must produce a result for the comparison
+    if args.batch < 1:
+        parser.error("--batch must be at least 1")
+    if args.rounds < 1:
+        parser.error("--rounds must be at least 1")
+
+    zone = Zone()
+    zone.read_master_file("zone")
+    Server.catalog.add_zone("gumpe.", zone)
+    Server.pool = SocketPool(1)
+    results = {}
+    # the request handlers print every request
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            for _ in range(args.rounds):
+                for batch in (0, args.batch):
+                    result = measure(
+                        batch, args.count, args.window, args.workers
+                    )
+                    if batch not in results or result[0] > results[batch][0]:
+                        results[batch] = result
+    Server.pool.close()
+
+    for batch, (pps, stats) in results.items():
+        name = "batched ({})".format(batch) if batch else "unbatched"
+        print("{:>14}: {:8.0f} packets/s".format(name, pps))
+        if stats is not None:
+            print("{:>14}  {}".format("", stats))
+    print("{:>14}: {:8.2f}x".format(
+        "speedup", results[args.batch][0] / results[0][0]
+    ))
+
+
+if __name__ == "__main__":
+    run_benchmark()
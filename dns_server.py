@@ -5,10 +5,15 @@
 This script contains the code for starting a DNS server.
 """
 
+import asyncio
 from argparse import ArgumentParser
 
-from dns.cache import RecordCache
-from dns.server import Server
+from dns.asyncserver import AsyncServer
+from dns.cache import POLICIES, CacheCheckpointer, RecordCache, SharedCache
+from dns.resolver import HealthChecker, Prefetcher, UpstreamGroup
+from dns.server import SHED_POLICIES, Server
+from dns.supervisor import Supervisor
+from dns.transport import SocketPool
 from dns.zone import Zone
 
 
@@ -22,29 +27,237 @@ def run_server():
         "-t", "--ttl", metavar="time", type=int, default=0,
         help="TTL value of cached entries (if > 0)",
     )
+    parser.add_argument(
+        "--max-entries", metavar="count", type=int, default=0,
+        help="Maximum number of cached records (if > 0)",
+    )
+    parser.add_argument(
+        "--max-bytes", metavar="size", type=int, default=0,
+        help="Maximum size of cached records in bytes (if > 0)",
+    )
+    parser.add_argument(
+        "--eviction", choices=sorted(POLICIES), default="lru",
+        help="Eviction policy used when the cache is full",
+    )
+    parser.add_argument(
+        "--segments", metavar="count", type=int, default=16,
+        help="Number of lock-striped cache segments",
+    )
+    parser.add_argument(
+        "--checkpoint", metavar="seconds", type=float, default=0,
+        help="Interval between cache checkpoints (if > 0)",
+    )
+    parser.add_argument(
+        "--prefetch", action="store_true",
+        help="Refresh popular cache entries before they expire",
+    )
+    parser.add_argument(
+        "--prefetch-hits", metavar="count", type=int, default=3,
+        help="Hits after which a cache entry is prefetched",
+    )
+    parser.add_argument(
+        "--prefetch-fraction", metavar="fraction", type=float, default=0.1,
+        help="Fraction of the TTL left at which an entry is prefetched",
+    )
+    parser.add_argument(
+        "--prefetch-budget", metavar="count", type=int, default=4,
+        help="Maximum number of concurrent prefetches",
+    )
+    parser.add_argument(
+        "--serve-stale", metavar="seconds", type=int, default=0,
+        help="Serve cache entries up to this long after they expire when "
+             "upstream servers fail (if > 0)",
+    )
+    parser.add_argument(
+        "--sockets", metavar="count", type=int, default=8,
+        help="Number of UDP sockets used for upstream queries",
+    )
+    parser.add_argument(
+        "--stagger-delay", metavar="seconds", type=float, default=0.2,
+        help="Time to wait for a nameserver before also querying the next",
+    )
+    parser.add_argument(
+        "--fanout", metavar="count", type=int, default=3,
+        help="Maximum number of nameservers queried for one step of a "
+             "resolution",
+    )
+    parser.add_argument(
+        "--max-queries", metavar="count", type=int, default=100,
+        help="Maximum number of queries sent for one resolution",
+    )
+    parser.add_argument(
+        "--time-limit", metavar="seconds", type=float, default=10,
+        help="Maximum duration of one resolution",
+    )
+    parser.add_argument(
+        "--forward", metavar="address", nargs="+",
+        help="Forward queries to these recursive servers instead of "
+             "resolving iteratively",
+    )
+    parser.add_argument(
+        "--forward-port", metavar="port", type=int, default=53,
+        help="Port of the recursive servers",
+    )
+    parser.add_argument(
+        "--health-interval", metavar="seconds", type=float, default=10,
+        help="Interval between health checks of the recursive servers",
+    )
+    parser.add_argument(
+        "--asyncio", action="store_true",
+        help="Handle requests in an asyncio event loop instead of a thread "
+             "per request",
+    )
+    parser.add_argument(
+        "--workers", metavar="count", type=int, default=0,
+        help="Number of worker threads (if > 0, otherwise a thread is "
+             "started per request)",
+    )
+    parser.add_argument(
+        "--queue-size", metavar="count", type=int, default=1024,
+        help="Maximum number of requests waiting for a worker",
+    )
+    parser.add_argument(
+        "--shed", choices=sorted(SHED_POLICIES), default="servfail",
+        help="What to do with requests when the queue is full",
+    )
+    parser.add_argument(
+        "--batch", metavar="count", type=int, default=0,
+        help="Maximum number of datagrams received or sent per system call "
+             "(if > 0)",
+    )
+    parser.add_argument(
+        "--processes", metavar="count", type=int, default=1,
+        help="Number of server processes sharing the port with "
+             "SO_REUSEPORT",
+    )
+    parser.add_argument(
+        "--shared-cache", action="store_true",
+        help="Share cached records between the server processes",
+    )
+    parser.add_argument(
+        "--shared-slots", metavar="count", type=int, default=65536,
+        help="Number of RRsets which fit in the shared cache",
+    )
     parser.add_argument(
         "-p", "--port", type=int, default=53,
         help="Port which server listens on",
     )
     args = parser.parse_args()
+    if args.asyncio and args.forward:
+        parser.error("--forward is not supported with --asyncio")
+    if args.asyncio and args.batch:
+        parser.error("--batch is not supported with --asyncio")
+    if 0 < args.max_entries < args.segments:
+        parser.error("--max-entries must be at least --segments")
+    if 0 < args.max_bytes < args.segments:
+        parser.error("--max-bytes must be at least --segments")
+    if args.fanout < 1 or args.max_queries < 1:
+        parser.error("--fanout and --max-queries must be at least 1")
 
     zone = Zone()
     zone.read_master_file("zone")
     Server.catalog.add_zone("gumpe.", zone)
+    shared = None
+    if args.shared_cache:
+        shared = SharedCache(args.shared_slots)
+
+    if args.processes > 1:
+        supervisor = Supervisor(
+            args.processes, lambda: serve(args, shared),
+            on_exit=shared.recover if shared is not None else None,
+        )
+        supervisor.run()
+        print("Restarts:", supervisor.restarts)
+    else:
+        serve(args, shared)
+
+
+def serve(args, shared=None):
+    """Run the server in this process
+
+    Args:
+        args (Namespace): the command line arguments
+        shared (SharedCache): cache shared with other server processes
+    """
+    # the processes of a multi-process server would race on the cache files
+    persistent = args.processes == 1
+    Server.pool = SocketPool(args.sockets)
+    Server.stagger_delay = args.stagger_delay
+    Server.fanout = args.fanout
+    Server.max_queries = args.max_queries
+    Server.time_limit = args.time_limit
+    if args.forward:
+        Server.upstreams = UpstreamGroup(
+            args.forward, args.forward_port, Server.infra
+        )
+        checker = HealthChecker(Server.upstreams, args.health_interval)
+        checker.start()
 
     if args.caching:
-        cache = RecordCache(args.ttl)
-        cache.read_cache_file()
+        cache = RecordCache(
+            args.ttl, args.max_entries, args.max_bytes, args.eviction,
+            args.segments,
+        )
         Server.cache = cache
+        if shared is not None:
+            cache.enable_shared(shared)
+        prefetcher = Prefetcher(
+            cache, budget=args.prefetch_budget, infra=Server.infra,
+            pool=Server.pool, upstreams=Server.upstreams,
+        )
+        if args.prefetch:
+            cache.enable_prefetch(
+                prefetcher, args.prefetch_hits, args.prefetch_fraction
+            )
+        if args.serve_stale > 0:
+            cache.enable_serve_stale(args.serve_stale, prefetcher)
+        checkpointer = None
+        if persistent:
+            cache.read_cache_file()
+            cache.read_journal()
+            # the journal is only enabled when something drains it
+            if args.checkpoint > 0:
+                checkpointer = CacheCheckpointer(cache, args.checkpoint)
+                checkpointer.start()
 
-    server = Server(args.port)
-    try:
-        server.serve()
-    except KeyboardInterrupt:
-        server.shutdown()
+    if args.asyncio:
+        server = AsyncServer(args.port, reuse_port=not persistent)
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
+        print("Requests:", server.stats())
+    else:
+        server = Server(
+            args.port, args.workers, args.queue_size, args.shed,
+            reuse_port=not persistent, batch=args.batch,
+        )
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            server.shutdown()
+        if args.workers > 0:
+            print("Shed:", server.shed)
+        if server.batcher is not None:
+            print("Batches:", server.batcher.stats())
 
+    print("Coalesced:", Server.coalescer.coalesced)
+    print("Sockets:", Server.pool.stats())
+    print("TCP:", Server.tcp.stats())
+    if args.forward:
+        checker.stop()
+        print("Upstreams:", {
+            ip: Server.infra.get(ip) for ip in Server.upstreams.ips
+        })
+    Server.pool.close()
     if args.caching:
-        cache.write_cache_file()
+        if checkpointer is not None:
+            checkpointer.stop()
+        elif persistent:
+            cache.write_cache_file()
+        print("Cache:", cache.stats())
+        if args.prefetch or args.serve_stale > 0:
+            print("Prefetch:", prefetcher.stats())
 
 if __name__ == "__main__":
     run_server()
@@ -2,24 +2,167 @@
 
 """Tests for your DNS resolver and server"""
 
+import asyncio
+import os
 import socket
 import sys
+import tempfile
+import time
+import threading
 import unittest
 from unittest import TestCase
+from unittest.mock import patch
 from argparse import ArgumentParser
 
+from dns.asyncresolver import AsyncResolver
+from dns.asyncserver import AsyncServer
 from dns.message import Message, Question, Header
-from dns.cache import RecordCache
+from dns.cache import CacheCheckpointer, InfrastructureCache, RecordCache, \
+    SharedCache
 from dns.classes import Class
+from dns.datagram import DatagramBatcher
 from dns.name import Name
-from dns.resolver import Resolver
-from dns.resource import ResourceRecord, ARecordData, CNAMERecordData
+from dns.resolver import BudgetExceeded, Forwarder, HealthChecker, \
+    NoData, Prefetcher, QueryCoalescer, ResolutionFailed, Resolver, \
+    UpstreamGroup
+from dns.rcodes import RCode
+from dns.server import RequestHandler, Server
+from dns.supervisor import Supervisor
+from dns.resource import ResourceRecord, AAAARecordData, ARecordData, \
+    CNAMERecordData, GenericRecordData, MXRecordData, NSRecordData, \
+    SOARecordData
+from dns.transport import SocketPool, TCPPool
 from dns.types import Type
 
 PORT = 53
 SERVER = "localhost"
 
 
+class FakeNameserver(threading.Thread):
+    """Authoritative nameserver on localhost for offline tests
+
+    Answers A and AAAA queries for the names in records and returns a name
+    error for all other names. A name mapped to a string is answered with a
+    CNAME record pointing to it. If referral is given as (nameserver,
+    glue), every query is answered with a referral instead. If tcp is set,
+    the nameserver also listens on TCP and truncates all UDP responses. If
+    rcode is given, every query is answered with that RCODE. If edns is
+    False, queries with an OPT record are answered with FORMERR.
+    """
+
+    def __init__(self, records, delay=0, address="127.0.0.1", port=0,
+                 referral=None, tcp=False, rcode=None, edns=True):
+        super().__init__()
+        self.daemon = True
+        self.records = records
+        self.referral = referral
+        self.rcode = rcode
+        self.edns = edns
+        self.rd = None
+        self.delay = delay
+        self.queries = 0
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.port = self.sock.getsockname()[1]
+        self.listener = None
+        if tcp:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.bind((address, self.port))
+            self.listener.listen()
+            thread = threading.Thread(target=self.serve_tcp)
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(512)
+            except OSError:
+                return
+            self.queries += 1
+            response = self.respond(Message.from_bytes(data))
+            if self.listener is not None:
+                response.header.tc = 1
+                response.header.an_count = 0
+                response.answers = []
+            time.sleep(self.delay)
+            try:
+                self.sock.sendto(response.to_bytes(), address)
+            except OSError:
+                return  # closed while delaying
+
+    def serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            with conn:
+                while True:
+                    length = conn.recv(2)
+                    if len(length) < 2:
+                        break
+                    data = conn.recv(int.from_bytes(length, "big"))
+                    self.queries += 1
+                    data = self.respond(Message.from_bytes(data)).to_bytes()
+                    conn.sendall(len(data).to_bytes(2, "big") + data)
+
+    def respond(self, query):
+        self.rd = query.header.rd
+        qname = query.questions[0].qname
+        qtype = query.questions[0].qtype
+        target = self.records.get(str(qname).lower())
+        if isinstance(target, str):
+            answers = [ResourceRecord(qname, Type.CNAME, Class.IN, 60,
+                                      CNAMERecordData(Name(target)))]
+        else:
+            answers = [
+                ResourceRecord(qname, Type.A, Class.IN, 60,
+                               ARecordData(address_))
+                if qtype is Type.A else
+                ResourceRecord(qname, Type.AAAA, Class.IN, 60,
+                               AAAARecordData(address_))
+                for address_ in target or []
+                if qtype is (Type.AAAA if ":" in address_ else Type.A)
+            ]
+        header = Header(query.header.ident, 0, 1, len(answers), 0, 0)
+        header.qr = 1
+        header.aa = 1
+        if target is None:
+            header.rcode = RCode.NXDomain
+        response = Message(header, query.questions, answers)
+        if self.referral is not None:
+            nsdname, glue = self.referral
+            response.header = Header(query.header.ident, 0, 1, 0, 1,
+                                     int(glue is not None))
+            response.header.qr = 1
+            response.answers = []
+            response.authorities = [ResourceRecord(
+                Name("gumpe"), Type.NS, Class.IN, 60,
+                NSRecordData(Name(nsdname)),
+            )]
+            if glue is not None:
+                response.additionals = [ResourceRecord(
+                    Name(nsdname), Type.A, Class.IN, 60,
+                    ARecordData(glue),
+                )]
+        rcode = self.rcode
+        if not self.edns and query.additionals:
+            rcode = RCode.FormErr
+        if rcode is not None:
+            response.header.rcode = rcode
+            response.header.an_count = 0
+            response.answers = []
+        return response
+
+    def close(self):
+        self.sock.close()
+        if self.listener is not None:
+            self.listener.close()
+
+
 class TestResolver(TestCase):
     """Resolver tests"""
 
@@ -77,7 +220,7 @@ class TestCache(TestCase):
         )
         cache.add_record(record)
         self.assertEqual(
-            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), record
+            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), [record]
         )
 
     def test_expired_cache_entry(self):
@@ -104,10 +247,402 @@ class TestCache(TestCase):
             rdata=ARecordData("1.0.0.1"),
         )
         cache.add_record(record)
-        cache_entry = cache.lookup(Name("bonobo.putin"), Type.A, Class.IN)
+        cache_entry, = cache.lookup(Name("bonobo.putin"), Type.A, Class.IN)
         self.assertEqual(cache_entry, record)
         self.assertEqual(cache_entry.ttl, 60)
 
+    def test_lookup_returns_rrset(self):
+        cache = RecordCache(0)
+        records = [
+            ResourceRecord(
+                name=Name("server1.gumpe"),
+                type_=Type.A,
+                class_=Class.IN,
+                ttl=60,
+                rdata=ARecordData(address),
+            )
+            for address in ("10.0.1.4", "10.0.1.5")
+        ]
+        cache.add_records(records)
+        cache.add_record(records[0])
+        self.assertCountEqual(
+            cache.lookup(Name("SERVER1.gumpe."), Type.A, Class.IN), records
+        )
+        self.assertEqual(
+            cache.lookup(Name("server1.gumpe"), Type.CNAME, Class.IN), None
+        )
+
+    def test_expired_entries_evicted_on_insert(self):
+        cache = RecordCache(0)
+        for i in range(10):
+            cache.add_record(ResourceRecord(
+                name=Name("host{}.putin".format(i)),
+                type_=Type.A,
+                class_=Class.IN,
+                ttl=0,
+                rdata=ARecordData("1.0.0.1"),
+            ))
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.all_records(), [])
+
+    def test_max_entries_lru(self):
+        cache = RecordCache(0, max_entries=2)
+        for name in ("a.putin", "b.putin"):
+            cache.add_record(ResourceRecord(
+                name=Name(name),
+                type_=Type.A,
+                class_=Class.IN,
+                ttl=60,
+                rdata=ARecordData("1.0.0.1"),
+            ))
+        cache.lookup(Name("a.putin"), Type.A, Class.IN)
+        cache.add_record(ResourceRecord(
+            name=Name("c.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.0.0.1"),
+        ))
+        self.assertIsNotNone(cache.lookup(Name("a.putin"), Type.A, Class.IN))
+        self.assertIsNone(cache.lookup(Name("b.putin"), Type.A, Class.IN))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_max_entries_lfu(self):
+        cache = RecordCache(0, max_entries=2, policy="lfu")
+        for name in ("a.putin", "b.putin"):
+            cache.add_record(ResourceRecord(
+                name=Name(name),
+                type_=Type.A,
+                class_=Class.IN,
+                ttl=60,
+                rdata=ARecordData("1.0.0.1"),
+            ))
+        cache.lookup(Name("b.putin"), Type.A, Class.IN)
+        cache.lookup(Name("b.putin"), Type.A, Class.IN)
+        cache.lookup(Name("a.putin"), Type.A, Class.IN)
+        cache.add_record(ResourceRecord(
+            name=Name("c.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.0.0.1"),
+        ))
+        self.assertIsNone(cache.lookup(Name("c.putin"), Type.A, Class.IN))
+        self.assertIsNotNone(cache.lookup(Name("a.putin"), Type.A, Class.IN))
+        self.assertIsNotNone(cache.lookup(Name("b.putin"), Type.A, Class.IN))
+
+    def test_max_bytes(self):
+        record = ResourceRecord(
+            name=Name("a.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.0.0.1"),
+        )
+        size = len(record.to_bytes(0, None))
+        cache = RecordCache(0, max_bytes=size)
+        cache.add_record(record)
+        self.assertEqual(cache.nbytes, size)
+        cache.add_record(ResourceRecord(
+            name=Name("b.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.0.0.1"),
+        ))
+        self.assertEqual(cache.size, 1)
+        self.assertEqual(cache.nbytes, size)
+
+    def test_limits_add_up(self):
+        cache = RecordCache(0, max_entries=10, max_bytes=100, segments=4)
+        self.assertEqual(
+            [segment.max_entries for segment in cache.segments],
+            [3, 3, 2, 2]
+        )
+        self.assertEqual(
+            sum(segment.max_bytes for segment in cache.segments), 100
+        )
+        with self.assertRaises(AssertionError):
+            RecordCache(0, max_entries=3, segments=4)
+
+    def test_concurrent_access(self):
+        cache = RecordCache(0, max_entries=64, segments=4)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(500):
+                    name = Name("host{}.putin".format((n * i) % 100))
+                    cache.add_record(ResourceRecord(
+                        name=name,
+                        type_=Type.A,
+                        class_=Class.IN,
+                        ttl=60,
+                        rdata=ARecordData("1.0.0.{}".format(n)),
+                    ))
+                    cache.lookup(name, Type.A, Class.IN)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=worker, args=(n,)) for n in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(cache.size, 64)
+        self.assertEqual(cache.size, len(cache.all_records()))
+        self.assertEqual(cache.stats()["hits"] + cache.stats()["misses"], 4000)
+
+    def test_negative_nodata(self):
+        cache = RecordCache(0)
+        cache.add_negative(Name("bonobo.putin"), Type.A, Class.IN, 60,
+                           RCode.NoError)
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), []
+        )
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.MX, Class.IN), None
+        )
+
+    def test_negative_nxdomain(self):
+        cache = RecordCache(0)
+        cache.add_negative(Name("bonobo.putin"), Type.A, Class.IN, 60,
+                           RCode.NXDomain)
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.MX, Class.IN), []
+        )
+        record = ResourceRecord(
+            name=Name("bonobo.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.0.0.1"),
+        )
+        cache.add_record(record)
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), [record]
+        )
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.MX, Class.IN), None
+        )
+
+    def test_negative_expired(self):
+        cache = RecordCache(0)
+        cache.add_negative(Name("bonobo.putin"), Type.A, Class.IN, 0,
+                           RCode.NXDomain)
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), None
+        )
+
+    def test_cache_file(self):
+        cache = RecordCache(0)
+        records = [
+            ResourceRecord(
+                name=Name("bonobo.putin"),
+                type_=Type.A,
+                class_=Class.IN,
+                ttl=60,
+                rdata=ARecordData("1.0.0.1"),
+            ),
+            ResourceRecord(
+                name=Name("www.putin"),
+                type_=Type.CNAME,
+                class_=Class.IN,
+                ttl=60,
+                rdata=CNAMERecordData(Name("bonobo.putin")),
+            ),
+        ]
+        cache.add_records(records)
+        cache.add_negative(Name("gumpe.putin"), Type.A, Class.IN, 60,
+                           RCode.NXDomain)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "cache")
+            cache.write_cache_file(filename)
+            self.assertEqual(os.listdir(directory), ["cache"])
+            restored = RecordCache(0)
+            restored.read_cache_file(filename)
+        self.assertEqual(
+            restored.lookup(Name("bonobo.putin"), Type.A, Class.IN),
+            [records[0]]
+        )
+        self.assertEqual(
+            restored.lookup(Name("www.putin"), Type.CNAME, Class.IN),
+            [records[1]]
+        )
+        self.assertEqual(
+            restored.lookup(Name("gumpe.putin"), Type.A, Class.IN), []
+        )
+
+    def test_invalid_cache_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "cache")
+            with open(filename, "wb") as file_:
+                file_.write(b"[]")
+            cache = RecordCache(0)
+            cache.read_cache_file(filename)
+            cache.read_cache_file(os.path.join(directory, "missing"))
+        self.assertEqual(cache.size, 0)
+
+    def test_checkpoint_journal(self):
+        cache = RecordCache(0, max_entries=1)
+        records = [
+            ResourceRecord(
+                name=Name(name),
+                type_=Type.A,
+                class_=Class.IN,
+                ttl=60,
+                rdata=ARecordData("1.0.0.1"),
+            )
+            for name in ("a.putin", "b.putin")
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "cache")
+            checkpointer = CacheCheckpointer(cache, 60, filename)
+            cache.add_records(records)
+            checkpointer.checkpoint()
+            self.assertFalse(os.path.exists(filename))
+            restored = RecordCache(0)
+            restored.read_journal(filename + ".log")
+            self.assertEqual(restored.all_records(), [records[1]])
+
+            checkpointer.stop()
+            self.assertEqual(os.listdir(directory), ["cache"])
+            restored = RecordCache(0)
+            restored.read_cache_file(filename)
+            self.assertEqual(restored.all_records(), [records[1]])
+
+    def test_torn_journal(self):
+        cache = RecordCache(0)
+        records = [
+            ResourceRecord(
+                name=Name(name),
+                type_=Type.A,
+                class_=Class.IN,
+                ttl=60,
+                rdata=ARecordData("1.0.0.1"),
+            )
+            for name in ("a.putin", "b.putin")
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "cache")
+            checkpointer = CacheCheckpointer(cache, 60, filename)
+            cache.add_records(records)
+            checkpointer.checkpoint()
+            with open(filename + ".log", "rb") as file_:
+                journal = file_.read()
+            for length in range(1, len(journal)):
+                with open(filename + ".log", "wb") as file_:
+                    file_.write(journal[:length])
+                restored = RecordCache(0)
+                restored.read_journal(filename + ".log")
+                self.assertIn(
+                    restored.all_records(), ([], [records[0]])
+                )
+
+    def test_failed_compaction(self):
+        cache = RecordCache(0)
+        record = ResourceRecord(
+            name=Name("a.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.0.0.1"),
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "missing", "cache")
+            checkpointer = CacheCheckpointer(cache, 60, filename)
+            cache.add_record(record)
+            checkpointer.compact()
+            self.assertEqual(len(checkpointer.journal), 1)
+
+    def test_prefetch_trigger(self):
+        cache = RecordCache(0)
+        prefetches = []
+        cache.enable_prefetch(
+            lambda *args: prefetches.append(args), hits=2, fraction=0.5
+        )
+        record = ResourceRecord(
+            name=Name("bonobo.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.0.0.1"),
+        )
+        cache.add_record(record)
+        for _ in range(3):
+            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN)
+        self.assertEqual(prefetches, [])
+        cache_entry, = cache.lookup(Name("bonobo.putin"), Type.A, Class.IN)
+        cache_entry.added -= 45
+        cache.lookup(Name("bonobo.putin"), Type.A, Class.IN)
+        self.assertEqual(
+            prefetches, [(Name("bonobo.putin"), Type.A, Class.IN)]
+        )
+
+    def test_prefetcher_budget(self):
+        prefetcher = Prefetcher(RecordCache(0), budget=0)
+        prefetcher(Name("bonobo.putin"), Type.A, Class.IN)
+        self.assertEqual(
+            prefetcher.stats(),
+            {"triggered": 0, "succeeded": 0, "failed": 0, "skipped": 1},
+        )
+
+    def test_serve_stale(self):
+        cache = RecordCache(0)
+        refreshes = []
+        cache.enable_serve_stale(60, lambda *args: refreshes.append(args))
+        record = ResourceRecord(
+            name=Name("bonobo.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=0,
+            rdata=ARecordData("1.0.0.1"),
+        )
+        cache.add_record(record)
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), None
+        )
+        stale, = cache.lookup_stale(Name("bonobo.putin"), Type.A, Class.IN)
+        self.assertEqual(stale, record)
+        self.assertEqual(stale.ttl, 30)
+        self.assertEqual(
+            refreshes, [(Name("bonobo.putin"), Type.A, Class.IN)]
+        )
+
+
+class TestInfrastructureCache(TestCase):
+    """Infrastructure cache tests"""
+
+    def test_sort_by_srtt(self):
+        infra = InfrastructureCache(alpha=0.5)
+        infra.record_rtt("10.0.0.1", 0.2)
+        infra.record_rtt("10.0.0.2", 0.05)
+        infra.record_rtt("10.0.0.2", 0.15)
+        self.assertAlmostEqual(infra.get("10.0.0.2")["srtt"], 0.1)
+        self.assertEqual(
+            infra.sort(["10.0.0.1", "10.0.0.2", "10.0.0.3"]),
+            ["10.0.0.2", "10.0.0.1", "10.0.0.3"]
+        )
+
+    def test_backoff(self):
+        infra = InfrastructureCache()
+        infra.record_rtt("10.0.0.1", 0.01)
+        infra.record_timeout("10.0.0.1", 5)
+        self.assertEqual(
+            infra.get("10.0.0.1"),
+            {"srtt": 5, "timeouts": 1, "backed_off": True}
+        )
+        self.assertEqual(
+            infra.sort(["10.0.0.1", "10.0.0.2"]), ["10.0.0.2", "10.0.0.1"]
+        )
+        infra.record_rtt("10.0.0.1", 0.01)
+        self.assertFalse(infra.get("10.0.0.1")["backed_off"])
+
 
 class TestResolverCache(TestCase):
     """Resolver tests with cache enabled"""
@@ -134,6 +669,200 @@ class TestResolverCache(TestCase):
             ("bonobo.putin", ["putin.bonobo."], ["1.0.0.1"])
         )
 
+    def test_negative_from_cache(self):
+        cache = RecordCache(0)
+        resolver = Resolver(5, cache)
+        cache.add_negative(Name("bonobo.putin"), Type.A, Class.IN, 60,
+                           RCode.NXDomain)
+        self.assertEqual(
+            resolver.gethostbyname("bonobo.putin"),
+            ("bonobo.putin", [], [])
+        )
+        self.assertNotIsInstance(
+            resolver.lookup_cache("bonobo.putin"), NoData
+        )
+        cache.add_negative(Name("bonobo.putin"), Type.MX, Class.IN, 60,
+                           RCode.NoError)
+        cache.add_negative(Name("gorilla.putin"), Type.MX, Class.IN, 60,
+                           RCode.NoError)
+        self.assertNotIsInstance(
+            resolver.lookup_cache("bonobo.putin", Type.MX), NoData
+        )
+        answer = resolver.lookup_cache("gorilla.putin", Type.MX)
+        self.assertEqual(answer, [])
+        self.assertIsInstance(answer, NoData)
+
+    def test_negative_ttl(self):
+        header = Header(1337, 0, 1, 0, 1, 0)
+        header.qr = 1
+        header.rcode = RCode.NXDomain
+        soa = ResourceRecord(
+            name=Name("putin"),
+            type_=Type.SOA,
+            class_=Class.IN,
+            ttl=900,
+            rdata=SOARecordData(Name("ns.putin"), Name("admin.putin"),
+                                1, 3600, 600, 86400, 300),
+        )
+        response = Message.from_bytes(Message(
+            header, [Question(Name("bonobo.putin"), Type.A, Class.IN)],
+            authorities=[soa],
+        ).to_bytes())
+        self.assertEqual(Resolver.negative_ttl(response), 300)
+        cache = RecordCache(0)
+        resolver = Resolver(5, cache)
+        self.assertTrue(resolver.cache_negative("bonobo.putin", response))
+        self.assertEqual(
+            cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), []
+        )
+
+    def test_negative_after_cname(self):
+        soa = ResourceRecord(
+            name=Name("putin"),
+            type_=Type.SOA,
+            class_=Class.IN,
+            ttl=900,
+            rdata=SOARecordData(Name("ns.putin"), Name("admin.putin"),
+                                1, 3600, 600, 86400, 300),
+        )
+        alias = ResourceRecord(
+            name=Name("alias.putin"),
+            type_=Type.CNAME,
+            class_=Class.IN,
+            ttl=60,
+            rdata=CNAMERecordData(Name("bonobo.putin")),
+        )
+        for rcode in (RCode.NXDomain, RCode.NoError):
+            header = Header(1337, 0, 1, 1, 1, 0)
+            header.qr = 1
+            header.rcode = rcode
+            response = Message(
+                header, [Question(Name("alias.putin"), Type.A, Class.IN)],
+                [alias], [soa],
+            )
+            cache = RecordCache(0)
+            resolver = Resolver(5, cache)
+            resolver.process_response("alias.putin", response)
+            self.assertEqual(
+                cache.lookup(Name("bonobo.putin"), Type.A, Class.IN), []
+            )
+            self.assertEqual(
+                cache.lookup(Name("alias.putin"), Type.CNAME, Class.IN),
+                [alias]
+            )
+            self.assertIsNone(
+                cache.lookup(Name("alias.putin"), Type.A, Class.IN)
+            )
+
+    def test_closest_servers(self):
+        cache = RecordCache(0)
+        resolver = Resolver(5, cache)
+        self.assertEqual(
+            resolver.closest_servers("a.example.com"), [Resolver.root_server]
+        )
+        cache.add_record(ResourceRecord(
+            name=Name("example.com"),
+            type_=Type.NS,
+            class_=Class.IN,
+            ttl=60,
+            rdata=NSRecordData(Name("ns1.example.com")),
+        ))
+        self.assertEqual(
+            resolver.closest_servers("a.example.com"), [Resolver.root_server]
+        )
+        cache.add_record(ResourceRecord(
+            name=Name("ns1.example.com"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=60,
+            rdata=ARecordData("1.2.3.4"),
+        ))
+        self.assertEqual(
+            resolver.closest_servers("a.example.com"), ["1.2.3.4"]
+        )
+        self.assertEqual(
+            resolver.closest_servers("example.com"), ["1.2.3.4"]
+        )
+        self.assertEqual(
+            resolver.closest_servers("example.org"), [Resolver.root_server]
+        )
+
+    def test_bailiwick(self):
+        header = Header(1, 0, 1, 0, 2, 2)
+        header.qr = 1
+        response = Message(
+            header, [Question(Name("host.gumpe"), Type.A, Class.IN)],
+            authorities=[
+                ResourceRecord(Name(owner), Type.NS, Class.IN, 60,
+                               NSRecordData(Name("ns." + owner)))
+                for owner in ("gumpe", "putin")
+            ],
+            additionals=[
+                ResourceRecord(Name(name), Type.A, Class.IN, 60,
+                               ARecordData(address))
+                for name, address in (("ns.gumpe", "1.2.3.4"),
+                                      ("www.putin", "6.6.6.6"))
+            ],
+        )
+        cache = RecordCache(0)
+        resolver = Resolver(5, cache)
+        self.assertEqual(
+            resolver.process_response("host.gumpe", response, zone=Name("")),
+            (None, ["1.2.3.4"], [Name("ns.gumpe")], Name("gumpe"))
+        )
+        self.assertIsNone(cache.lookup(Name("putin"), Type.NS, Class.IN))
+        self.assertIsNone(cache.lookup(Name("www.putin"), Type.A, Class.IN))
+
+        cache = RecordCache(0)
+        resolver = Resolver(5, cache)
+        for zone in ("putin", "gumpe"):
+            with self.assertRaises(ResolutionFailed):
+                resolver.process_response(
+                    "host.gumpe", response, zone=Name(zone)
+                )
+        self.assertEqual(cache.all_records(), [])
+
+    def test_serve_stale_on_failure(self):
+        cache = RecordCache(0)
+        cache.enable_serve_stale(60)
+        resolver = Resolver(5, cache, stale_timeout=None)
+        cache.add_record(ResourceRecord(
+            name=Name("bonobo.putin"),
+            type_=Type.A,
+            class_=Class.IN,
+            ttl=0,
+            rdata=ARecordData("1.0.0.1"),
+        ))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.close()
+        stale, = resolver.query_recursive(sock, "bonobo.putin")
+        self.assertEqual(stale.rdata.address, "1.0.0.1")
+        with self.assertRaises(OSError):
+            resolver.query_recursive(sock, "gumpe.putin")
+
+    def test_serve_stale_when_slow(self):
+        nameserver = FakeNameserver({"host.gumpe.": ["1.2.3.4"]}, delay=0.3)
+        nameserver.start()
+        self.addCleanup(nameserver.close)
+        cache = RecordCache(0)
+        cache.enable_serve_stale(60)
+        cache.add_record(ResourceRecord(
+            Name("host.gumpe"), Type.A, Class.IN, 0, ARecordData("1.0.0.1")
+        ))
+        resolver = Resolver(5, cache, stale_timeout=0.05)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = nameserver.port
+        stale, = resolver.query_recursive(None, "host.gumpe")
+        self.assertEqual(stale.rdata.address, "1.0.0.1")
+        deadline = time.time() + 2
+        while (
+                cache.lookup(Name("host.gumpe"), Type.A, Class.IN) is None and
+                time.time() < deadline
+        ):
+            time.sleep(0.01)
+        fresh, = cache.lookup(Name("host.gumpe"), Type.A, Class.IN)
+        self.assertEqual(fresh.rdata.address, "1.2.3.4")
+
     def test_expired_cache_entry(self):
         cache = RecordCache(0)
         resolver = Resolver(5, cache)
@@ -169,6 +898,1132 @@ class TestResolverCache(TestCase):
         )
 
 
+class TestResolutionBudget(TestCase):
+    """Bounded iterative resolution"""
+
+    def resolve(self, referral, **kwargs):
+        nameserver = FakeNameserver({}, referral=referral)
+        nameserver.start()
+        resolver = Resolver(1, RecordCache(0), **kwargs)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = nameserver.port
+        try:
+            return resolver.gethostbyname("host.gumpe")
+        finally:
+            self.queries = nameserver.queries
+            nameserver.close()
+
+    def test_referral_loop(self):
+        with self.assertRaises(ResolutionFailed):
+            self.resolve(("ns.gumpe", "127.0.0.1"))
+        self.assertEqual(self.queries, 1)
+
+    def test_nameserver_depends_on_itself(self):
+        with self.assertRaises(ResolutionFailed):
+            self.resolve(("ns.gumpe", None))
+        self.assertEqual(self.queries, 2)
+
+    def test_query_budget(self):
+        with self.assertRaises(BudgetExceeded):
+            self.resolve(("ns.gumpe", None), max_queries=1)
+
+    def resolve_glueless(self, errors):
+        question = Question(Name("host.gumpe"), Type.A, Class.IN)
+        header = Header(1, 0, 1, 0, 2, 0)
+        header.qr = 1
+        referral = Message(header, [question], authorities=[
+            ResourceRecord(Name("gumpe"), Type.NS, Class.IN, 60,
+                           NSRecordData(Name(nsdname)))
+            for nsdname in ("ns1.gumpe", "ns2.gumpe")
+        ])
+        answer = ResourceRecord(Name("host.gumpe"), Type.A, Class.IN, 60,
+                                ARecordData("1.2.3.4"))
+        header = Header(1, 0, 1, 1, 0, 0)
+        header.qr = 1
+        responses = [referral, Message(header, [question], [answer])]
+
+        def resolve(sock, hostname, *args):
+            error = errors.get(str(hostname))
+            if error is not None:
+                raise error
+            return [ResourceRecord(hostname, Type.A, Class.IN, 60,
+                                   ARecordData("127.0.0.2"))]
+
+        resolver = Resolver(1)
+        with patch.object(resolver, "send_query_staggered",
+                          side_effect=responses), \
+                patch.object(resolver, "resolve", side_effect=resolve):
+            return resolver.query_recursive(
+                None, "host.gumpe", ["127.0.0.1"]
+            ), answer
+
+    def test_glueless_nameserver_fails(self):
+        result, answer = self.resolve_glueless(
+            {"ns1.gumpe.": socket.timeout()}
+        )
+        self.assertEqual(result, [answer])
+        with self.assertRaises(socket.timeout):
+            self.resolve_glueless({
+                "ns1.gumpe.": OSError(), "ns2.gumpe.": socket.timeout()
+            })
+        with self.assertRaises(BudgetExceeded):
+            self.resolve_glueless(
+                {"ns1.gumpe.": BudgetExceeded("query budget exceeded")}
+            )
+
+    def test_deadline(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        resolver = Resolver(5, time_limit=0.1)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = sock.getsockname()[1]
+        start = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            resolver.gethostbyname("host.gumpe")
+        sock.close()
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class TestCNAMEChain(TestCase):
+    """Following CNAME chains"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver({
+            "a.gumpe.": "b.gumpe.",
+            "b.gumpe.": "c.gumpe.",
+            "c.gumpe.": ["1.2.3.4"],
+            "loop1.gumpe.": "loop2.gumpe.",
+            "loop2.gumpe.": "loop1.gumpe.",
+        })
+        self.nameserver.start()
+
+    def tearDown(self):
+        self.nameserver.close()
+
+    def resolver(self, **kwargs):
+        resolver = Resolver(1, RecordCache(0), **kwargs)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = self.nameserver.port
+        return resolver
+
+    def test_chain(self):
+        resolver = self.resolver()
+        self.assertEqual(
+            resolver.gethostbyname("a.gumpe"),
+            ("a.gumpe", ["b.gumpe.", "c.gumpe."], ["1.2.3.4"]),
+        )
+        self.assertEqual(self.nameserver.queries, 3)
+        self.assertEqual(
+            resolver.gethostbyname("b.gumpe"),
+            ("b.gumpe", ["c.gumpe."], ["1.2.3.4"]),
+        )
+        self.assertEqual(self.nameserver.queries, 3)
+
+    def test_loop(self):
+        self.assertEqual(
+            self.resolver().gethostbyname("loop1.gumpe"),
+            ("loop1.gumpe", ["loop2.gumpe.", "loop1.gumpe."], []),
+        )
+        self.assertEqual(self.nameserver.queries, 2)
+
+    def test_max_chain(self):
+        self.assertEqual(
+            self.resolver(max_chain=1).gethostbyname("a.gumpe"),
+            ("a.gumpe", ["b.gumpe.", "c.gumpe."], []),
+        )
+        self.assertEqual(self.nameserver.queries, 2)
+
+
+class TestQueryTypes(TestCase):
+    """Resolving records of other types than A"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver({
+            "host.gumpe.": ["1.2.3.4", "2001:db8::1"],
+            "alias.gumpe.": "host.gumpe.",
+        })
+        self.nameserver.start()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.resolver = Resolver(1, RecordCache(0))
+        self.resolver.root_server = "127.0.0.1"
+        self.resolver.port = self.nameserver.port
+
+    def tearDown(self):
+        self.sock.close()
+        self.nameserver.close()
+
+    def test_aaaa(self):
+        for _ in range(2):
+            answer = self.resolver.query_recursive(
+                self.sock, "alias.gumpe", type_=Type.AAAA
+            )
+            self.assertEqual(
+                [(record.type_, str(record.rdata)) for record in answer],
+                [(Type.CNAME, "Canonical Name: host.gumpe."),
+                 (Type.AAAA, "IPv6: 2001:db8::1")],
+            )
+        self.assertEqual(self.nameserver.queries, 2)
+        self.assertEqual(
+            self.resolver.gethostbyname("alias.gumpe"),
+            ("alias.gumpe", ["host.gumpe."], ["1.2.3.4"]),
+        )
+        self.assertEqual(self.nameserver.queries, 3)
+
+    def test_nodata(self):
+        answer = self.resolver.query_recursive(
+            self.sock, "host.gumpe", type_=Type.MX
+        )
+        self.assertEqual(answer, [])
+        self.assertIsInstance(answer, NoData)
+        answer = self.resolver.query_recursive(
+            self.sock, "nothing.gumpe", type_=Type.MX
+        )
+        self.assertNotIsInstance(answer, NoData)
+
+    def test_nodata_rcode(self):
+        query = Message(
+            Header(1, 0, 1, 0, 0, 0),
+            [Question(Name("host.gumpe"), Type.MX, Class.IN)],
+        )
+        for records, rcode in ((NoData(), RCode.NoError),
+                               ([], RCode.NXDomain)):
+            response = RequestHandler.make_response(query, records, False)
+            self.assertEqual(response.header.rcode, rcode)
+
+    def test_cached_mx(self):
+        record = ResourceRecord(
+            Name("gumpe"), Type.MX, Class.IN, 60,
+            MXRecordData(10, Name("mail.gumpe")),
+        )
+        self.resolver.cache.add_record(record)
+        answer = self.resolver.query_recursive(
+            self.sock, "gumpe", type_=Type.MX
+        )
+        self.assertEqual(answer, [record])
+        self.assertEqual(self.nameserver.queries, 0)
+
+    def test_mx_to_bytes(self):
+        record = ResourceRecord(
+            Name("gumpe"), Type.MX, Class.IN, 60,
+            MXRecordData(10, Name("mail.gumpe")),
+        )
+        message = Message(Header(1, 0, 0, 2, 0, 0), answers=[record, record])
+        self.assertEqual(
+            Message.from_bytes(message.to_bytes()).answers, [record, record]
+        )
+
+
+class TestSocketPool(TestCase):
+    """Upstream queries through a shared socket pool"""
+
+    def setUp(self):
+        self.pool = SocketPool(4, "127.0.0.1")
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_resolve(self):
+        nameserver = FakeNameserver({"host.gumpe.": ["1.2.3.4"]})
+        nameserver.start()
+        resolver = Resolver(1, pool=self.pool)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = nameserver.port
+        try:
+            self.assertEqual(
+                resolver.gethostbyname("host.gumpe"),
+                ("host.gumpe", [], ["1.2.3.4"]),
+            )
+        finally:
+            nameserver.close()
+        ports = {upstream.port for upstream in self.pool.sockets}
+        self.assertEqual(len(ports), 4)
+
+    def test_spoofed_response(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(1)
+        channel = self.pool.channel()
+        channel.send(Resolver.make_query("host.gumpe"),
+                     server.getsockname())
+        data, address = server.recvfrom(512)
+        query = Message.from_bytes(data)
+        query.header.qr = 1
+        spoofed = Message.from_bytes(data)
+        spoofed.questions[0].qname = Name("evil.gumpe")
+        spoofed.header.qr = 1
+        server.sendto(spoofed.to_bytes(), address)
+        server.sendto(query.to_bytes(), address)
+        response, _ = channel.receive(1)
+        self.assertEqual(response.questions[0].qname, Name("host.gumpe"))
+        self.assertEqual(self.pool.stats()["dropped"], 1)
+        channel.close()
+        server.close()
+
+    def test_truncated_datagram(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(1)
+        channel = self.pool.channel()
+        channel.send(Resolver.make_query("host.gumpe"),
+                     server.getsockname())
+        data, address = server.recvfrom(512)
+        # ends in the middle of the type of the question
+        server.sendto(data[:26], address)
+        response = Message.from_bytes(data)
+        response.header.qr = 1
+        server.sendto(response.to_bytes(), address)
+        response, _ = channel.receive(1)
+        self.assertEqual(response.questions[0].qname, Name("host.gumpe"))
+        self.assertTrue(all(
+            upstream.thread.is_alive() for upstream in self.pool.sockets
+        ))
+        channel.close()
+        server.close()
+
+
+class TestTruncation(TestCase):
+    """TCP fallback and EDNS0"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver(
+            {"a.gumpe.": ["1.2.3.4"], "b.gumpe.": ["5.6.7.8"]}, tcp=True
+        )
+        self.nameserver.start()
+        self.tcp = TCPPool()
+
+    def tearDown(self):
+        self.tcp.close()
+        self.nameserver.close()
+
+    def test_tcp_fallback(self):
+        resolver = Resolver(1, tcp=self.tcp)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = self.nameserver.port
+        self.assertEqual(resolver.gethostbyname("a.gumpe"),
+                         ("a.gumpe", [], ["1.2.3.4"]))
+        self.assertEqual(resolver.gethostbyname("b.gumpe"),
+                         ("b.gumpe", [], ["5.6.7.8"]))
+        self.assertEqual(self.nameserver.connections, 1)
+        self.assertEqual(self.tcp.stats(),
+                         {"connects": 1, "reuses": 1, "evicted": 0})
+
+    def test_idle_expiry(self):
+        tcp = TCPPool(max_age=0)
+        self.addCleanup(tcp.close)
+        query = Resolver.make_query("a.gumpe")
+        address = ("127.0.0.1", self.nameserver.port)
+        for _ in range(2):
+            tcp.query(query, address, 1)
+            time.sleep(0.01)
+        self.assertEqual(tcp.stats(),
+                         {"connects": 2, "reuses": 0, "evicted": 1})
+
+    def test_idle_limit(self):
+        tcp = TCPPool(max_total=2)
+        self.addCleanup(tcp.close)
+        socks = [socket.socket() for _ in range(3)]
+        for i, sock in enumerate(socks):
+            tcp.release(("127.0.0.{}".format(i + 1), 53), sock)
+        self.assertEqual(socks[0].fileno(), -1)
+        self.assertIs(tcp.acquire(("127.0.0.2", 53)), socks[1])
+        self.assertIsNone(tcp.acquire(("127.0.0.1", 53)))
+        socks[1].close()
+
+    def test_malformed_tcp_response(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        self.addCleanup(listener.close)
+
+        def serve():
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(512)
+                conn.sendall(b"\x00\x03abc")
+                conn.recv(512)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        with self.assertRaises(ConnectionError):
+            self.tcp.query(Resolver.make_query("a.gumpe"),
+                           listener.getsockname(), 1)
+        thread.join()
+        self.assertEqual(len(self.tcp.idle), 0)
+
+    def test_async_tcp_fallback(self):
+        async def resolve():
+            resolver = AsyncResolver(1, tcp=self.tcp)
+            resolver.root_server = "127.0.0.1"
+            resolver.port = self.nameserver.port
+            await resolver.open()
+            try:
+                return await resolver.gethostbyname("a.gumpe")
+            finally:
+                resolver.close()
+
+        self.assertEqual(asyncio.run(resolve()),
+                         ("a.gumpe", [], ["1.2.3.4"]))
+
+    def test_edns_fallback(self):
+        nameserver = FakeNameserver({"a.gumpe.": ["1.2.3.4"]}, edns=False)
+        nameserver.start()
+        self.addCleanup(nameserver.close)
+        resolver = Resolver(1)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = nameserver.port
+        self.assertEqual(resolver.gethostbyname("a.gumpe"),
+                         ("a.gumpe", [], ["1.2.3.4"]))
+        self.assertEqual(nameserver.queries, 2)
+
+        async def resolve():
+            resolver = AsyncResolver(1)
+            resolver.root_server = "127.0.0.1"
+            resolver.port = nameserver.port
+            await resolver.open()
+            try:
+                return await resolver.gethostbyname("a.gumpe")
+            finally:
+                resolver.close()
+
+        self.assertEqual(asyncio.run(resolve()),
+                         ("a.gumpe", [], ["1.2.3.4"]))
+        self.assertEqual(nameserver.queries, 4)
+
+    def test_failure_rcodes(self):
+        nameserver = FakeNameserver({"a.gumpe.": ["1.2.3.4"]})
+        nameserver.start()
+        self.addCleanup(nameserver.close)
+        resolver = Resolver(1)
+        resolver.root_server = "127.0.0.1"
+        resolver.port = nameserver.port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        for rcode in (RCode.FormErr, RCode.NotImp, RCode.ServFail):
+            nameserver.rcode = rcode
+            with self.assertRaises(ConnectionError):
+                resolver.query_recursive(sock, "a.gumpe")
+
+    def test_edns(self):
+        query = Resolver.make_query("a.gumpe", payload=4096)
+        query = Message.from_bytes(query.to_bytes())
+        self.assertEqual(query.header.ar_count, 1)
+        self.assertEqual(query.additionals[0].type_, Type.OPT)
+        self.assertEqual(query.additionals[0].class_, 4096)
+
+
+class TestForwarder(TestCase):
+    """Forwarding to upstream recursive servers"""
+
+    def setUp(self):
+        records = {"a.gumpe.": ["1.2.3.4"], "b.gumpe.": ["5.6.7.8"]}
+        self.first = FakeNameserver(records, address="127.0.0.2")
+        self.second = FakeNameserver(
+            records, address="127.0.0.3", port=self.first.port
+        )
+        self.first.start()
+        self.second.start()
+        self.upstreams = UpstreamGroup(
+            ["127.0.0.2", "127.0.0.3"], self.first.port
+        )
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+
+    def test_load_balancing(self):
+        forwarder = Forwarder(1, self.upstreams, RecordCache(0))
+        self.assertEqual(forwarder.gethostbyname("a.gumpe"),
+                         ("a.gumpe", [], ["1.2.3.4"]))
+        self.assertEqual(forwarder.gethostbyname("b.gumpe"),
+                         ("b.gumpe", [], ["5.6.7.8"]))
+        self.assertEqual((self.first.queries, self.second.queries), (1, 1))
+        self.assertEqual((self.first.rd, self.second.rd), (1, 1))
+        forwarder.gethostbyname("a.gumpe")
+        self.assertEqual(self.first.queries + self.second.queries, 2)
+
+    def test_failover(self):
+        self.first.rcode = RCode.ServFail
+        forwarder = Forwarder(1, self.upstreams)
+        for _ in range(2):
+            self.assertEqual(forwarder.gethostbyname("a.gumpe"),
+                             ("a.gumpe", [], ["1.2.3.4"]))
+        self.assertEqual((self.first.queries, self.second.queries), (1, 2))
+        self.assertFalse(self.upstreams.infra.get("127.0.0.2")["backed_off"])
+
+    def test_out_of_rotation_until_probed(self):
+        self.upstreams.infra.backoff = 0.01
+        self.upstreams.infra.record_timeout("127.0.0.2", 1)
+        time.sleep(0.02)
+        self.assertFalse(self.upstreams.infra.get("127.0.0.2")["backed_off"])
+        for _ in range(2):
+            self.assertEqual(self.upstreams.order()[-1], "127.0.0.2")
+        HealthChecker(self.upstreams).check()
+        self.assertEqual(
+            [self.upstreams.order()[0] for _ in range(2)],
+            ["127.0.0.2", "127.0.0.3"]
+        )
+
+    def test_health_check(self):
+        self.second.rcode = RCode.Refused
+        checker = HealthChecker(self.upstreams)
+        self.assertEqual(checker.check(),
+                         {"127.0.0.2": True, "127.0.0.3": False})
+        self.second.rcode = None
+        self.assertEqual(checker.check(),
+                         {"127.0.0.2": True, "127.0.0.3": True})
+        self.assertFalse(self.upstreams.infra.get("127.0.0.3")["backed_off"])
+
+
+class TestAsyncServer(TestCase):
+    """Requests handled by the asyncio server"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver({"host.gumpe.": ["1.2.3.4"]})
+        self.nameserver.start()
+        patches = [
+            patch.object(AsyncResolver, "root_server", "127.0.0.1"),
+            patch.object(AsyncResolver, "port", self.nameserver.port),
+            patch.object(Server, "cache", RecordCache(0)),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server = AsyncServer(0, 1)
+        self.thread = threading.Thread(
+            target=asyncio.run, args=(self.server.serve(),)
+        )
+        self.thread.start()
+        while self.server.transport is None:
+            time.sleep(0.01)
+        self.address = self.server.transport.get_extra_info("sockname")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.sock.close()
+        self.nameserver.close()
+
+    def ask(self, data):
+        self.sock.sendto(data, self.address)
+        return Message.from_bytes(self.sock.recv(512))
+
+    def test_resolve_and_cache(self):
+        header = Header(1337, 0, 1, 0, 0, 0)
+        header.rd = 1
+        query = Message(
+            header, [Question(Name("host.gumpe"), Type.A, Class.IN)]
+        )
+        for _ in range(2):
+            response = self.ask(query.to_bytes())
+            self.assertEqual(response.header.ident, 1337)
+            self.assertEqual(response.answers[0].rdata.address, "1.2.3.4")
+        self.assertEqual(self.nameserver.queries, 1)
+        self.assertEqual(self.server.stats(),
+                         {"inline": 1, "resolved": 1, "failed": 0})
+
+    def test_nodata(self):
+        for name, rcode in (("host.gumpe", RCode.NoError),
+                            ("nothing.gumpe", RCode.NXDomain)):
+            header = Header(1337, 0, 1, 0, 0, 0)
+            header.rd = 1
+            query = Message(header, [Question(Name(name), Type.MX, Class.IN)])
+            for _ in range(2):
+                response = self.ask(query.to_bytes())
+                self.assertEqual(response.header.rcode, rcode)
+                self.assertEqual(response.answers, [])
+
+    def test_malformed_request(self):
+        self.assertEqual(self.ask(b"\x00").header.rcode, RCode.FormErr)
+
+
+class TestWorkerPool(TestCase):
+    """Load shedding of the threaded server"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver(
+            {"host.gumpe.": ["1.2.3.4"]}, delay=0.5
+        )
+        self.nameserver.start()
+        pool = SocketPool(1, "127.0.0.1")
+        self.addCleanup(pool.close)
+        patches = [
+            patch.object(Resolver, "root_server", "127.0.0.1"),
+            patch.object(Resolver, "port", self.nameserver.port),
+            patch.object(Server, "cache", None),
+            patch.object(Server, "pool", pool),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(3)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.sock.close()
+        self.nameserver.close()
+
+    def start(self, shed):
+        self.server = Server(0, workers=1, queue_size=1, shed=shed)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+        while getattr(self.server, "sock", None) is None:
+            time.sleep(0.01)
+        address = self.server.sock.getsockname()
+        header = Header(1337, 0, 1, 0, 0, 0)
+        header.rd = 1
+        query = Message(
+            header, [Question(Name("host.gumpe"), Type.A, Class.IN)]
+        ).to_bytes()
+        self.sock.sendto(query, address)
+        time.sleep(0.1)
+        for _ in range(3):
+            self.sock.sendto(query, address)
+
+    def shed_rcodes(self, shed):
+        self.start(shed)
+        rcodes = [
+            Message.from_bytes(self.sock.recv(512)).header.rcode
+            for _ in range(4)
+        ]
+        self.assertEqual(self.server.shed, 2)
+        return rcodes
+
+    def test_servfail(self):
+        self.assertEqual(self.shed_rcodes("servfail"),
+                         [RCode.ServFail, RCode.ServFail,
+                          RCode.NoError, RCode.NoError])
+
+    def test_refused(self):
+        self.assertEqual(self.shed_rcodes("refused"),
+                         [RCode.Refused, RCode.Refused,
+                          RCode.NoError, RCode.NoError])
+
+    def test_time_limit(self):
+        with patch.object(Server, "time_limit", 0.1):
+            self.start("servfail")
+            rcodes = {
+                Message.from_bytes(self.sock.recv(512)).header.rcode
+                for _ in range(4)
+            }
+        self.assertEqual(rcodes, {RCode.ServFail})
+
+    def test_drop(self):
+        self.start("drop")
+        for _ in range(2):
+            response = Message.from_bytes(self.sock.recv(512))
+            self.assertEqual(response.header.rcode, RCode.NoError)
+        self.sock.settimeout(0.5)
+        with self.assertRaises(socket.timeout):
+            self.sock.recv(512)
+        self.assertEqual(self.server.shed, 2)
+
+
+class TestMultiProcess(TestCase):
+    """Shared cache and supervisor of the multi-process server"""
+
+    def setUp(self):
+        self.shared = SharedCache(64)
+        self.addCleanup(self.shared.close)
+        self.record = ResourceRecord(
+            Name("host.gumpe"), Type.A, Class.IN, 60, ARecordData("1.2.3.4")
+        )
+
+    def test_shared_between_caches(self):
+        first, second = RecordCache(0), RecordCache(0)
+        first.enable_shared(self.shared)
+        second.enable_shared(self.shared)
+        first.add_record(self.record)
+        self.assertEqual(
+            second.lookup(Name("host.gumpe"), Type.A, Class.IN),
+            [self.record]
+        )
+        self.assertIsNone(
+            second.lookup(Name("host.gumpe"), Type.AAAA, Class.IN)
+        )
+
+    def test_shared_between_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            cache = RecordCache(0)
+            cache.enable_shared(self.shared)
+            cache.add_record(self.record)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        cache = RecordCache(0)
+        cache.enable_shared(self.shared)
+        self.assertEqual(
+            cache.lookup(Name("host.gumpe"), Type.A, Class.IN), [self.record]
+        )
+
+    def test_expired(self):
+        record = ResourceRecord(
+            Name("host.gumpe"), Type.A, Class.IN, 0, ARecordData("1.2.3.4")
+        )
+        first, second = RecordCache(0), RecordCache(0)
+        first.enable_shared(self.shared)
+        second.enable_shared(self.shared)
+        first.add_record(record)
+        self.assertIsNone(
+            second.lookup(Name("host.gumpe"), Type.A, Class.IN)
+        )
+
+    def test_writer_killed(self):
+        key = RecordCache._key(Name("host.gumpe"), Type.A, Class.IN)
+        slot = SharedCache._hash(key) % self.shared.slots
+        stripe = slot % len(self.shared.locks)
+        pid = os.fork()
+        if pid == 0:
+            # killed in the middle of writing the slot
+            self.shared.locks[stripe].acquire()
+            SharedCache._OWNER.pack_into(
+                self.shared.memory,
+                self.shared.owners + stripe * SharedCache._OWNER.size,
+                os.getpid(), slot,
+            )
+            self.shared.memory[slot * self.shared.slot_size + 7] = 1
+            os._exit(0)
+        os.waitpid(pid, 0)
+        first, second = RecordCache(0), RecordCache(0)
+        first.enable_shared(self.shared)
+        second.enable_shared(self.shared)
+        start = time.monotonic()
+        first.add_record(self.record)
+        self.assertIsNone(
+            second.lookup(Name("host.gumpe"), Type.A, Class.IN)
+        )
+        self.assertLess(time.monotonic() - start, 1)
+
+        self.assertEqual(self.shared.recover(os.getpid()), 0)
+        self.assertEqual(self.shared.recover(pid), 1)
+        self.assertEqual(self.shared.get(key), [])
+        third = RecordCache(0)
+        third.enable_shared(self.shared)
+        start = time.monotonic()
+        third.add_record(self.record)
+        self.assertLess(time.monotonic() - start, self.shared.lock_timeout)
+        self.assertEqual(
+            second.lookup(Name("host.gumpe"), Type.A, Class.IN),
+            [self.record]
+        )
+
+    def test_restart(self):
+        exited = []
+        supervisor = Supervisor(
+            2, lambda: os._exit(0), restart_delay=0.05,
+            on_exit=exited.append,
+        )
+        thread = threading.Thread(target=supervisor.run)
+        thread.start()
+        while supervisor.restarts < 2:
+            time.sleep(0.01)
+        supervisor.shutdown()
+        thread.join()
+        self.assertGreaterEqual(len(exited), 2)
+        self.assertEqual(len(supervisor.pids()), 2)
+
+    def test_reuse_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        pool = SocketPool(1, "127.0.0.1")
+        self.addCleanup(pool.close)
+        with patch.object(Server, "pool", pool):
+            servers = [Server(port, reuse_port=True) for _ in range(2)]
+            threads = [
+                threading.Thread(target=server.serve) for server in servers
+            ]
+            for thread in threads:
+                thread.start()
+            while any(getattr(server, "sock", None) is None
+                      for server in servers):
+                time.sleep(0.01)
+            self.assertTrue(all(thread.is_alive() for thread in threads))
+            # the kernel picks the server which receives a datagram, so
+            # both are woken up by datagrams from different ports
+            for server in servers:
+                server.done = True
+            while any(thread.is_alive() for thread in threads):
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    s.sendto(b"", ("127.0.0.1", port))
+                time.sleep(0.01)
+            for server in servers:
+                server.sock.close()
+
+
+class TestZeroCopyParsing(TestCase):
+    """Parsing messages from a reused receive buffer"""
+
+    def test_buffer_reused(self):
+        header = Header(7, 0, 1, 2, 0, 0)
+        header.qr = 1
+        answers = [
+            ResourceRecord(Name("host.gumpe"), Type.A, Class.IN, 60,
+                           ARecordData("1.2.3.4")),
+            ResourceRecord(Name("host.gumpe"), Type.TXT, Class.IN, 60,
+                           GenericRecordData(b"\x05hello")),
+        ]
+        packet = Message(
+            header, [Question(Name("host.gumpe"), Type.A, Class.IN)], answers
+        ).to_bytes()
+        buffer = bytearray(512)
+        buffer[:len(packet)] = packet
+        message = Message.from_bytes(memoryview(buffer)[:len(packet)])
+        buffer[:] = bytes(512)
+        self.assertEqual(message.questions[0].qname, Name("host.gumpe"))
+        self.assertEqual(message.answers, answers)
+        self.assertIsInstance(message.answers[1].rdata.data, bytes)
+        self.assertEqual(message.to_bytes(), packet)
+
+    def test_pointer_loop(self):
+        header = Header(7, 0, 1, 0, 0, 0).to_bytes()
+        # a pointer to itself, and two labels pointing at each other
+        for name in (b"\xc0\x0c", b"\x01a\xc0\x10\x01b\xc0\x0c"):
+            packet = header + name + b"\x00\x01\x00\x01"
+            with self.assertRaises(ValueError):
+                Message.from_bytes(packet)
+
+
+class TestDatagramBatcher(TestCase):
+    """Batched datagram I/O"""
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(2)
+
+    def tearDown(self):
+        self.sock.close()
+        self.client.close()
+
+    def test_receive_batch(self):
+        for mmsg in (True, False):
+            with self.subTest(mmsg=mmsg):
+                batcher = DatagramBatcher(self.sock, 4, mmsg=mmsg)
+                for i in range(6):
+                    self.client.sendto(bytes([i]) * i,
+                                       self.sock.getsockname())
+                time.sleep(0.1)
+                address = self.client.getsockname()
+                self.assertEqual(batcher.receive(), [
+                    (bytes([i]) * i, address) for i in range(4)
+                ])
+                self.assertEqual(batcher.receive(), [
+                    (bytes([i]) * i, address) for i in range(4, 6)
+                ])
+                self.assertEqual(batcher.stats()["datagrams"], 6)
+
+    def test_reply_not_held(self):
+        batcher = DatagramBatcher(self.sock, 4, size=16)
+        batcher.sendto(b"a", self.client.getsockname())
+        self.assertEqual(batcher.stats()["sent"], 1)
+        self.assertEqual(self.client.recv(512), b"a")
+
+    def test_coalesced_replies(self):
+        for mmsg in (True, False):
+            with self.subTest(mmsg=mmsg):
+                batcher = DatagramBatcher(self.sock, 4, size=16, mmsg=mmsg)
+                replies = [b"a", b"b" * 100, b"c"]
+                # another thread is sending
+                with batcher.lock:
+                    for reply in replies:
+                        batcher.sendto(reply, self.client.getsockname())
+                    self.assertEqual(batcher.stats()["sent"], 0)
+                    batcher.flush()
+                self.assertEqual(
+                    [self.client.recv(512) for _ in replies], replies
+                )
+                stats = batcher.stats()
+                self.assertEqual(stats["sent"], 3)
+                if stats["mmsg"]:
+                    self.assertEqual(stats["send_calls"], 1)
+
+    def test_server(self):
+        pool = SocketPool(1, "127.0.0.1")
+        self.addCleanup(pool.close)
+        with patch.object(Server, "pool", pool):
+            server = Server(0, workers=2, batch=8)
+            thread = threading.Thread(target=server.serve)
+            thread.start()
+            while getattr(server, "sock", None) is None:
+                time.sleep(0.01)
+            for ident in range(5):
+                query = Message(
+                    Header(ident, 0, 1, 0, 0, 0),
+                    [Question(Name("nothing.invalid"), Type.A, Class.IN)]
+                )
+                self.client.sendto(query.to_bytes(), server.sock.getsockname())
+            responses = [
+                Message.from_bytes(self.client.recv(512)) for _ in range(5)
+            ]
+            server.shutdown()
+            thread.join()
+        self.assertEqual(
+            sorted(response.header.ident for response in responses),
+            list(range(5))
+        )
+        self.assertTrue(all(
+            response.header.rcode == RCode.NXDomain for response in responses
+        ))
+
+
+class TestQueryCoalescer(TestCase):
+    """Coalescing of concurrent resolutions"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver(
+            {"host.gumpe.": ["10.0.0.1"]}, delay=0.2
+        )
+        self.nameserver.start()
+
+    def tearDown(self):
+        self.nameserver.close()
+
+    def test_concurrent_resolutions(self):
+        coalescer = QueryCoalescer()
+        results = []
+
+        def resolve():
+            resolver = Resolver(5, coalescer=coalescer)
+            resolver.root_server = "127.0.0.1"
+            resolver.port = self.nameserver.port
+            results.append(resolver.gethostbyname("host.gumpe"))
+
+        threads = [threading.Thread(target=resolve) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [("host.gumpe", [], ["10.0.0.1"])] * 10)
+        self.assertEqual(self.nameserver.queries, 1)
+        self.assertEqual(coalescer.coalesced, 9)
+
+    def test_reentrant(self):
+        coalescer = QueryCoalescer()
+        self.assertEqual(
+            coalescer.resolve(
+                "key", lambda: coalescer.resolve("key", lambda: [1])
+            ),
+            [1]
+        )
+        self.assertEqual(coalescer.coalesced, 0)
+
+    def test_concurrent_resolutions_async(self):
+        async def resolve():
+            resolver = AsyncResolver(5)
+            resolver.root_server = "127.0.0.1"
+            resolver.port = self.nameserver.port
+            await resolver.open()
+            try:
+                results = await asyncio.gather(*(
+                    resolver.gethostbyname("host.gumpe") for _ in range(10)
+                ))
+                return results, resolver.coalesced
+            finally:
+                resolver.close()
+
+        results, coalesced = asyncio.run(resolve())
+        self.assertEqual(results, [("host.gumpe", [], ["10.0.0.1"])] * 10)
+        self.assertEqual(self.nameserver.queries, 1)
+        self.assertEqual(coalesced, 9)
+
+
+class TestStaggeredQueries(TestCase):
+    """Staggered querying of several nameservers"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver(
+            {"host.gumpe.": ["10.0.0.1"]}, address="127.0.0.3"
+        )
+        self.dead = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.dead.bind(("127.0.0.2", self.nameserver.port))
+        self.nameserver.start()
+
+    def tearDown(self):
+        self.nameserver.close()
+        self.dead.close()
+
+    def test_dead_first_server(self):
+        resolver = Resolver(2, stagger_delay=0.05)
+        resolver.port = self.nameserver.port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        start = time.monotonic()
+        answers = resolver.query_recursive(
+            sock, "host.gumpe", ["127.0.0.2", "127.0.0.3"]
+        )
+        sock.close()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(answers[0].rdata.address, "10.0.0.1")
+
+    def test_prefer_fastest_server(self):
+        infra = InfrastructureCache()
+        resolver = Resolver(2, stagger_delay=0.05, infra=infra)
+        resolver.port = self.nameserver.port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        resolver.query_recursive(
+            sock, "host.gumpe", ["127.0.0.2", "127.0.0.3"]
+        )
+        start = time.monotonic()
+        resolver.query_recursive(
+            sock, "host.gumpe", ["127.0.0.2", "127.0.0.3"]
+        )
+        sock.close()
+        self.assertLess(time.monotonic() - start, 0.05)
+        self.assertEqual(
+            infra.sort(["127.0.0.2", "127.0.0.3"]),
+            ["127.0.0.3", "127.0.0.2"]
+        )
+
+    def test_unanswered_server_slower(self):
+        self.nameserver.delay = 0.1
+        infra = InfrastructureCache(unknown_rtt=0.01)
+        resolver = Resolver(2, stagger_delay=0.05, infra=infra)
+        resolver.port = self.nameserver.port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        resolver.query_recursive(
+            sock, "host.gumpe", ["127.0.0.2", "127.0.0.3"]
+        )
+        sock.close()
+        self.assertGreaterEqual(infra.get("127.0.0.2")["srtt"], 0.15)
+        self.assertFalse(infra.get("127.0.0.2")["backed_off"])
+
+    def test_unanswered_server_slower_async(self):
+        self.nameserver.delay = 0.1
+        infra = InfrastructureCache(unknown_rtt=0.01)
+
+        async def resolve():
+            resolver = AsyncResolver(2, stagger_delay=0.05, infra=infra)
+            resolver.port = self.nameserver.port
+            await resolver.open()
+            try:
+                await resolver.query_recursive(
+                    "host.gumpe", ["127.0.0.2", "127.0.0.3"]
+                )
+            finally:
+                resolver.close()
+
+        asyncio.run(resolve())
+        self.assertGreaterEqual(infra.get("127.0.0.2")["srtt"], 0.15)
+        self.assertFalse(infra.get("127.0.0.2")["backed_off"])
+
+    def test_fanout_limit(self):
+        resolver = Resolver(0.2, stagger_delay=0.05, fanout=1)
+        resolver.port = self.nameserver.port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        with self.assertRaises(socket.timeout):
+            resolver.query_recursive(
+                sock, "host.gumpe", ["127.0.0.2", "127.0.0.3"]
+            )
+        sock.close()
+        self.assertEqual(self.nameserver.queries, 0)
+
+    def test_dead_first_server_async(self):
+        async def resolve():
+            resolver = AsyncResolver(2, stagger_delay=0.05)
+            resolver.port = self.nameserver.port
+            await resolver.open()
+            try:
+                return await resolver.query_recursive(
+                    "host.gumpe", ["127.0.0.2", "127.0.0.3"]
+                )
+            finally:
+                resolver.close()
+
+        start = time.monotonic()
+        answers = asyncio.run(resolve())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(answers[0].rdata.address, "10.0.0.1")
+
+
+class TestAsyncResolver(TestCase):
+    """Asynchronous resolver tests against a local nameserver"""
+
+    def setUp(self):
+        self.nameserver = FakeNameserver({
+            "host{}.gumpe.".format(i): ["10.0.0.{}".format(i)]
+            for i in range(100)
+        })
+        self.nameserver.start()
+
+    def tearDown(self):
+        self.nameserver.close()
+
+    def test_concurrent_gethostbyname(self):
+        async def resolve():
+            resolver = AsyncResolver(5)
+            resolver.root_server = "127.0.0.1"
+            resolver.port = self.nameserver.port
+            await resolver.open()
+            try:
+                return await asyncio.gather(*(
+                    resolver.gethostbyname("host{}.gumpe".format(i))
+                    for i in range(100)
+                ))
+            finally:
+                resolver.close()
+
+        results = asyncio.run(resolve())
+        self.assertEqual(
+            results,
+            [
+                ("host{}.gumpe".format(i), [], ["10.0.0.{}".format(i)])
+                for i in range(100)
+            ]
+        )
+
+    def test_cache(self):
+        async def resolve():
+            resolver = AsyncResolver(5, RecordCache(0))
+            resolver.root_server = "127.0.0.1"
+            resolver.port = self.nameserver.port
+            await resolver.open()
+            try:
+                first = await resolver.gethostbyname("host1.gumpe")
+                second = await resolver.gethostbyname("host1.gumpe")
+                missing = await resolver.gethostbyname("bonobo.gumpe")
+                return first, second, missing
+            finally:
+                resolver.close()
+
+        first, second, missing = asyncio.run(resolve())
+        self.assertEqual(first, ("host1.gumpe", [], ["10.0.0.1"]))
+        self.assertEqual(second, first)
+        self.assertEqual(missing, ("bonobo.gumpe", [], []))
+        self.assertEqual(self.nameserver.queries, 2)
+
+    def test_serve_stale_when_slow(self):
+        self.nameserver.delay = 0.3
+        cache = RecordCache(0)
+        cache.enable_serve_stale(60)
+        cache.add_record(ResourceRecord(
+            Name("host1.gumpe"), Type.A, Class.IN, 0, ARecordData("1.0.0.1")
+        ))
+
+        async def resolve():
+            resolver = AsyncResolver(5, cache, stale_timeout=0.05)
+            resolver.root_server = "127.0.0.1"
+            resolver.port = self.nameserver.port
+            await resolver.open()
+            try:
+                stale = await resolver.gethostbyname("host1.gumpe")
+                await asyncio.gather(*resolver.background)
+                fresh = await resolver.gethostbyname("host1.gumpe")
+                return stale, fresh
+            finally:
+                resolver.close()
+
+        stale, fresh = asyncio.run(resolve())
+        self.assertEqual(stale, ("host1.gumpe", [], ["1.0.0.1"]))
+        self.assertEqual(fresh, ("host1.gumpe", [], ["10.0.0.1"]))
+        self.assertEqual(self.nameserver.queries, 1)
+
+
 class TestServer(TestCase):
     """Server tests"""
 